@@ -0,0 +1,266 @@
+#!/usr/bin/python3
+
+import re
+import sys
+import json
+import random
+import timeit
+import parser
+import argparse
+import platform
+import parselib
+from datetime import datetime, timedelta, timezone
+
+RESULTS_FILE = 'bench_results.json'
+BASELINE_FILE = 'bench_baseline.json'
+THRESHOLD = 0.25 # Allowed slowdown against baseline, 0.25 is 25 %.
+REPEAT = 5
+MIN_TIME = 0.2 # Seconds every repetition runs for at least.
+
+FIXTURE_IMEI = '356307042441013'
+FIXTURE_START = datetime(2021, 3, 1, 10, 0, tzinfo=timezone.utc)
+GPS_DATA = {'longitude':25.28, 'latitude':54.68, 'altitude':112, 'angle':180, 'satellites':9, 'speed':42}
+
+BENCHMARKS = {}
+
+
+def benchmark(name):
+    """
+    Registers a benchmark. Decorated function gets fixtures and returns a callable that is timed.
+    """
+    def register(setup):
+        BENCHMARKS[name] = setup
+        return setup
+    return register
+
+def make_records(rng, count, io_elements, codec):
+    io = {avl_id: rng.randrange(0, 2 ** (8 * rng.choice((1, 2, 4, 8)))) for avl_id in range(1, io_elements + 1)}
+    if codec == parselib.CODEC_8E:
+        io[io_elements + 1] = bytes(rng.randrange(256) for _ in range(16))
+    return [parselib.build_record(FIXTURE_START + timedelta(seconds=i), GPS_DATA, io, 0, 1, codec) for i in range(count)]
+
+def make_device_log(rng, packets):
+    """
+    Generates log of server_main with TCP packets, in the format parse_log searches.
+    """
+    lines = []
+    for i in range(packets):
+        time_str = (FIXTURE_START + timedelta(seconds=i)).strftime('[%Y.%m.%d %H:%M:%S]')
+        packet = parselib.build_avl_packet(make_records(rng, 1, 5, parselib.CODEC_8)).hex()
+        lines.append(f'{time_str} Packet len: {len(packet) // 2}, data: {packet}')
+        lines.append(f'{time_str} this is correct single packet')
+        lines.append(f'{time_str} sending reply')
+    return '\n'.join(lines) + '\n'
+
+def make_periodic_log(rng, records):
+    """
+    Generates device log with periodic low priority records, in the format parser.py analyzes.
+    """
+    lines = []
+    time = FIXTURE_START.replace(tzinfo=None)
+    for _ in range(records):
+        time += timedelta(seconds=rng.randint(55, 65))
+        lines.append(f"{time.strftime('[%Y.%m.%d %H:%M:%S]')}-[REC.GEN] Periodic low priority record")
+        lines.append(f"{time.strftime('[%Y.%m.%d %H:%M:%S]')}-[GPS] fix ok")
+    return '\n'.join(lines) + '\n'
+
+def make_fixtures(seed=0):
+    """
+    Generates data every benchmark runs on. Same seed gives same data.
+
+        Returns:
+            fixtures (dict): packets and logs keyed by name.
+    """
+    rng = random.Random(seed)
+    fixtures = {}
+    for codec, name in ((parselib.CODEC_8, '08'), (parselib.CODEC_8E, '8e')):
+        for size, records, io_elements in (('small', 1, 5), ('io_heavy', 10, 60)):
+            packet = parselib.build_avl_packet(make_records(rng, records, io_elements, codec), codec)
+            fixtures[f'tcp_{name}_{size}'] = packet
+    fixtures['udp_08_small'] = parselib.build_avl_packet(make_records(rng, 1, 5, parselib.CODEC_8),
+        parselib.CODEC_8, 'UDP', FIXTURE_IMEI, 1)
+    fixtures['imei'] = parselib.build_imei_packet(FIXTURE_IMEI)
+    fixtures['device_log'] = make_device_log(rng, 1000)
+    fixtures['periodic_log'] = make_periodic_log(rng, 1000)
+    return fixtures
+
+
+@benchmark('parse_packet[tcp_bytes]')
+def bench_parse_packet_tcp_bytes(fixtures):
+    packet = (None, fixtures['tcp_08_small'])
+    return lambda: parselib.parse_packet(packet)
+
+@benchmark('parse_packet[tcp_hex]')
+def bench_parse_packet_tcp_hex(fixtures):
+    packet = (None, fixtures['tcp_08_small'].hex())
+    return lambda: parselib.parse_packet(packet)
+
+@benchmark('parse_packet[udp_bytes]')
+def bench_parse_packet_udp_bytes(fixtures):
+    packet = (None, fixtures['udp_08_small'])
+    return lambda: parselib.parse_packet(packet)
+
+@benchmark('parse_packet[udp_hex]')
+def bench_parse_packet_udp_hex(fixtures):
+    packet = (None, fixtures['udp_08_small'].hex())
+    return lambda: parselib.parse_packet(packet)
+
+def register_payload_benchmarks():
+    for codec, name in ((parselib.CODEC_8, '08'), (parselib.CODEC_8E, '8e')):
+        for size in ('small', 'io_heavy'):
+            fixture = f'tcp_{name}_{size}'
+
+            def hex_setup(fixtures, fixture=fixture, name=name):
+                packet_info, _ = parselib.parse_packet((None, fixtures[fixture].hex()))
+                records, count = packet_info['records'], packet_info['no_of_data_1']
+                return lambda: parselib.parse_record_payload(records, count, name)
+
+            def bytes_setup(fixtures, fixture=fixture, codec=codec):
+                packet_info, _ = parselib.parse_packet((None, fixtures[fixture]))
+                records, count = packet_info['records'], packet_info['no_of_data_1']
+                return lambda: parselib.decode_record_payload(records, count, codec)
+
+            benchmark(f'parse_record_payload[{name}_{size}]')(hex_setup)
+            benchmark(f'decode_record_payload[{name}_{size}]')(bytes_setup)
+
+register_payload_benchmarks()
+
+@benchmark('parse_imei[bytes]')
+def bench_parse_imei_bytes(fixtures):
+    imei = fixtures['imei']
+    return lambda: parselib.parse_imei(imei)
+
+@benchmark('parse_imei[hex]')
+def bench_parse_imei_hex(fixtures):
+    imei = fixtures['imei'].hex()
+    return lambda: parselib.parse_imei(imei)
+
+@benchmark('build_gprs_cmd')
+def bench_build_gprs_cmd(fixtures):
+    return lambda: parselib.build_gprs_cmd('getinfo')
+
+@benchmark('build_record_reply[tcp_bytes]')
+def bench_build_record_reply_tcp(fixtures):
+    return lambda: parselib.build_record_reply('TCP', 10)
+
+@benchmark('build_record_reply[udp_hex]')
+def bench_build_record_reply_udp_hex(fixtures):
+    return lambda: parselib.build_record_reply('UDP', '0A', '01')
+
+@benchmark('parse_log[1000_packets]')
+def bench_parse_log(fixtures):
+    log = fixtures['device_log']
+    return lambda: parselib.parse_log(log)
+
+@benchmark('parser.find_intervals[1000_records]')
+def bench_find_intervals(fixtures):
+    log = fixtures['periodic_log']
+    return lambda: parser.find_intervals(log)
+
+@benchmark('parser.interval_stats[1000_records]')
+def bench_interval_stats(fixtures):
+    diffs = parser.find_intervals(fixtures['periodic_log'])
+    return lambda: parser.interval_stats(list(diffs))
+
+
+def measure(func, repeat=REPEAT, min_time=MIN_TIME):
+    """
+    Times func. Number of calls per repetition is chosen so that a repetition takes at least min_time.
+
+        Returns:
+            result (dict): best and median time per call in ns, and number of calls per repetition.
+    """
+    timer = timeit.Timer(func)
+    number = 1
+    while True:
+        elapsed = timer.timeit(number)
+        if elapsed >= min_time:
+            break
+        number = max(number * 2, int(number * min_time / max(elapsed, 1e-9) * 1.1))
+    times = sorted(t / number * 1e9 for t in timer.repeat(repeat, number))
+    return {'best_ns':round(times[0], 1), 'median_ns':round(times[len(times) // 2], 1), 'calls':number}
+
+def run(names, repeat=REPEAT, min_time=MIN_TIME, seed=0, out=sys.stdout):
+    """
+    Runs benchmarks on generated fixtures.
+
+        Parameters:
+            names (list of str): benchmarks to run.
+            repeat (int): number of repetitions of every benchmark. Default REPEAT.
+            min_time (float): minimal duration of a repetition in seconds. Default MIN_TIME.
+            seed (int): seed of fixture data. Default 0.
+
+        Returns:
+            results (dict): measurements keyed by benchmark name and run metadata.
+    """
+    fixtures = make_fixtures(seed)
+    results = {}
+    for name in names:
+        results[name] = measure(BENCHMARKS[name](fixtures), repeat, min_time)
+        if out:
+            print(f"{name:<45} {results[name]['best_ns']:>12.1f} ns", file=out)
+    return {'time':datetime.now(timezone.utc).isoformat(), 'python':platform.python_version(),
+        'machine':platform.machine(), 'seed':seed, 'benchmarks':results}
+
+def compare(results, baseline, threshold=THRESHOLD):
+    """
+    Compares best times with baseline.
+
+        Returns:
+            regressions (list of tuples): (name, baseline ns, current ns, ratio) of benchmarks
+            slower than baseline by more than threshold.
+    """
+    regressions = []
+    for name, result in results['benchmarks'].items():
+        base = baseline['benchmarks'].get(name)
+        if base is None:
+            continue
+        ratio = result['best_ns'] / base['best_ns']
+        if ratio > 1 + threshold:
+            regressions.append((name, base['best_ns'], result['best_ns'], ratio))
+    return regressions
+
+def main(argv=None):
+    arg_parser = argparse.ArgumentParser(description='Micro-benchmarks of parselib and parser.py hot paths.')
+    arg_parser.add_argument('-k', '--filter', help='run only benchmarks matching this regex')
+    arg_parser.add_argument('-l', '--list', action='store_true', help='list benchmarks and exit')
+    arg_parser.add_argument('-o', '--output', default=RESULTS_FILE, help=f'results file. Default {RESULTS_FILE}')
+    arg_parser.add_argument('-b', '--baseline', default=BASELINE_FILE, help=f'baseline file. Default {BASELINE_FILE}')
+    arg_parser.add_argument('--save-baseline', action='store_true', help='store results as the new baseline')
+    arg_parser.add_argument('--threshold', type=float, default=THRESHOLD,
+        help=f'allowed slowdown against baseline as a fraction. Default {THRESHOLD}')
+    arg_parser.add_argument('--repeat', type=int, default=REPEAT)
+    arg_parser.add_argument('--min-time', type=float, default=MIN_TIME)
+    arg_parser.add_argument('--seed', type=int, default=0)
+    args = arg_parser.parse_args(argv)
+
+    names = [name for name in BENCHMARKS if not args.filter or re.search(args.filter, name)]
+    if args.list:
+        print('\n'.join(names))
+        return 0
+    results = run(names, args.repeat, args.min_time, args.seed)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f'Baseline saved to {args.baseline}')
+        return 0
+    try:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+    except FileNotFoundError:
+        print(f'No baseline at {args.baseline}, run with --save-baseline to create it.')
+        return 0
+    regressions = compare(results, baseline, args.threshold)
+    for name, base, current, ratio in regressions:
+        print(f'SLOWER: {name}: {base:.1f} ns -> {current:.1f} ns ({(ratio - 1) * 100:.0f} %)')
+    if regressions:
+        print(f'{len(regressions)} benchmarks are more than {args.threshold * 100:.0f} % slower than baseline.')
+        return 1
+    print(f'No benchmark is more than {args.threshold * 100:.0f} % slower than baseline.')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
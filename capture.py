@@ -0,0 +1,332 @@
+#!/usr/bin/python3
+
+import os
+import re
+import mmap
+import time
+import socket
+import struct
+import argparse
+import logger
+import parselib
+import threading
+import collections
+from datetime import datetime, timedelta, timezone
+
+MAGIC = b'TCAP'
+VERSION = 1
+IN = 0 # Frame received from device.
+OUT = 1 # Frame sent to device.
+INDEX_SUFFIX = '.idx'
+
+FILE_HEADER = struct.Struct('>4sB3xQ') # magic, version, wall-clock time of capture start in ns
+FRAME_HEADER = struct.Struct('>IQQHBB') # data length, ns since capture start, imei, port, direction, ip length
+INDEX_ENTRY = struct.Struct('>QQQ') # ns since capture start, imei, offset of the frame header
+
+TEXT_LINE_PATTERN = re.compile(r'^(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2},\d{3}) - RAW: (<<|>>) (?:b\')?([0-9a-fA-F]*)\'?'
+    r'(?: IMEI: (\S+))?$')
+TEXT_TIME_FORMAT = '%Y-%m-%d %H:%M:%S,%f'
+
+CaptureFrame = collections.namedtuple('CaptureFrame', ['time', 'direction', 'peer', 'imei', 'data'])
+
+
+def pack_imei(imei):
+    return int(imei) if imei and str(imei).isdigit() else 0
+
+def unpack_imei(imei):
+    return str(imei) if imei else None
+
+def pack_peer(peer):
+    if not peer:
+        return b'', 0
+    ip, port = peer[0], peer[1]
+    family = socket.AF_INET6 if ':' in ip else socket.AF_INET
+    return socket.inet_pton(family, ip), port
+
+def unpack_peer(ip, port):
+    if not ip:
+        return None
+    family = socket.AF_INET6 if len(ip) == 16 else socket.AF_INET
+    return (socket.inet_ntop(family, ip), port)
+
+
+class CaptureWriter:
+
+    def __init__(self, path, start=None):
+        """
+        Initializes CaptureWriter object which appends frames to a binary capture file and its index.
+        Every frame is stored with a length prefix, direction, monotonic timestamp, peer and IMEI.
+        Index (path + '.idx') holds fixed size (timestamp, imei, offset) entries, so it can be searched through mmap.
+
+            Parameters:
+                path (str): path to the capture file. If it exists, frames are appended to it.
+                start (int): wall-clock time of capture start in ns. If supplied, a new capture
+                is always created. Default None.
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        exists = os.path.exists(path) and os.path.getsize(path) >= FILE_HEADER.size
+        if exists and start is None:
+            with open(path, 'rb') as f:
+                magic, version, start = FILE_HEADER.unpack(f.read(FILE_HEADER.size))
+            if magic != MAGIC:
+                raise ValueError(f'{path} is not a capture file')
+            self.file = open(path, 'ab')
+            self.index = open(path + INDEX_SUFFIX, 'ab')
+        else:
+            start = time.time_ns() if start is None else start
+            self.file = open(path, 'wb')
+            self.index = open(path + INDEX_SUFFIX, 'wb')
+            self.file.write(FILE_HEADER.pack(MAGIC, VERSION, start))
+        self.start = start
+        # Timestamps are monotonic within a run and continue from wall-clock time of the capture start.
+        self.monotonic_base = time.monotonic_ns() - (time.time_ns() - start)
+
+    def write(self, direction, data, peer=None, imei=None, timestamp=None):
+        """
+        Appends a frame to the capture.
+
+            Parameters:
+                direction (int): IN or OUT.
+                data (bytes-like): frame as received or sent.
+                peer (tuple): address and port of the device. Default None.
+                imei (str): IMEI of the device if it is known. Default None.
+                timestamp (int): ns since capture start. Default is now.
+        """
+        ip, port = pack_peer(peer)
+        imei = pack_imei(imei)
+        with self.lock:
+            # Taken under the lock, so frames of concurrent writers are appended in time order,
+            # readers bisect the index.
+            if timestamp is None:
+                timestamp = time.monotonic_ns() - self.monotonic_base
+            header = FRAME_HEADER.pack(len(data), timestamp, imei, port, direction, len(ip))
+            offset = self.file.tell()
+            self.file.write(header)
+            self.file.write(ip)
+            self.file.write(data)
+            self.index.write(INDEX_ENTRY.pack(timestamp, imei, offset))
+
+    def flush(self):
+        with self.lock:
+            self.file.flush()
+            self.index.flush()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+            self.index.close()
+
+
+class CaptureReader:
+
+    def __init__(self, path):
+        """
+        Initializes CaptureReader object. Capture and its index are mapped to memory, frames are
+        read only when they are requested.
+
+            Parameters:
+                path (str): path to the capture file.
+        """
+        self.path = path
+        self.file = open(path, 'rb')
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.start = FILE_HEADER.unpack_from(self.data, 0)
+        if magic != MAGIC:
+            raise ValueError(f'{path} is not a capture file')
+        self.start_time = datetime.fromtimestamp(self.start / 1e9, timezone.utc)
+        self.index_file = None
+        self.index = b''
+        index_path = path + INDEX_SUFFIX
+        if os.path.exists(index_path) and os.path.getsize(index_path):
+            self.index_file = open(index_path, 'rb')
+            self.index = mmap.mmap(self.index_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __iter__(self):
+        offset = FILE_HEADER.size
+        size = len(self.data)
+        while offset + FRAME_HEADER.size <= size:
+            frame, offset = self.read_at(offset)
+            if frame is None:
+                break
+            yield frame
+
+    def __len__(self):
+        return len(self.index) // INDEX_ENTRY.size
+
+    def close(self):
+        self.data.close()
+        self.file.close()
+        if self.index_file:
+            self.index.close()
+            self.index_file.close()
+
+    def read_at(self, offset):
+        """
+        Reads a frame stored at offset.
+
+            Returns:
+                frame (CaptureFrame): the frame, None if the capture is truncated there.
+                next_offset (int): offset of the next frame.
+        """
+        length, timestamp, imei, port, direction, ip_len = FRAME_HEADER.unpack_from(self.data, offset)
+        start = offset + FRAME_HEADER.size
+        end = start + ip_len + length
+        if end > len(self.data):
+            return None, end
+        ip = self.data[start:start + ip_len]
+        frame = CaptureFrame(self.to_time(timestamp), direction, unpack_peer(ip, port), unpack_imei(imei),
+            self.data[start + ip_len:end])
+        return frame, end
+
+    def to_time(self, timestamp):
+        return self.start_time + timedelta(microseconds=timestamp // 1000)
+
+    def to_timestamp(self, time):
+        if time.tzinfo is None:
+            time = time.astimezone()
+        return max(int((time - self.start_time).total_seconds() * 1e9), 0)
+
+    def entry(self, i):
+        return INDEX_ENTRY.unpack_from(self.index, i * INDEX_ENTRY.size)
+
+    def bisect(self, timestamp):
+        """
+        Finds position of the first index entry not older than timestamp.
+        """
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.entry(mid)[0] < timestamp:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def frames(self, start=None, end=None, imei=None):
+        """
+        Yields frames within time window and/or of a single device. Uses the index, only matching frames are read.
+
+            Parameters:
+                start (datetime): frames older than start are skipped. Default None.
+                end (datetime): frames newer than end are skipped. Default None.
+                imei (str): only frames of this IMEI are returned. Default None.
+
+            Returns:
+                frame (CaptureFrame): matching frames in time order.
+        """
+        if not self.index:
+            # Naive times are local, frame times are aware.
+            if start is not None and start.tzinfo is None:
+                start = start.astimezone()
+            if end is not None and end.tzinfo is None:
+                end = end.astimezone()
+            for frame in self:
+                if ((start is None or frame.time >= start) and (end is None or frame.time <= end)
+                        and (imei is None or frame.imei == imei)):
+                    yield frame
+            return
+        first = self.bisect(self.to_timestamp(start)) if start else 0
+        last = self.bisect(self.to_timestamp(end) + 1) if end else len(self)
+        wanted = pack_imei(imei)
+        for i in range(first, last):
+            timestamp, entry_imei, offset = self.entry(i)
+            if imei is None or entry_imei == wanted:
+                frame, _ = self.read_at(offset)
+                if frame is not None:
+                    yield frame
+
+
+def text_to_capture(text_path, capture_path):
+    """
+    Converts raw text log (raw.log), or its rotated segment, to a binary capture. Text log has no peer information.
+    IMEI is taken from the line (see logger.RawFormatter), logs written without it only have IMEI of
+    IMEI and UDP frames.
+
+        Returns:
+            count (int): number of converted frames.
+    """
+    writer = None
+    count = 0
+    with logger.open_segment(text_path) as f:
+        for line in f:
+            match = TEXT_LINE_PATTERN.match(line.rstrip('\n'))
+            if not match:
+                continue
+            time_str, direction, data, imei = match.groups()
+            wall = datetime.strptime(time_str, TEXT_TIME_FORMAT).astimezone()
+            wall_ns = int(wall.timestamp() * 1e6) * 1000
+            if writer is None:
+                writer = CaptureWriter(capture_path, wall_ns)
+            data = bytes.fromhex(data)
+            if direction == '<<' and imei is None:
+                try:
+                    if len(data) > 4 and data[2:4] == b'\xca\xfe':
+                        imei = parselib.parse_imei(parselib.parse_packet((None, data))[0]['imei'], False)
+                    elif len(data) > 2 and int.from_bytes(data[:2], 'big') == len(data) - 2:
+                        imei = parselib.parse_imei(data)
+                except (ValueError, IndexError, struct.error):
+                    imei = None
+            writer.write(IN if direction == '<<' else OUT, data, imei=imei, timestamp=max(wall_ns - writer.start, 0))
+            count += 1
+    if writer:
+        writer.close()
+    return count
+
+def capture_to_text(capture_path, text_path, start=None, end=None, imei=None):
+    """
+    Converts binary capture to raw text log format.
+
+        Returns:
+            count (int): number of converted frames.
+    """
+    count = 0
+    with CaptureReader(capture_path) as reader, open(text_path, 'w') as f:
+        for frame in reader.frames(start, end, imei):
+            local = frame.time.astimezone()
+            time_str = f"{local.strftime('%Y-%m-%d %H:%M:%S')},{local.microsecond // 1000:03d}"
+            tag = f' IMEI: {frame.imei}' if frame.imei else ''
+            if frame.direction == IN:
+                f.write(f'{time_str} - RAW: << {frame.data.hex()}{tag}\n')
+            else:
+                f.write(f"{time_str} - RAW: >> b'{frame.data.hex()}'{tag}\n")
+            count += 1
+    return count
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Converts and searches binary raw captures.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    to_text = commands.add_parser('to-text', help='convert capture to raw text log')
+    to_text.add_argument('capture')
+    to_text.add_argument('text')
+    from_text = commands.add_parser('from-text', help='convert raw text log to capture')
+    from_text.add_argument('text')
+    from_text.add_argument('capture')
+    dump = commands.add_parser('dump', help='print frames of a capture')
+    dump.add_argument('capture')
+    for command in (to_text, dump):
+        command.add_argument('--imei')
+        command.add_argument('--start', type=datetime.fromisoformat, help='ISO format, local time if no offset')
+        command.add_argument('--end', type=datetime.fromisoformat, help='ISO format, local time if no offset')
+    args = parser.parse_args(argv)
+    if args.command == 'to-text':
+        count = capture_to_text(args.capture, args.text, args.start, args.end, args.imei)
+        print(f'{count} frames written to {args.text}')
+    elif args.command == 'from-text':
+        count = text_to_capture(args.text, args.capture)
+        print(f'{count} frames written to {args.capture}')
+    elif args.command == 'dump':
+        with CaptureReader(args.capture) as reader:
+            for frame in reader.frames(args.start, args.end, args.imei):
+                direction = '<<' if frame.direction == IN else '>>'
+                print(f'{frame.time.astimezone()} {frame.peer} {frame.imei} {direction} {frame.data.hex()}')
+
+
+if __name__ == '__main__':
+    main()
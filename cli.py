@@ -0,0 +1,293 @@
+#!/usr/bin/python3
+
+import sys
+import signal
+import argparse
+import functools
+import config
+import logger
+import metrics
+import decodepool
+import dedup
+import supervisor
+import sinks
+import core
+import engine
+from core import ServerCore
+
+__version__ = '1.0'
+SINK_PATHS = {'sqlite':'records.db', 'columnar':'records'}
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Runs Teltonika device server without GUI.',
+        epilog=f'Example of configuration file:\n{config.EXAMPLE}', formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-c', '--config', help='configuration file with any number of TCP and UDP listeners')
+    parser.add_argument('-p', '--port', type=int, help='port to listen on, if configuration file is not used')
+    parser.add_argument('-t', '--protocol', choices=['TCP', 'UDP'], default='TCP', type=str.upper,
+        help='transport protocol, TCP by default')
+    parser.add_argument('--log-file', help='application events log file')
+    parser.add_argument('--raw-log-file', help='raw data log file')
+    parser.add_argument('--raw-format', choices=['text', 'capture'],
+        help='raw data as hex text lines or as binary capture (see capture.py), text by default')
+    parser.add_argument('--log-queue', action='store_true', default=None,
+        help='write logs from a background thread, network threads only enqueue records')
+    parser.add_argument('--log-flush-interval', type=float, help=f'seconds between log writes, '
+        f'{logger.FLUSH_INTERVAL} by default')
+    parser.add_argument('--log-buffer-size', type=int, help=f'maximum number of queued log records, '
+        f'{logger.BUFFER_SIZE} by default')
+    parser.add_argument('--log-overflow', choices=logger.OVERFLOW_POLICIES,
+        help='what to do with log records when the queue is full, drop_oldest by default')
+    parser.add_argument('--log-max-bytes', type=int,
+        help='rotate log files when they reach this many bytes, not rotated by size by default')
+    parser.add_argument('--log-rotate-interval', type=float,
+        help='rotate log files every this many seconds (86400 is a day), not rotated by time by default')
+    parser.add_argument('--log-backup-count', type=int, help='rotated log segments kept, all of them by default')
+    parser.add_argument('--log-max-age', type=float,
+        help='seconds rotated log segments are kept for, forever by default')
+    parser.add_argument('--no-log-compress', action='store_true', default=None,
+        help="don't gzip rotated log segments")
+    parser.add_argument('--handshake-timeout', type=float,
+        help=f'seconds TCP client has to send its IMEI in, {core.HANDSHAKE_TIMEOUT} by default, 0 disables it')
+    parser.add_argument('--tcp-idle-timeout', type=float,
+        help='close TCP connection when nothing is received for this many seconds, disabled by default')
+    parser.add_argument('--udp-idle-timeout', type=float,
+        help='forget UDP device when nothing is received for this many seconds, disabled by default')
+    parser.add_argument('--udp-rcvbuf', type=int, help=f'receive buffer of UDP sockets in bytes, unless set for '
+        f'the listener in configuration file, {engine.UDP_RCVBUF} by default')
+    parser.add_argument('--decode-workers', type=int, help='decode records in this many worker processes after '
+        f'packets are acked, {decodepool.WORKERS} (decode on network threads before acking) by default')
+    parser.add_argument('--dedup-window', type=int, help='packets remembered per device to recognize ones sent again '
+        f'because their ack was lost, {dedup.WINDOW} by default, 0 disables deduplication')
+    parser.add_argument('--sink', choices=['sqlite', 'columnar'],
+        help='store decoded records in SQLite database or in columnar files, records are not stored by default')
+    parser.add_argument('--sink-path', help='database file (records.db by default) or directory of columnar files '
+        '(records by default)')
+    parser.add_argument('--ack-after-durable', action='store_true', default=None,
+        help='ack packets only once their records are stored')
+    parser.add_argument('--metrics-port', type=int,
+        help='serve metrics in Prometheus text format on http://<metrics-host>:<port>/metrics, disabled by default')
+    parser.add_argument('--metrics-host', help='address metrics are served on, 127.0.0.1 by default')
+    parser.add_argument('--no-device-metrics', action='store_true', default=None,
+        help="don't keep counters of every IMEI")
+    parser.add_argument('-w', '--workers', type=int, help='run this many worker processes sharing listening ports '
+        '(SO_REUSEPORT) under a supervisor, 0 (single process) by default')
+    parser.add_argument('--control-socket', help=f'Unix socket of the supervisor, {supervisor.CONTROL_SOCKET} by default')
+    parser.add_argument('--list-clients', action='store_true',
+        help='print devices connected to a running supervisor and exit')
+    parser.add_argument('--send-cmd', nargs=2, metavar=('IMEI', 'CMD'),
+        help='send GPRS command through a running supervisor and exit')
+    parser.add_argument('--disconnect', metavar='IMEI', help='disconnect device through a running supervisor and exit')
+    parser.add_argument('-v', '--verbose', action='store_true',
+        help='print information that is otherwise shown in GUI text browser')
+    parser.add_argument('--version', action='version', version=f'%(prog)s {__version__}')
+    args = parser.parse_args(argv)
+    if not args.config and args.port is None and not is_control(args):
+        parser.error('either --config or --port is required')
+    return args
+
+def is_control(args):
+    return bool(args.list_clients or args.send_cmd or args.disconnect)
+
+def load_settings(args):
+    """
+    Merges configuration file and command line options. Command line options take precedence.
+
+        Parameters:
+            args (argparse.Namespace): parsed command line options.
+
+        Returns:
+            settings (dict): server options and list of listeners, see config.load_config().
+    """
+    if args.config:
+        settings = config.load_config(args.config)
+    else:
+        settings = {'server':{}, 'listeners':[{'name':None, 'protocol':args.protocol, 'port':args.port,
+            'host':'0.0.0.0', 'rcvbuf':None}], 'commands':[]}
+    for listener in settings['listeners']:
+        listener['rcvbuf'] = listener['rcvbuf'] or args.udp_rcvbuf
+    server = settings['server']
+    server['log_file'] = args.log_file or server.get('log_file', 'application_events.log')
+    server['raw_log_file'] = args.raw_log_file or server.get('raw_log_file', 'raw.log')
+    server['raw_format'] = args.raw_format or server.get('raw_format', 'text')
+    server['log_queue'] = args.log_queue or server.get('log_queue', 'no').lower() in ('yes', 'true', 'on', '1')
+    server['log_flush_interval'] = args.log_flush_interval or float(server.get('log_flush_interval',
+        logger.FLUSH_INTERVAL))
+    server['log_buffer_size'] = args.log_buffer_size or int(server.get('log_buffer_size', logger.BUFFER_SIZE))
+    server['log_overflow'] = args.log_overflow or server.get('log_overflow', logger.OVERFLOW_DROP_OLDEST)
+    rotation_options = (('log_max_bytes', logger.MAX_BYTES, int), ('log_rotate_interval', logger.INTERVAL, float),
+        ('log_backup_count', logger.BACKUP_COUNT, int), ('log_max_age', logger.MAX_AGE, float))
+    for option, default, kind in rotation_options:
+        value = getattr(args, option)
+        server[option] = kind(value if value is not None else server.get(option, default))
+    server['log_compress'] = not (args.no_log_compress or
+        server.get('log_compress', 'yes').lower() in ('no', 'false', 'off', '0'))
+    for option, default in (('handshake_timeout', core.HANDSHAKE_TIMEOUT), ('tcp_idle_timeout', core.IDLE_TIMEOUT),
+            ('udp_idle_timeout', core.IDLE_TIMEOUT)):
+        value = getattr(args, option)
+        if value is None:
+            value = server.get(option, default)
+        server[option] = float(value or 0) or None # 0 disables the timeout.
+    decode_workers = args.decode_workers if args.decode_workers is not None else server.get('decode_workers')
+    server['decode_workers'] = int(decode_workers or decodepool.WORKERS)
+    dedup_window = args.dedup_window if args.dedup_window is not None else server.get('dedup_window')
+    server['dedup_window'] = int(dedup_window if dedup_window is not None else dedup.WINDOW)
+    server['sink'] = args.sink or server.get('sink') or None
+    server['sink_path'] = args.sink_path or server.get('sink_path') or SINK_PATHS.get(server['sink'])
+    server['ack_after_durable'] = bool(args.ack_after_durable or
+        server.get('ack_after_durable', 'no').lower() in ('yes', 'true', 'on', '1'))
+    server['workers'] = int(args.workers if args.workers is not None else server.get('workers', 0))
+    server['control_socket'] = args.control_socket or server.get('control_socket', supervisor.CONTROL_SOCKET)
+    metrics_port = args.metrics_port if args.metrics_port is not None else server.get('metrics_port')
+    server['metrics_port'] = int(metrics_port) if metrics_port else None
+    server['metrics_host'] = args.metrics_host or server.get('metrics_host', '127.0.0.1')
+    server['device_metrics'] = not (args.no_device_metrics or
+        server.get('device_metrics', 'yes').lower() in ('no', 'false', 'off', '0'))
+    return settings
+
+def log_rotation(settings):
+    if not settings['log_max_bytes'] and not settings['log_rotate_interval']:
+        return None
+    return {'max_bytes':settings['log_max_bytes'], 'interval':settings['log_rotate_interval'],
+        'backup_count':settings['log_backup_count'], 'max_age':settings['log_max_age'],
+            'compress':settings['log_compress']}
+
+def create_log_writer(settings):
+    if not settings['log_queue']:
+        return None
+    return logger.LogWriter(settings['log_flush_interval'], settings['log_buffer_size'], settings['log_overflow'])
+
+def serve(settings, verbose=False, worker=None, control_path=None):
+    """
+    Runs server until it is closed with SIGTERM or Ctrl+C.
+
+        Parameters:
+            settings (dict): server options, listeners and commands, see load_settings().
+            verbose (bool): print information that is otherwise shown in GUI text browser. Default False.
+            worker (int): index of supervisor's worker, None runs a standalone server. Default None.
+            control_path (str): control socket of the supervisor, only used by workers. Default None.
+    """
+    options = settings['server']
+    log_file, raw_log_file, metrics_port = options['log_file'], options['raw_log_file'], options['metrics_port']
+    if worker is not None:
+        # Workers write their own logs and records and serve their own metrics on consecutive ports.
+        log_file, raw_log_file = supervisor.worker_file(log_file, worker), supervisor.worker_file(raw_log_file, worker)
+        metrics_port = metrics_port and metrics_port + worker
+    log_writer = create_log_writer(options)
+    server = ServerCore(log_file, raw_log_file, log_writer, options['raw_format'],
+        metrics.Metrics(options['device_metrics']), options['decode_workers'], log_rotation(options))
+    metrics_server = None
+    if metrics_port:
+        metrics_server = metrics.MetricsServer(server.metrics, options['metrics_host'], metrics_port)
+        metrics_server.start()
+        server.logger.info(f"Metrics are served on http://{options['metrics_host']}:{metrics_port}/metrics")
+    server.handshake_timeout = options['handshake_timeout']
+    server.idle_timeouts = {'TCP':options['tcp_idle_timeout'], 'UDP':options['udp_idle_timeout']}
+    server.dedup = dedup.DedupIndex(options['dedup_window']) if options['dedup_window'] else None
+    if options['sink']:
+        sink_path = options['sink_path'] if worker is None else supervisor.worker_file(options['sink_path'], worker)
+        server.sink = sinks.create_sink(options['sink'], sink_path)
+        server.ack_after_durable = options['ack_after_durable']
+        server.logger.info(f"Records are stored in {sink_path} ({options['sink']}).")
+    if verbose:
+        server.display_info.connect(print)
+    signal.signal(signal.SIGTERM, lambda signum, frame: server.close())
+    for listener in settings['listeners']:
+        server.add_listener(listener['port'], listener['protocol'], listener['host'], listener['name'],
+            listener['rcvbuf'], worker is not None)
+    link = None
+    if worker is not None:
+        # Connected before the server starts, so no device is missed.
+        link = supervisor.SupervisorLink(server, worker, control_path)
+    server.start()
+    for listener in server.listeners:
+        server.logger.info(f"{listener.trans_prot} server started on port {listener.port}.")
+    if link:
+        link.start()
+    else:
+        schedule_commands(server, settings['commands'])
+    try:
+        while server.thread.is_alive():
+            server.thread.join(0.5)
+    except KeyboardInterrupt:
+        server.close()
+        server.thread.join()
+    server.logger.info(f"Server was closed with all it's connections.")
+    server.scheduler.stop()
+    if metrics_server:
+        metrics_server.stop()
+    if log_writer:
+        log_writer.stop()
+
+def supervise(settings, verbose=False):
+    """
+    Runs workers under a supervisor until it is closed with SIGTERM or Ctrl+C. Every worker runs
+    serve() in its own process, scheduled commands are sent from the supervisor.
+    """
+    options = settings['server']
+    sup = supervisor.Supervisor(options['workers'], functools.partial(serve, settings, verbose),
+        options['control_socket'], options['log_file'], log_rotation(options))
+    if verbose:
+        sup.display_info.connect(print)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sup.close())
+    sup.start()
+    sup.logger.info(f"Supervisor started {options['workers']} workers, control socket is {options['control_socket']}.")
+    schedule_commands(sup, settings['commands'])
+    try:
+        while sup.thread.is_alive():
+            sup.thread.join(0.5)
+    except KeyboardInterrupt:
+        sup.close()
+        sup.thread.join()
+    sup.stop()
+    sup.logger.info(f"Supervisor was closed with all it's workers.")
+
+def schedule_commands(server, commands):
+    for command in commands:
+        for imei in command['imei']:
+            server.scheduler.schedule(imei, command['cmd'] + '\r\n', command['delay'], command['period'],
+                command['jitter'])
+        server.logger.info(f"GPRS CMD {command['name']} is scheduled for {len(command['imei'])} devices.")
+
+def control(args):
+    """
+    Sends request of --list-clients, --send-cmd or --disconnect option to a running supervisor.
+
+        Returns:
+            status (int): exit status.
+    """
+    path = args.control_socket
+    if not path and args.config:
+        path = config.load_config(args.config)['server'].get('control_socket')
+    try:
+        with supervisor.ControlClient(path or supervisor.CONTROL_SOCKET) as client:
+            if args.list_clients:
+                clients = client.clients()
+                for device in clients:
+                    print(f"{device['imei']}\t{device['protocol']}\tworker {device['worker']}\t{device['addr']}")
+                print(f'{len(clients)} clients')
+            elif args.send_cmd:
+                imei, cmd = args.send_cmd
+                worker = client.send_cmd(cmd + '\r\n', imei)
+                print(f'GPRS CMD sent to {imei} through worker {worker}.')
+            else:
+                worker = client.disconnect_client(args.disconnect)
+                print(f'{args.disconnect} disconnected by worker {worker}.')
+    except (OSError, RuntimeError) as e:
+        print(f'Error: {e}')
+        return 1
+    return 0
+
+def main(argv=None):
+    args = parse_args(argv)
+    if is_control(args):
+        return control(args)
+    settings = load_settings(args)
+    if settings['server']['workers']:
+        supervise(settings, args.verbose)
+    else:
+        serve(settings, args.verbose)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
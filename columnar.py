@@ -0,0 +1,203 @@
+#!/usr/bin/python3
+
+import numpy as np
+import parselib
+
+# Fixed-width part of every AVL record, same layout as parselib.RECORD_HEADER.
+RECORD_HEADER = np.dtype([('timestamp', '>u8'), ('priority', 'u1'), ('longitude', '>i4'), ('latitude', '>i4'),
+    ('altitude', '>i2'), ('angle', '>u2'), ('satellites', 'u1'), ('speed', '>u2')])
+VALUE_WIDTHS = (1, 2, 4, 8)
+
+
+def gather(buf, offsets, width):
+    """
+    Copies width bytes starting at every offset into rows of a new array.
+
+        Parameters:
+            buf (np.ndarray): uint8 array with all payloads.
+            offsets (np.ndarray): start of every field.
+            width (int): field size in bytes.
+
+        Returns:
+            rows (np.ndarray): (len(offsets), width) uint8 array, C-contiguous.
+    """
+    return buf[offsets[:, None] + np.arange(width)]
+
+def gather_uint(buf, offsets, width):
+    """
+    Reads big-endian unsigned ints of width bytes starting at every offset.
+    """
+    if not len(offsets):
+        return np.zeros(0, np.uint64)
+    return gather(buf, offsets, width).view(f'>u{width}').ravel().astype(np.uint64)
+
+def expand_groups(starts, counts, records, entry_size):
+    """
+    Turns IO element groups (start, count) into offsets of every element in the group.
+
+        Returns:
+            offsets (np.ndarray): offset of every element.
+            records (np.ndarray): index of the record every element belongs to.
+    """
+    starts = np.asarray(starts, np.int64)
+    counts = np.asarray(counts, np.int64)
+    records = np.asarray(records, np.int64)
+    total = int(counts.sum())
+    if not total:
+        return np.zeros(0, np.int64), np.zeros(0, np.int64)
+    firsts = np.repeat(np.cumsum(counts) - counts, counts)
+    within = np.arange(total) - firsts
+    return np.repeat(starts, counts) + within * entry_size, np.repeat(records, counts)
+
+def scan_payload(payload, base, no_of_records, codec, layout):
+    """
+    Walks record payload and notes where every record and IO element group starts.
+    Only counts are read here, values are decoded later for all records at once.
+
+        Parameters:
+            payload (bytes-like): record payload of a single packet.
+            base (int): offset the payload will have in the joined buffer of all payloads.
+            no_of_records (int): number of records in this payload.
+            codec (int): codec of the payload.
+            layout (dict): collected offsets, updated in place.
+
+        Raises:
+            ValueError: if a record doesn't fit in the payload. Values are gathered from the joined
+            buffer later, so they would be read from the next payload instead.
+    """
+    size = len(payload)
+    counter = parselib.U16 if codec == parselib.CODEC_8E else parselib.U8
+    c_size = counter.size
+    pos = 0
+    for n in range(no_of_records):
+        record = len(layout['records'])
+        layout['records'].append(base + pos)
+        layout['codecs'].append(c_size)
+        pos += RECORD_HEADER.itemsize + 2 * c_size
+        for width in VALUE_WIDTHS:
+            count = counter.unpack_from(payload, pos)[0]
+            pos += c_size
+            if count:
+                groups = layout['groups'].setdefault((width, c_size), ([], [], []))
+                groups[0].append(base + pos)
+                groups[1].append(count)
+                groups[2].append(record)
+                pos += count * (c_size + width)
+                if pos > size:
+                    raise ValueError(f'Record payload is {size} bytes long, IO elements of record {n} end at {pos}')
+        if codec == parselib.CODEC_8E:
+            count = counter.unpack_from(payload, pos)[0]
+            pos += c_size
+            for _ in range(count):
+                avl_id, value_len = parselib.NX_ELEMENT.unpack_from(payload, pos)
+                pos += parselib.NX_ELEMENT.size
+                layout['nx'].append((record, avl_id, bytes(payload[pos:pos + value_len])))
+                pos += value_len
+        if pos > size:
+            raise ValueError(f'Record payload is {size} bytes long, record {n} ends at {pos}')
+
+def decode_batch(packets):
+    """
+    Decodes records of many packets into columns. Fixed-width fields of all records are decoded
+    with vectorized numpy operations. IO elements are returned in sparse (coordinate) form.
+
+        Parameters:
+            packets (iterable): packets as accepted by parselib.parse_packet, (time_received, data) tuples,
+            or bare packet data (bytes or hex str). GPRS command responses are skipped.
+
+        Returns:
+            batch (dict of np.ndarray): one entry per record in 'packet', 'time_received', 'timestamp',
+            'priority', 'longitude', 'latitude', 'altitude', 'angle', 'satellites', 'speed', 'event_id' and
+            'no_of_io'. One entry per IO element in 'io_record', 'io_id' and 'io_value' (uint64).
+            One entry per variable length (Codec 8E NX) element in 'nx_record', 'nx_id' and 'nx_value' (bytes).
+            *_record columns hold index of the record the element belongs to.
+    """
+    payloads = []
+    times = []
+    record_packets = []
+    layout = {'records':[], 'codecs':[], 'groups':{}, 'nx':[]}
+    pos = 0
+    for i, packet in enumerate(packets):
+        if not isinstance(packet, tuple):
+            packet = (None, packet)
+        if isinstance(packet[1], str):
+            packet = (packet[0], bytes.fromhex(packet[1]))
+        pinfo, _ = parselib.parse_packet(packet)
+        if pinfo['codec'] not in (parselib.CODEC_8, parselib.CODEC_8E):
+            continue
+        payload = pinfo['records']
+        payloads.append(payload)
+        count = len(layout['records'])
+        scan_payload(payload, pos, pinfo['no_of_data_1'], pinfo['codec'], layout)
+        n = len(layout['records']) - count
+        record_packets.extend([i] * n)
+        times.extend([packet[0]] * n)
+        pos += len(payload)
+    buf = np.frombuffer(b''.join(payloads), np.uint8)
+
+    records = np.asarray(layout['records'], np.int64)
+    headers = gather(buf, records, RECORD_HEADER.itemsize).view(RECORD_HEADER).ravel()
+    c_sizes = np.asarray(layout['codecs'], np.int64)
+    event_id = np.zeros(len(records), np.uint16)
+    no_of_io = np.zeros(len(records), np.uint16)
+    for c_size in (1, 2):
+        mask = c_sizes == c_size
+        offsets = records[mask] + RECORD_HEADER.itemsize
+        event_id[mask] = gather_uint(buf, offsets, c_size)
+        no_of_io[mask] = gather_uint(buf, offsets + c_size, c_size)
+
+    io_record, io_id, io_value = [], [], []
+    for (width, c_size), (starts, counts, recs) in layout['groups'].items():
+        offsets, recs = expand_groups(starts, counts, recs, c_size + width)
+        io_record.append(recs)
+        io_id.append(gather_uint(buf, offsets, c_size))
+        io_value.append(gather_uint(buf, offsets + c_size, width))
+    if io_record:
+        io_record = np.concatenate(io_record)
+        order = np.argsort(io_record, kind='stable')
+        io_record = io_record[order]
+        io_id = np.concatenate(io_id)[order].astype(np.uint16)
+        io_value = np.concatenate(io_value)[order]
+    else:
+        io_record, io_id, io_value = np.zeros(0, np.int64), np.zeros(0, np.uint16), np.zeros(0, np.uint64)
+
+    nx = layout['nx']
+    nx_value = np.empty(len(nx), object)
+    nx_value[:] = [value for _, _, value in nx]
+    return {
+        'packet':np.asarray(record_packets, np.int64),
+        'time_received':np.array([t if t is not None else 'NaT' for t in times], 'datetime64[us]'),
+        'timestamp':headers['timestamp'].astype(np.int64).astype('datetime64[ms]'),
+        'priority':headers['priority'].astype(np.uint8),
+        'longitude':headers['longitude'].astype(np.float64) / 10000000,
+        'latitude':headers['latitude'].astype(np.float64) / 10000000,
+        'altitude':headers['altitude'].astype(np.int16),
+        'angle':headers['angle'].astype(np.uint16),
+        'satellites':headers['satellites'].astype(np.uint8),
+        'speed':headers['speed'].astype(np.uint16),
+        'event_id':event_id,
+        'no_of_io':no_of_io,
+        'io_record':io_record,
+        'io_id':io_id,
+        'io_value':io_value,
+        'nx_record':np.asarray([record for record, _, _ in nx], np.int64),
+        'nx_id':np.asarray([avl_id for _, avl_id, _ in nx], np.uint16),
+        'nx_value':nx_value,
+    }
+
+def io_column(batch, avl_id, default=0):
+    """
+    Makes a dense column of a single IO element out of sparse IO columns of a batch.
+
+        Parameters:
+            batch (dict): result of decode_batch.
+            avl_id (int): AVL id of the IO element.
+            default (int): value of records that don't have the IO element. Default 0.
+
+        Returns:
+            column (np.ndarray): uint64 value for every record.
+    """
+    column = np.full(len(batch['timestamp']), default, np.uint64)
+    mask = batch['io_id'] == avl_id
+    column[batch['io_record'][mask]] = batch['io_value'][mask]
+    return column
@@ -0,0 +1,95 @@
+#!/usr/bin/python3
+
+import configparser
+
+LISTENER_PREFIX = 'listener:'
+COMMAND_PREFIX = 'command:'
+
+EXAMPLE = """
+[server]
+log_file = application_events.log
+raw_log_file = raw.log
+raw_format = text
+log_queue = yes
+log_flush_interval = 0.5
+log_buffer_size = 10000
+log_overflow = drop_oldest
+log_max_bytes = 104857600
+log_rotate_interval = 86400
+log_backup_count = 0
+log_max_age = 2592000
+log_compress = yes
+handshake_timeout = 30
+tcp_idle_timeout = 900
+udp_idle_timeout = 900
+decode_workers = 2
+dedup_window = 32
+workers = 0
+sink = sqlite
+sink_path = records.db
+ack_after_durable = no
+control_socket = control.sock
+metrics_port = 9150
+metrics_host = 127.0.0.1
+device_metrics = yes
+
+[listener:fmb-tcp]
+protocol = TCP
+port = 5027
+
+[listener:fmb-udp]
+protocol = UDP
+port = 5027
+host = 0.0.0.0
+rcvbuf = 4194304
+
+[command:poll-info]
+cmd = getinfo
+imei = 356307042441013 356307042441014
+period = 600
+jitter = 30
+"""
+
+def load_config(path):
+    """
+    Reads server configuration from an INI file. Every [listener:<name>] section describes
+    one listening socket, [server] section holds options of the server itself.
+    Every [command:<name>] section describes a GPRS command sent to listed IMEIs once
+    (after delay seconds) or every period seconds.
+
+        Parameters:
+            path (str): path to the configuration file.
+
+        Returns:
+            config (dict): 'server' dict of server options, 'listeners' list of dicts
+            with 'name', 'protocol', 'port', 'host' and 'rcvbuf' (None if not set) keys and
+            'commands' list of dicts with 'name', 'cmd', 'imei' (list), 'delay', 'period' and 'jitter' keys.
+    """
+    parser = configparser.ConfigParser()
+    with open(path, 'r') as f:
+        parser.read_file(f)
+    listeners = []
+    for section in parser.sections():
+        if not section.startswith(LISTENER_PREFIX):
+            continue
+        options = parser[section]
+        protocol = options.get('protocol', 'TCP').upper()
+        if protocol not in ('TCP', 'UDP'):
+            raise ValueError(f'[{section}] unknown protocol {protocol}')
+        port = options.getint('port')
+        if port is None:
+            raise ValueError(f'[{section}] port is missing')
+        listeners.append({'name':section[len(LISTENER_PREFIX):], 'protocol':protocol,
+            'port':port, 'host':options.get('host', '0.0.0.0'), 'rcvbuf':options.getint('rcvbuf')})
+    commands = []
+    for section in parser.sections():
+        if not section.startswith(COMMAND_PREFIX):
+            continue
+        options = parser[section]
+        if not options.get('cmd') or not options.get('imei'):
+            raise ValueError(f'[{section}] cmd and imei are required')
+        commands.append({'name':section[len(COMMAND_PREFIX):], 'cmd':options.get('cmd'),
+            'imei':options.get('imei').replace(',', ' ').split(), 'delay':options.getfloat('delay', 0.0),
+            'period':options.getfloat('period'), 'jitter':options.getfloat('jitter', 0.0)})
+    server = dict(parser['server']) if parser.has_section('server') else {}
+    return {'server':server, 'listeners':listeners, 'commands':commands}
@@ -0,0 +1,579 @@
+#!/usr/bin/python3
+
+import time
+import struct
+import functools
+import parselib
+import threading
+import binascii
+import capture
+import decodepool
+import dedup
+from logger import Logger
+from metrics import Metrics
+from registry import SessionRegistry
+from scheduler import CommandScheduler
+from engine import Engine, Listener
+from datetime import datetime
+
+HANDSHAKE_TIMEOUT = 30 # Seconds TCP client has to send its IMEI in.
+IDLE_TIMEOUT = None # Seconds without data after which session is closed. None never closes it.
+MAX_QUEUED_COMMANDS = 100 # GPRS commands waiting for a single connection's output buffer to drain.
+
+
+class Signal:
+
+    def __init__(self):
+        """
+        Initializes Signal object. A minimal replacement of pyqtSignal, so server core can run without Qt.
+        Connected slots are called in the thread that emits the signal.
+        """
+        self.slots = []
+
+    def connect(self, slot):
+        self.slots.append(slot)
+
+    def disconnect(self, slot):
+        self.slots.remove(slot)
+
+    def emit(self, *args):
+        for slot in self.slots:
+            slot(*args)
+
+
+class ServerCore:
+
+    def __init__(self, log_file='application_events.log', raw_log_file='raw.log', log_writer=None, raw_format='text',
+            metrics=None, decode_workers=decodepool.WORKERS, log_rotation=None):
+        """
+        Initializes ServerCore object. It owns sockets, clients and packet handling and reports
+        everything through display_info, new_conn and closed_conn signals. It doesn't depend on Qt,
+        so it can run headless (see cli.py) or with the GUI attached (see main.py).
+        If log_writer (logger.LogWriter) is supplied, network threads only enqueue log records.
+        raw_format is either 'text' (hex lines in raw_log_file) or 'capture' (binary capture, see capture.py).
+        If log_rotation (see logger.Logger) is supplied, log_file and text raw_log_file are rotated.
+        Counters and histograms are kept in metrics (metrics.Metrics), see metrics.MetricsServer to expose them.
+        Decoded AVL records are reported through new_records signal, in the order the device sent them.
+        With decode_workers > 0 they are decoded by worker processes (decodepool.DecodePool) after the packet
+        is acked, otherwise on the network thread before it is. If sink (sinks.RecordSink) is set, decoded
+        records are stored in it and with ack_after_durable packets are only acked once their records are durable.
+        """
+        self.display_info = Signal()
+        self.new_conn = Signal()
+        self.closed_conn = Signal()
+        self.new_records = Signal() # IMEI and list of decoded records, see parselib.decode_record_payload().
+        self.thread = None
+        self.sessions = SessionRegistry() # Session of every device, by IMEI and by address.
+        self.listeners = []
+        self.engine = Engine(self)
+        self.time_format = '%Y.%m.%d %H:%M:%S.%f'
+        self.running = False
+        self.automatic_imei = None
+        self.auto_job = None
+        self.handshake_timeout = HANDSHAKE_TIMEOUT
+        self.idle_timeouts = {'TCP':IDLE_TIMEOUT, 'UDP':IDLE_TIMEOUT}
+        self.metrics = metrics or Metrics()
+        self.metrics.gauge('clients', 'Devices known to the server.', lambda: self.clients)
+        self.metrics.gauge('tcp_connections', 'Open TCP connections.', lambda: len(self.engine.connections))
+        self.metrics.gauge('udp_backlog', 'Batches of datagrams waiting to be decoded.', self.engine.udp_backlog)
+        self.logger = Logger('Server', log_file, log_writer, log_rotation)
+        self.raw_logger = None
+        self.raw_capture = None
+        if raw_format == 'capture':
+            self.raw_capture = capture.CaptureWriter(raw_log_file)
+        else:
+            self.raw_logger = Logger('RAW', raw_log_file, log_writer, log_rotation)
+        self.decode_workers = decode_workers
+        self.decode_pool = None # Created for every run of the engine.
+        self.sink = None
+        self.ack_after_durable = False
+        self.dedup = dedup.DedupIndex() # None handles every packet, even if it was received before.
+        self.metrics.gauge('decode_backlog', 'Frames waiting for a decoder process.',
+            lambda: self.decode_pool.backlog() if self.decode_pool else 0)
+        self.metrics.gauge('sink_backlog', 'Records waiting to be written by the record sink.',
+            lambda: self.sink.backlog if self.sink else 0)
+        self.scheduler = CommandScheduler(self)
+        self.new_conn.connect(self.scheduler.device_online)
+        self.logger.info(f'Server is created.')
+
+    @property
+    def clients(self):
+        return len(self.sessions)
+
+    def add_listener(self, port, trans_prot, host='0.0.0.0', name=None, rcvbuf=None, reuse_port=False):
+        listener = Listener(port, trans_prot, host, name, rcvbuf, reuse_port)
+        listener.open()
+        self.listeners.append(listener)
+        self.logger.info(f'{listener.trans_prot} socket created and binded to {listener.port} port ({listener}).')
+        if listener.trans_prot == 'UDP':
+            size = listener.receive_buffer_size()
+            self.logger.info(f'{listener} receive buffer is {size} bytes.')
+            if size < listener.rcvbuf:
+                self.logger.warning(f'{listener} receive buffer is smaller than requested {listener.rcvbuf} bytes, '
+                    f'raise net.core.rmem_max to allow it.')
+        return listener
+
+    def create_socket(self, port, trans_prot):
+        # Single listener setup used by the GUI.
+        return self.add_listener(port, trans_prot)
+
+    def log_raw(self, direction, data, peer=None, imei=None):
+        session = self.sessions.get(imei) if imei else None
+        if direction == capture.IN:
+            self.metrics.inc('bytes_received', len(data))
+            self.metrics.device(imei, bytes_received=len(data))
+            if session:
+                session.bytes_received += len(data)
+                session.last_seen = time.time()
+        else:
+            self.metrics.inc('bytes_sent', len(data))
+            self.metrics.device(imei, bytes_sent=len(data))
+            if session:
+                session.bytes_sent += len(data)
+        if self.raw_capture:
+            self.raw_capture.write(direction, data, peer, imei)
+        elif direction == capture.IN:
+            self.raw_logger.info(f'<< {data.hex()}', imei)
+        else:
+            self.raw_logger.info(f'>> {binascii.hexlify(data)}', imei)
+
+    def send(self, channel, msg, imei=None):
+        # Must be called from the engine's event loop thread.
+        if isinstance(msg, str): msg = binascii.unhexlify(msg)
+        channel.write(msg)
+        self.log_raw(capture.OUT, msg, channel.get_extra_info('peername'), imei)
+
+    def send_pending(self, session):
+        # Writes queued GPRS commands of the session. Must be called from the engine's event loop thread.
+        # Writes never block: while TCP transport's output buffer is over its high-water mark commands
+        # stay queued, they are written when the transport resumes writing (see self.resume_sending()).
+        # Returns reason why commands were dropped, None otherwise.
+        if session.protocol == 'TCP':
+            transport = session.conn
+            if transport.is_closing():
+                session.commands.clear()
+                return 'connection is closing'
+        else:
+            transport = session.listener.transport
+            if not transport:
+                session.commands.clear()
+                return f'{session.listener} is closed'
+        while session.commands:
+            if session.protocol == 'TCP':
+                if transport.get_write_buffer_size() >= transport.get_write_buffer_limits()[1]:
+                    return None
+                self.send(transport, session.commands.popleft(), session.imei)
+            else:
+                packet = session.commands.popleft()
+                transport.sendto(packet, session.conn)
+                self.log_raw(capture.OUT, packet, session.conn, session.imei)
+            self.metrics.inc('commands_sent', 1, session.protocol)
+        return None
+
+    def resume_sending(self, imei, conn):
+        # Called by the engine when output buffer of TCP connection has drained.
+        session = self.sessions.get(imei)
+        if session and session.conn is conn and session.commands:
+            self.send_pending(session)
+
+    def send_bulk(self, cmd, imeis=None, queue_offline=False):
+        """
+        Sends GPRS command to many devices at once. Command is encoded once and written to every
+        connection from the event loop in a single pass. Safe to call from any thread.
+
+            Parameters:
+                cmd (str): GPRS command.
+                imeis (iterable of str): IMEIs of the devices. Default None sends it to every client.
+                queue_offline (bool): send the command to offline devices when they connect. Default False.
+
+            Returns:
+                summary (concurrent.futures.Future): resolves to a dict with 'sent' (written to the connection),
+                'queued' (waiting for connection's output buffer to drain) and 'offline' lists of IMEIs
+                and 'failed' dict of IMEI: reason.
+        """
+        packet = parselib.encode_gprs_cmd(cmd)
+        return self.engine.submit(self.dispatch, cmd, packet, None if imeis is None else list(imeis), queue_offline)
+
+    def dispatch(self, cmd, packet, imeis=None, queue_offline=False):
+        # Queues packet for every device and writes it. Must be called from the engine's event loop thread.
+        summary = {'sent':[], 'queued':[], 'offline':[], 'failed':{}}
+        sessions = list(self.sessions) if imeis is None else []
+        for imei in imeis or ():
+            session = self.sessions.get(imei)
+            if session:
+                sessions.append(session)
+            else:
+                summary['offline'].append(imei)
+                if queue_offline:
+                    self.scheduler.schedule(imei, cmd)
+        for session in sessions:
+            if len(session.commands) >= MAX_QUEUED_COMMANDS:
+                summary['failed'][session.imei] = 'too many commands are queued'
+                continue
+            session.commands.append(packet)
+            error = self.send_pending(session)
+            if error:
+                summary['failed'][session.imei] = error
+            elif session.commands:
+                summary['queued'].append(session.imei)
+            else:
+                summary['sent'].append(session.imei)
+        msg = (f"GPRS CMD {cmd!r} sent to {len(summary['sent'])} clients, queued for {len(summary['queued'])}, "
+            f"failed for {len(summary['failed'])}, {len(summary['offline'])} are offline.")
+        self.display_info.emit(msg)
+        self.logger.info(msg)
+        for imei, reason in summary['failed'].items():
+            self.logger.error(f"Could not send GPRS CMD to {imei} - {reason}.")
+        return summary
+
+    def send_cmd(self, cmd, imei):
+        session = self.sessions.get(imei)
+        if session:
+            packet = parselib.encode_gprs_cmd(cmd)
+            try:
+                if session.protocol == 'TCP' and session.conn.is_closing():
+                    raise BrokenPipeError('connection is closing')
+                elif session.protocol == 'UDP' and not session.listener.transport:
+                    raise BrokenPipeError(f'{session.listener} is closed')
+                session.commands.append(packet)
+                self.engine.call(self.send_pending, session)
+            except BrokenPipeError as e:
+                self.display_info.emit(f"Could not send GPRS CMD - {e}.")
+                self.logger.error(f"Could not send GPRS CMD - {e}.")
+            self.display_info.emit(f"Sending GPRS CMD to {imei} - {cmd}")
+            self.logger.info(f"Sending GPRS CMD to {imei} - {cmd}")
+
+    def start_auto_sending(self, cmd, imei, period):
+        # Single automatic command used by the GUI. Any number of commands can be scheduled through self.scheduler.
+        self.stop_auto_sending()
+        self.automatic_imei = imei
+        self.auto_job = self.scheduler.schedule(imei, cmd, 0, period)
+        self.display_info.emit(f"Scheduling GPRS CMD SENDING to {imei} every {period} seconds.")
+        self.logger.info(f"Scheduling GPRS CMD SENDING to {imei} every {period} seconds.")
+
+    def stop_auto_sending(self):
+        if self.auto_job:
+            self.scheduler.cancel(self.auto_job)
+            self.auto_job = None
+            self.automatic_imei = None
+            self.display_info.emit(f"Automatic GPRS CMD SENDING stopped.")
+            self.logger.info(f"Automatic GPRS CMD SENDING stopped.")
+
+    def accept_new_connection(self, imei, conn_entity, listener, addr=None, announce=True):
+        # conn_entity is TCP transport or address and port of UDP device.
+        # If announce is False, new_conn of a new device is emitted once it is replied to (see self.send_acks()).
+        addr = addr or (conn_entity if listener.trans_prot == 'UDP' else conn_entity.get_extra_info('peername'))
+        session, created = self.sessions.add(imei, listener, conn_entity, addr)
+        if created:
+            # UDP sessions are created by the decoder thread, the timer wheel lives on the event loop.
+            self.engine.call(self.watch_idle, session)
+            if announce:
+                self.new_conn.emit(imei)
+            else:
+                session.announced = False
+        elif (session.listener, session.conn) != (listener, conn_entity):
+            # Update session with received conn_entity (UDP entity might change).
+            self.sessions.move(session, listener, conn_entity, addr)
+            self.logger.warning(f'{imei} is in the list of clients but its address and port are different.')
+            self.logger.info(f'Updating {imei} address and port to {addr} ({listener})')
+        return session
+
+    def watch_idle(self, session):
+        # Must be called from the engine's event loop thread.
+        timeout = self.idle_timeouts.get(session.protocol)
+        if timeout:
+            self.engine.wheel.schedule(timeout, self.check_idle, session)
+
+    def check_idle(self, session):
+        # Called by the engine's timer wheel. Timer isn't moved on every packet, instead it is
+        # rescheduled here if something was received since it was set.
+        if self.sessions.get(session.imei) is not session:
+            return
+        timeout = self.idle_timeouts.get(session.protocol)
+        if not timeout:
+            return
+        idle = time.time() - session.last_seen
+        if idle < timeout:
+            self.engine.wheel.schedule(timeout - idle, self.check_idle, session)
+            return
+        self.metrics.inc('idle_timeouts', 1, session.protocol)
+        self.display_info.emit(f"Nothing received from {session.imei} for {idle:.0f} seconds, closing connection.")
+        self.logger.warning(f"Nothing received from {session.imei} - {session.addr} for {idle:.0f} seconds, "
+            f"closing connection.")
+        if session.protocol == 'TCP':
+            session.conn.close()
+            # Everything else is handled automatically in self.end_communication().
+        elif self.sessions.remove(session.imei):
+            self.closed_conn.emit(session.imei)
+
+    def close(self):
+        # Engine closes listening sockets and every client connection on its own loop.
+        # UDP clients are removed when the engine stops, see self.run().
+        self.engine.stop()
+        self.running = False
+
+    def disconnect_client(self, imei):
+        session = self.sessions.get(imei)
+        if not session:
+            return
+        if session.protocol == 'TCP':
+            self.engine.call(session.conn.close)
+            # Everything else is handled automatically in self.end_communication().
+        elif session.protocol == 'UDP':
+            if self.sessions.remove(imei):
+                self.closed_conn.emit(imei)
+        if self.automatic_imei == imei:
+            self.stop_auto_sending()
+        self.display_info.emit(f"Connection with {imei} closed by user input.")
+
+    def communicate(self, listener, conn, addr, imei, data):
+        # Called by the engine for every complete frame received from TCP client.
+        # Returns IMEI of the client, None if it is not known (yet).
+        if not imei:
+            try:
+                imei = parselib.parse_imei(data)
+            except UnicodeDecodeError:
+                imei = None
+            self.log_raw(capture.IN, data, addr, imei)
+            self.logger.info(f'IMEI received from the client - {imei}')
+            if not imei:
+                self.metrics.inc('handshake_failures', 1, 'TCP')
+                conn.close()
+            else:
+                self.metrics.inc('handshakes', 1, 'TCP')
+                self.send(conn, '01', imei)
+                self.logger.info(f'Sending IMEI reply...')
+                self.accept_new_connection(imei, conn, listener, addr)
+                self.display_info.emit(f"Connected from: {addr}. IMEI: {imei}")
+                self.logger.info(f"Connected from: {addr} to {listener}. IMEI: {imei}")
+        else:
+            received = time.perf_counter()
+            self.log_raw(capture.IN, data, addr, imei)
+            decode_start = time.perf_counter()
+            packet = (datetime.now(), data)
+            recs = None
+            try:
+                pinfo, reply = parselib.parse_packet(packet)
+                # Acked packet is dropped by the device, so a corrupted one must not be acked.
+                parselib.check_crc(pinfo, data)
+                rpayload = pinfo['records']
+                data_no = pinfo['no_of_data_1']
+                codec = pinfo['codec']
+                key = self.dedup_key(pinfo)
+                duplicate = key is not None and self.dedup.is_duplicate(imei, *key)
+                if duplicate:
+                    pass
+                elif self.decode_pool:
+                    # Records are decoded by worker processes after the packet is acked.
+                    parselib.check_packet(pinfo)
+                elif codec == parselib.CODEC_8 or codec == parselib.CODEC_8E:
+                    recs = parselib.decode_record_payload(rpayload, data_no, codec)
+            except (struct.error, ValueError, IndexError):
+                self.metrics.inc('decode_errors', 1, 'TCP')
+                raise
+            if duplicate:
+                # Ack of the packet was lost and device sent it again, it has been handled already.
+                self.send(conn, reply, imei)
+                self.metrics.inc('duplicates', 1, 'TCP')
+                return imei
+            if codec == parselib.CODEC_8 or codec == parselib.CODEC_8E:
+                if recs is not None:
+                    self.metrics.observe('decode_seconds', time.perf_counter() - decode_start)
+                ack = None
+                if self.sink and self.ack_after_durable:
+                    ack = functools.partial(self.engine.call, self.send_ack, conn, reply, imei, received, key)
+                else:
+                    self.send(conn, reply, imei)
+                    self.metrics.observe('ack_latency_seconds', time.perf_counter() - received)
+                    if key:
+                        self.dedup.add(imei, *key)
+                self.metrics.inc('packets', 1, 'TCP')
+                self.metrics.inc('records', data_no, 'TCP')
+                self.metrics.device(imei, packets=1, records=data_no)
+                session = self.sessions.get(imei)
+                if session:
+                    session.packets += 1
+                    session.records += data_no
+                self.display_info.emit(f"IMEI: {imei} - {data.hex()}")
+                self.display_info.emit(f"Sending record reply: {reply.hex()}")
+                self.logger.info(f"IMEI: {imei} - {data.hex()}")
+                self.logger.info(f"Sending record reply: {reply.hex()}")
+                if self.decode_pool:
+                    self.decode_pool.submit(imei, rpayload, data_no, codec, ack)
+                else:
+                    self.store(imei, recs, ack)
+            elif codec == parselib.CODEC_12:
+                self.metrics.inc('command_responses', 1, 'TCP')
+                response = parselib.parse_gprs_cmd_response(rpayload)
+                self.display_info.emit(f"{imei} - {response}")
+                self.logger.info(f"{imei} - {response}")
+        return imei
+
+    def dedup_key(self, packet_info):
+        # Returns key of AVL packet for self.dedup, None if packet can't be deduplicated.
+        if self.dedup is None or packet_info['codec'] not in (parselib.CODEC_8, parselib.CODEC_8E):
+            return None
+        timestamp = parselib.first_record_timestamp(packet_info['records'])
+        if timestamp is None:
+            return None
+        return timestamp, packet_info['no_of_data_1'], packet_info.get('packet_id')
+
+    def send_ack(self, conn, reply, imei, received, key=None):
+        # Sends TCP ack once records of the packet are durable. Must be called from the engine's event loop thread.
+        if conn.is_closing():
+            return
+        self.send(conn, reply, imei)
+        self.metrics.observe('ack_latency_seconds', time.perf_counter() - received)
+        if key:
+            self.dedup.add(imei, *key)
+
+    def ack_datagram(self, listener, reply, addr, imei, received, key=None):
+        # Sends UDP ack once records of the datagram are durable.
+        if key:
+            self.dedup.add(imei, *key)
+        self.engine.call(self.send_acks, listener, [(reply, addr)], received)
+
+    def store(self, imei, records, ack=None):
+        # Publishes records of a single packet and stores them in the sink. ack is called once they are durable.
+        self.new_records.emit(imei, records)
+        if self.sink:
+            self.sink.put(imei, records, ack)
+        elif ack:
+            ack()
+
+    def records_decoded(self, imei, records, duration, ack):
+        # Called by the decode pool with records of a single packet, in order the packets were received.
+        self.metrics.observe('decode_seconds', duration)
+        self.store(imei, records, ack)
+
+    def decode_failed(self, imei, error, ack):
+        # Called by the decode pool for a packet which records could not be decoded. It was acked already,
+        # unless acks wait for records to be durable, then it is never acked.
+        session = self.sessions.get(imei)
+        self.metrics.inc('decode_errors', 1, session.protocol if session else None)
+        self.logger.error(f"Could not decode records of {imei} - {error}")
+
+    def end_communication(self, imei, addr, conn=None):
+        # Called by the engine when TCP connection is closed by either side.
+        if not imei:
+            self.display_info.emit(f"Couldn't establish connection with {addr}")
+            self.logger.error(f"Couldn't establish connection with {addr}")
+            return
+        self.display_info.emit(f"Connection with {imei} - {addr} closed.")
+        self.logger.info(f"Connection with {imei} - {addr} closed.")
+        # Session is kept if the device has already reconnected through another connection.
+        if self.sessions.remove(imei, conn):
+            self.closed_conn.emit(imei)
+
+    def handle_datagram(self, listener, data, addr):
+        # Called by the engine's UDP decoder thread for every datagram received by UDP listener.
+        # Returns ack of the datagram, None if it needs none or if it is sent once records are durable.
+        # Acks are written by self.send_acks().
+        received = time.perf_counter()
+        if addr[0] != ('127.0.0.1'): self.display_info.emit(f"Received UDP packet from {addr}.")
+        packet = (datetime.now(), data)
+        recs = None
+        try:
+            pinfo, reply = parselib.parse_packet(packet)
+            rpayload = pinfo['records']
+            data_no = pinfo['no_of_data_1']
+            codec = pinfo['codec']
+            imei = parselib.parse_imei(pinfo['imei'], False)
+            key = self.dedup_key(pinfo)
+            duplicate = key is not None and self.dedup.is_duplicate(imei, *key)
+            if duplicate:
+                pass
+            elif self.decode_pool:
+                # Records are decoded by worker processes, the ack is sent before they are.
+                parselib.check_packet(pinfo)
+            elif codec == parselib.CODEC_8 or codec == parselib.CODEC_8E:
+                recs = parselib.decode_record_payload(rpayload, data_no, codec)
+        except (struct.error, ValueError, IndexError):
+            self.metrics.inc('decode_errors', 1, 'UDP')
+            self.metrics.inc('bytes_received', len(data))
+            raise
+        if codec != parselib.CODEC_12:
+            # Session of a new device exists before its first datagram is logged and counted, as on TCP.
+            # Commands queued for a device that comes online are sent after the ack of its datagram,
+            # as they are after the IMEI reply of TCP devices.
+            session = self.accept_new_connection(imei, addr, listener, announce=False)
+        self.log_raw(capture.IN, data, addr, imei)
+        if duplicate:
+            # Ack of the datagram was lost and device sent it again, it has been handled already.
+            self.metrics.inc('duplicates', 1, 'UDP')
+            return reply
+        if codec != parselib.CODEC_12:
+            if recs is not None:
+                self.metrics.observe('decode_seconds', time.perf_counter() - received)
+            self.metrics.inc('packets', 1, 'UDP')
+            self.metrics.inc('records', data_no, 'UDP')
+            self.metrics.device(imei, packets=1, records=data_no)
+            session.packets += 1
+            session.records += data_no
+            session.last_seen = time.time()
+            self.display_info.emit(f"IMEI: {imei} - {data.hex()}")
+            self.display_info.emit(f"Sending record reply: {reply.hex()}")
+            self.logger.info(f"IMEI: {imei} - {data.hex()}")
+            self.logger.info(f"Sending record reply: {reply.hex()}")
+            ack = None
+            if self.sink and self.ack_after_durable:
+                ack = functools.partial(self.ack_datagram, listener, reply, addr, imei, received, key)
+                reply = None
+            elif key:
+                self.dedup.add(imei, *key)
+            if self.decode_pool:
+                self.decode_pool.submit(imei, rpayload, data_no, codec, ack)
+            elif recs is not None:
+                self.store(imei, recs, ack)
+            elif ack:
+                ack()
+            return reply
+        else:
+            self.metrics.inc('command_responses', 1, 'UDP')
+            response = parselib.parse_gprs_cmd_response(rpayload)
+            self.display_info.emit(f"{response}")
+            self.logger.info(f"{response}")
+        return None
+
+    def send_acks(self, listener, acks, received):
+        # Called by the engine on its event loop with acks of a batch of datagrams read at received
+        # (time.perf_counter()), so ack latency includes the time the batch waited for the decoder.
+        transport = listener.transport
+        if not transport:
+            return
+        for reply, addr in acks:
+            transport.sendto(reply, addr)
+            session = self.sessions.get_by_address(addr)
+            self.log_raw(capture.OUT, reply, addr, session.imei if session else None)
+            if session and not session.announced:
+                session.announced = True
+                self.new_conn.emit(session.imei)
+        latency = time.perf_counter() - received
+        for _ in acks:
+            self.metrics.observe('ack_latency_seconds', latency)
+
+    def run(self):
+        self.running = True
+        if self.sink:
+            self.sink.start(self)
+        if self.decode_workers:
+            self.decode_pool = decodepool.DecodePool(self.decode_workers, self.records_decoded, self.decode_failed)
+        self.engine.run(self.listeners)
+        self.running = False
+        # TCP clients are removed as their connections close. UDP clients have no connection to close.
+        for session in self.sessions.clear():
+            self.closed_conn.emit(session.imei)
+        self.listeners = []
+        if self.decode_pool:
+            self.decode_pool.close()
+            self.decode_pool = None
+        if self.sink:
+            self.sink.close()
+        if self.raw_capture:
+            self.raw_capture.flush()
+        self.logger.info(f"Server engine stopped - Server thread is closing")
+
+    def start(self):
+        # Runs the server in a background thread. Call run() instead to block the calling thread.
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
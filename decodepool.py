@@ -0,0 +1,155 @@
+#!/usr/bin/python3
+
+import time
+import struct
+import threading
+import multiprocessing
+import concurrent.futures
+import parselib
+
+WORKERS = 0 # Decoder processes, 0 decodes records on the network threads.
+BATCH_SIZE = 64 # Frames sent to a worker process at once.
+FLUSH_INTERVAL = 0.005 # Seconds a frame waits for its batch to fill up.
+MAX_PENDING_BATCHES = 4 # Batches in flight per worker. Frames wait in the pool while all are taken.
+
+
+def decode_frames(frames):
+    """
+    Decodes record payloads of a batch of frames. Runs in a worker process.
+
+        Parameters:
+            frames (list of tuples): (payload, no of records, codec) tuples.
+
+        Returns:
+            results (list of tuples): (records, error, decoding time) tuple for every frame.
+            records is None and error is a message if the frame could not be decoded.
+    """
+    results = []
+    for payload, no_of_records, codec in frames:
+        start = time.perf_counter()
+        try:
+            records = parselib.decode_record_payload(payload, no_of_records, codec)
+        except (struct.error, ValueError, IndexError) as e:
+            results.append((None, repr(e), time.perf_counter() - start))
+            continue
+        results.append((records, None, time.perf_counter() - start))
+    return results
+
+
+class DecodePool:
+
+    def __init__(self, workers, callback, error_callback, batch_size=BATCH_SIZE, flush_interval=FLUSH_INTERVAL,
+            max_pending=MAX_PENDING_BATCHES):
+        """
+        Initializes DecodePool object. Record payloads are decoded by a pool of worker processes, so
+        decoding doesn't hold the GIL of network threads. Frames are collected into batches and every
+        batch is pickled to a worker through a pipe at once. Frames of a device get consecutive
+        sequence numbers and results are handed over in that order no matter which worker finishes first.
+        callback and error_callback are called from the pool's result thread.
+
+            Parameters:
+                workers (int): number of worker processes.
+                callback (function): called with IMEI, list of decoded records, decoding time and context.
+                error_callback (function): called with IMEI, error message and context of a frame that failed
+                to decode.
+                batch_size (int): frames sent to a worker at once. Default BATCH_SIZE.
+                flush_interval (float): seconds a frame waits for its batch to fill up. Default FLUSH_INTERVAL.
+                max_pending (int): batches in flight per worker. Default MAX_PENDING_BATCHES.
+        """
+        self.workers = workers
+        self.callback = callback
+        self.error_callback = error_callback
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        # Workers are started from a multi-threaded process, forking it could copy held locks.
+        self.executor = concurrent.futures.ProcessPoolExecutor(workers, multiprocessing.get_context('spawn'))
+        self.in_flight = threading.Semaphore(workers * max_pending)
+        self.condition = threading.Condition()
+        self.batch = [] # (imei, seq, payload, no of records, codec, context) waiting to be sent to a worker.
+        self.assigned = {} # assigned[imei] = sequence number of the next frame.
+        self.lock = threading.Lock() # Guards results and delivered, held while results are handed over.
+        self.results = {} # results[imei] = {seq: (records, error, decoding time)} waiting for earlier frames.
+        self.delivered = {} # delivered[imei] = sequence number of the next frame to hand over.
+        self.stopping = False
+        self.thread = threading.Thread(target=self.run, name='DecodePool', daemon=True)
+        self.thread.start()
+
+    def backlog(self):
+        # Frames waiting to be sent to a worker.
+        return len(self.batch)
+
+    def submit(self, imei, payload, no_of_records, codec, context=None):
+        """
+        Queues record payload of a frame for decoding. Safe to call from any thread.
+
+            Parameters:
+                imei (str): IMEI of the device.
+                payload (bytes-like): record data, copied before it is queued.
+                no_of_records (int): number of records in payload.
+                codec (int): CODEC_8 or CODEC_8E.
+                context: passed to callback or error_callback with the result. Default None.
+        """
+        payload = bytes(payload)
+        with self.condition:
+            seq = self.assigned.get(imei, 0)
+            self.assigned[imei] = seq + 1
+            self.batch.append((imei, seq, payload, no_of_records, codec, context))
+            if len(self.batch) == 1 or len(self.batch) >= self.batch_size:
+                self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.batch and not self.stopping:
+                    self.condition.wait()
+                if not self.batch:
+                    return
+                if len(self.batch) < self.batch_size and not self.stopping:
+                    self.condition.wait(self.flush_interval)
+                batch, self.batch = self.batch[:self.batch_size], self.batch[self.batch_size:]
+            self.in_flight.acquire()
+            frames = [(payload, no_of_records, codec) for _, _, payload, no_of_records, codec, _ in batch]
+            try:
+                future = self.executor.submit(decode_frames, frames)
+            except RuntimeError as e:
+                # Pool is broken (a worker died) or shut down.
+                self.in_flight.release()
+                self.deliver(batch, [(None, repr(e), 0.0)] * len(batch))
+                continue
+            future.add_done_callback(lambda future, batch=batch: self.done(batch, future))
+
+    def done(self, batch, future):
+        self.in_flight.release()
+        try:
+            results = future.result()
+        except Exception as e:
+            results = [(None, repr(e), 0.0)] * len(batch)
+        self.deliver(batch, results)
+
+    def deliver(self, batch, results):
+        with self.lock:
+            for (imei, seq, *_, context), result in zip(batch, results):
+                self.results.setdefault(imei, {})[seq] = result + (context,)
+            for imei in {imei for imei, *_ in batch}:
+                ready = self.results[imei]
+                seq = self.delivered.get(imei, 0)
+                while seq in ready:
+                    records, error, duration, context = ready.pop(seq)
+                    if records is None:
+                        self.error_callback(imei, error, context)
+                    else:
+                        self.callback(imei, records, duration, context)
+                    seq += 1
+                self.delivered[imei] = seq
+                if not ready:
+                    del self.results[imei]
+
+    def close(self):
+        """
+        Decodes every queued frame and stops worker processes.
+        """
+        with self.condition:
+            self.stopping = True
+            self.condition.notify()
+        self.thread.join()
+        self.executor.shutdown(wait=True)
@@ -0,0 +1,78 @@
+#!/usr/bin/python3
+
+import threading
+import collections
+
+WINDOW = 32 # Packets remembered per device, 0 disables deduplication.
+MAX_DEVICES = 100000 # Devices remembered, least recently seen are forgotten first.
+
+
+class History:
+
+    __slots__ = ('high_water', 'keys', 'order')
+
+    def __init__(self):
+        self.high_water = -1 # Newest timestamp of the first record of an accepted packet.
+        self.keys = set()
+        self.order = collections.deque() # Keys oldest first.
+
+
+class DedupIndex:
+
+    def __init__(self, window=WINDOW, max_devices=MAX_DEVICES):
+        """
+        Initializes DedupIndex object which recognizes AVL packets a device sends again because their
+        ack was lost. Every accepted packet is remembered by the timestamp of its first record, number
+        of records and UDP packet id (None for TCP). Packets whose first record is newer than every
+        accepted one (the high-water mark) are new without a lookup, older ones are duplicates if their
+        key is among the last window keys of the device. Memory is bounded by window keys per device
+        and max_devices devices.
+
+            Parameters:
+                window (int): packets remembered per device. Default WINDOW.
+                max_devices (int): devices remembered. Default MAX_DEVICES.
+        """
+        self.window = window
+        self.max_devices = max_devices
+        self.lock = threading.Lock()
+        self.devices = collections.OrderedDict() # devices[imei] = History, least recently seen first
+
+    def is_duplicate(self, imei, timestamp, count, packet_id=None):
+        """
+        Checks if packet was accepted before.
+
+            Parameters:
+                imei (str): IMEI of the device.
+                timestamp (int): timestamp of the first record of the packet.
+                count (int): number of records in the packet.
+                packet_id (int): AVL packet id of UDP packet. Default None.
+
+            Returns:
+                duplicate (bool): True if the same packet was accepted recently.
+        """
+        history = self.devices.get(imei)
+        if history is None or timestamp > history.high_water:
+            return False
+        return (timestamp, count, packet_id) in history.keys
+
+    def add(self, imei, timestamp, count, packet_id=None):
+        """
+        Remembers packet that was accepted (acked).
+        """
+        key = (timestamp, count, packet_id)
+        with self.lock:
+            history = self.devices.get(imei)
+            if history is None:
+                history = self.devices[imei] = History()
+                while len(self.devices) > self.max_devices:
+                    self.devices.popitem(last=False)
+            else:
+                self.devices.move_to_end(imei)
+            if key in history.keys:
+                return
+            history.keys.add(key)
+            history.order.append(key)
+            while len(history.order) > self.window:
+                history.keys.discard(history.order.popleft())
+            if timestamp > history.high_water:
+                history.high_water = timestamp
@@ -0,0 +1,444 @@
+#!/usr/bin/python3
+
+import time
+import queue
+import struct
+import socket
+import asyncio
+import functools
+import threading
+import collections
+import concurrent.futures
+from framer import Framer, FrameError, MAX_FRAME_SIZE
+from timerwheel import TimerWheel, TICK
+
+UDP_RCVBUF = 4 << 20 # Requested receive buffer of UDP sockets, the kernel caps it at net.core.rmem_max.
+UDP_BATCH_SIZE = 64 # Datagrams read from UDP socket in one go before they are handed to the decoder.
+UDP_DATAGRAM_SIZE = 8192 # Longer datagrams are dropped.
+UDP_QUEUE_SIZE = 256 # Batches waiting for the decoder. UDP sockets aren't read while the queue is full.
+
+
+class Listener:
+
+    def __init__(self, port, trans_prot, host='0.0.0.0', name=None, rcvbuf=None, reuse_port=False):
+        """
+        Initializes Listener object which represents single listening TCP or UDP socket of the server.
+
+            Parameters:
+                port (int): port to bind to.
+                trans_prot (str): 'TCP' or 'UDP'.
+                host (str): address to bind to. Default '0.0.0.0'.
+                name (str): name used in logs. Default is protocol and port.
+                rcvbuf (int): SO_RCVBUF of UDP socket in bytes. Default UDP_RCVBUF.
+                reuse_port (bool): set SO_REUSEPORT, so processes can share the port. Default False.
+        """
+        self.port = int(port)
+        self.trans_prot = trans_prot.upper()
+        self.host = host
+        self.name = name or f'{self.trans_prot}:{self.port}'
+        self.rcvbuf = rcvbuf or UDP_RCVBUF
+        self.reuse_port = reuse_port
+        self.sock = None
+        self.transport = None # UdpReceiver of UDP listener, set while engine is running.
+
+    def __str__(self):
+        return self.name
+
+    def open(self):
+        if self.trans_prot == 'TCP':
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        elif self.trans_prot == 'UDP':
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        else:
+            raise ValueError(f'Unknown transport protocol {self.trans_prot}')
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        if self.trans_prot == 'UDP':
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.rcvbuf)
+        self.sock.bind((self.host, self.port))
+        if self.trans_prot == 'TCP':
+            self.sock.listen()
+        self.sock.setblocking(False)
+
+    def receive_buffer_size(self):
+        # Size the kernel actually uses, Linux doubles the requested value and caps it at net.core.rmem_max.
+        return self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+
+
+class TcpConnection(asyncio.BufferedProtocol):
+
+    def __init__(self, engine, listener):
+        """
+        Initializes TcpConnection object which represents single device connected to the TCP listener.
+        Splits received stream into frames and passes them to the server.
+        """
+        self.engine = engine
+        self.listener = listener
+        self.server = engine.server
+        self.closed = engine.loop.create_future()
+        self.transport = None
+        self.addr = None
+        self.imei = None
+        self.framer = Framer(engine.max_frame_size)
+        self.handshake_timer = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.addr = transport.get_extra_info('peername')
+        self.server.metrics.inc('connections', 1, 'TCP')
+        self.server.logger.info(f"Connected from {self.addr} to {self.listener}")
+        self.server.logger.info(f"Waiting for IMEI...")
+        if self.server.handshake_timeout:
+            self.handshake_timer = self.engine.wheel.schedule(self.server.handshake_timeout, self.handshake_expired)
+
+    def handshake_expired(self):
+        self.handshake_timer = None
+        if not self.imei and not self.transport.is_closing():
+            self.server.metrics.inc('handshake_timeouts', 1, 'TCP')
+            self.server.logger.error(f"No IMEI received from {self.addr} in {self.server.handshake_timeout} seconds.")
+            self.transport.close()
+
+    def get_buffer(self, sizehint):
+        return self.framer.get_buffer(sizehint)
+
+    def buffer_updated(self, nbytes):
+        self.framer.buffer_updated(nbytes)
+        try:
+            for frame in self.framer.frames():
+                self.imei = self.server.communicate(self.listener, self.transport, self.addr, self.imei, frame)
+                self.framer.handshake = not self.imei
+                if self.imei and self.handshake_timer:
+                    self.engine.wheel.cancel(self.handshake_timer)
+                    self.handshake_timer = None
+                if self.transport.is_closing():
+                    break
+        except FrameError as e:
+            self.server.logger.error(f"{e}. Closing connection with {self.addr}.")
+            self.transport.close()
+        except (struct.error, ValueError, IndexError) as e:
+            # Packet is not acked, device sends it again on its next connection.
+            self.server.logger.error(f"Could not decode packet from {self.imei} - {self.addr} - {e!r}. Closing connection.")
+            self.transport.close()
+        except Exception:
+            self.server.logger.exception(f"Error while handling packet from {self.imei} - {self.addr}. Closing connection.")
+            self.transport.close()
+
+    def pause_writing(self):
+        # Transport's output buffer is over its high-water mark, queued commands wait until it drains.
+        pass
+
+    def resume_writing(self):
+        if self.imei:
+            self.server.resume_sending(self.imei, self.transport)
+
+    def connection_lost(self, exc):
+        self.engine.connections.discard(self)
+        self.engine.wheel.cancel(self.handshake_timer)
+        self.server.end_communication(self.imei, self.addr, self.transport)
+        self.closed.set_result(None)
+
+
+class UdpReceiver:
+
+    def __init__(self, engine, listener):
+        """
+        Initializes UdpReceiver object which reads datagrams of the UDP listener straight from its socket.
+        Every time the socket becomes readable up to engine.udp_batch_size datagrams are read into
+        a preallocated buffer with recvfrom_into() and the whole batch is handed to the decoder thread
+        (UdpDecoder), so the event loop gets back to the socket before the kernel's buffer fills up.
+        It is used as listener.transport, so it implements sendto() and is_closing() of a datagram transport.
+        """
+        self.engine = engine
+        self.listener = listener
+        self.server = engine.server
+        self.sock = listener.sock
+        self.buffer = bytearray(engine.udp_datagram_size + 1) # Datagram that fills it whole is too long.
+        self.view = memoryview(self.buffer)
+        self.outgoing = collections.deque() # (data, addr) waiting for the socket to become writable.
+        self.stalled = None # Batch that didn't fit into decoder's queue, reading is paused until it does.
+        self.reading = False
+        self.closing = False
+
+    def start(self):
+        self.listener.transport = self
+        self.reading = True
+        self.engine.loop.add_reader(self.sock, self.read)
+
+    def read(self):
+        batch = []
+        size = self.engine.udp_datagram_size
+        for _ in range(self.engine.udp_batch_size):
+            try:
+                nbytes, addr = self.sock.recvfrom_into(self.buffer)
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError as e:
+                self.server.logger.error(f"{self.listener} - {e}")
+                break
+            if nbytes > size:
+                self.server.metrics.inc('decode_errors', 1, 'UDP')
+                self.server.logger.error(f"Datagram from {addr} is longer than {size} bytes, dropping it.")
+                continue
+            batch.append((bytes(self.view[:nbytes]), addr))
+        if batch:
+            self.engine.decoder.put(self, batch, time.perf_counter())
+
+    def pause(self, batch):
+        self.stalled = batch
+        self.engine.loop.remove_reader(self.sock)
+
+    def resume(self):
+        self.stalled = None
+        if self.reading:
+            self.engine.loop.add_reader(self.sock, self.read)
+
+    def sendto(self, data, addr):
+        if self.closing:
+            return
+        if self.outgoing:
+            self.outgoing.append((data, addr))
+            return
+        try:
+            self.sock.sendto(data, addr)
+        except (BlockingIOError, InterruptedError):
+            self.outgoing.append((data, addr))
+            self.engine.loop.add_writer(self.sock, self.write_outgoing)
+        except OSError as e:
+            self.server.logger.error(f"{self.listener} - {e}")
+
+    def write_outgoing(self):
+        while self.outgoing:
+            data, addr = self.outgoing[0]
+            try:
+                self.sock.sendto(data, addr)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                self.server.logger.error(f"{self.listener} - {e}")
+            self.outgoing.popleft()
+        self.engine.loop.remove_writer(self.sock)
+
+    def is_closing(self):
+        return self.closing
+
+    def stop_reading(self):
+        self.reading = False
+        self.engine.loop.remove_reader(self.sock)
+
+    def close(self):
+        self.closing = True
+        self.engine.loop.remove_reader(self.sock)
+        self.engine.loop.remove_writer(self.sock)
+        self.outgoing.clear()
+        self.listener.transport = None
+        self.sock.close()
+
+
+class UdpDecoder(threading.Thread):
+
+    def __init__(self, engine, queue_size=UDP_QUEUE_SIZE):
+        """
+        Initializes UdpDecoder object. A thread that decodes batches of datagrams read by UdpReceivers, so
+        decoding, logging and signals don't hold up reading of the sockets. Acks of a batch are handed
+        back to the event loop at once (see core.ServerCore.send_acks()). When the queue is full receivers
+        stop reading and the kernel's receive buffer takes the burst.
+        """
+        super().__init__(name='UdpDecoder', daemon=True)
+        self.engine = engine
+        self.server = engine.server
+        self.queue = queue.Queue(queue_size)
+        self.stalled = [] # Receivers waiting for free space in the queue. Only changed on the event loop.
+
+    def put(self, receiver, batch, received):
+        # Called from the event loop.
+        try:
+            self.queue.put_nowait((receiver, batch, received))
+        except queue.Full:
+            receiver.pause((batch, received))
+            self.stalled.append(receiver)
+
+    def resume_stalled(self):
+        # Called from the event loop once the decoder has taken a batch off the queue.
+        while self.stalled:
+            receiver = self.stalled[0]
+            try:
+                self.queue.put_nowait((receiver, *receiver.stalled))
+            except queue.Full:
+                return
+            self.stalled.pop(0)
+            receiver.resume()
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            if self.stalled:
+                self.engine.call(self.resume_stalled)
+            receiver, batch, received = item
+            acks = []
+            for data, addr in batch:
+                try:
+                    ack = self.server.handle_datagram(receiver.listener, data, addr)
+                except (struct.error, ValueError, IndexError) as e:
+                    self.server.logger.error(f"Could not decode datagram from {addr} - {e!r}")
+                    continue
+                except Exception:
+                    self.server.logger.exception(f"Error while handling datagram from {addr}")
+                    continue
+                if ack:
+                    acks.append((ack, addr))
+            if acks:
+                self.engine.call(self.server.send_acks, receiver.listener, acks, received)
+
+    def stop(self):
+        # Blocks until every queued batch is decoded.
+        self.queue.put(None)
+        self.join()
+
+
+class Engine:
+
+    def __init__(self, server, max_frame_size=MAX_FRAME_SIZE, tick=TICK, udp_batch_size=UDP_BATCH_SIZE,
+            udp_datagram_size=UDP_DATAGRAM_SIZE, udp_queue_size=UDP_QUEUE_SIZE):
+        """
+        Initializes Engine object. It serves every listener and every TCP connection of the server on
+        a single asyncio event loop instead of a thread per connection. Timeouts are kept on a timer wheel
+        (timerwheel.TimerWheel) advanced every tick seconds, it can only be used from the loop.
+        Datagrams of UDP listeners are read in batches on the loop and decoded in a separate thread
+        (see UdpReceiver and UdpDecoder).
+        """
+        self.server = server
+        self.max_frame_size = max_frame_size
+        self.tick = tick
+        self.udp_batch_size = udp_batch_size
+        self.udp_datagram_size = udp_datagram_size
+        self.udp_queue_size = udp_queue_size
+        self.decoder = None
+        self.wheel = None
+        self.loop = None
+        self.stopped = None
+        self.stop_requested = False # Set by stop() called before run() created the loop, taken by the next run().
+        self.stop_lock = threading.Lock()
+        self.connections = set()
+
+    def run(self, listeners):
+        """
+        Runs event loop until engine is stopped. Blocks the calling thread.
+
+            Parameters:
+                listeners (list of Listener): opened listeners to serve.
+        """
+        # Selector loop on every platform, UDP sockets are read with add_reader().
+        loop = asyncio.SelectorEventLoop()
+        asyncio.set_event_loop(loop)
+        with self.stop_lock:
+            self.loop = loop
+            self.stopped = asyncio.Event()
+            # stop() called before the loop was created only cancels this run, not the later ones.
+            if self.stop_requested:
+                self.stop_requested = False
+                self.stopped.set()
+        self.wheel = TimerWheel(self.tick)
+        try:
+            loop.run_until_complete(self.serve(listeners))
+        finally:
+            with self.stop_lock:
+                self.loop = None
+                self.stopped = None
+            loop.close()
+
+    async def serve(self, listeners):
+        servers = []
+        receivers = []
+        for listener in listeners:
+            if listener.trans_prot == 'TCP':
+                factory = functools.partial(self.create_connection, listener)
+                servers.append(await self.loop.create_server(factory, sock=listener.sock))
+            else:
+                receivers.append(UdpReceiver(self, listener))
+        if receivers:
+            self.decoder = UdpDecoder(self, self.udp_queue_size)
+            self.decoder.start()
+            for receiver in receivers:
+                receiver.start()
+        ticker = asyncio.ensure_future(self.run_timers())
+        await self.stopped.wait()
+        ticker.cancel()
+        for server in servers:
+            server.close()
+        if receivers:
+            for receiver in receivers:
+                receiver.stop_reading()
+            # Batches already read are decoded and acked before the sockets are closed.
+            await self.loop.run_in_executor(None, self.decoder.stop)
+            await asyncio.sleep(0)
+            self.decoder = None
+            for receiver in receivers:
+                receiver.close()
+        conns = list(self.connections)
+        for conn in conns:
+            conn.transport.close()
+        await asyncio.gather(*[conn.closed for conn in conns])
+        for server in servers:
+            await server.wait_closed()
+
+    async def run_timers(self):
+        while True:
+            await asyncio.sleep(self.tick)
+            self.wheel.advance()
+
+    def create_connection(self, listener):
+        conn = TcpConnection(self, listener)
+        self.connections.add(conn)
+        return conn
+
+    def call(self, callback, *args):
+        """
+        Schedules callback to be run on the event loop. Safe to call from any thread.
+        """
+        loop = self.loop
+        if loop:
+            try:
+                loop.call_soon_threadsafe(callback, *args)
+            except RuntimeError:
+                pass # Loop was closed meanwhile.
+
+    def submit(self, callback, *args):
+        """
+        Schedules callback to be run on the event loop. Safe to call from any thread.
+
+            Returns:
+                future (concurrent.futures.Future): result of the callback.
+        """
+        future = concurrent.futures.Future()
+
+        def run():
+            if not future.set_running_or_notify_cancel():
+                return
+            try:
+                future.set_result(callback(*args))
+            except Exception as e:
+                future.set_exception(e)
+
+        if self.loop:
+            self.loop.call_soon_threadsafe(run)
+        else:
+            future.set_exception(RuntimeError('Engine is not running'))
+        return future
+
+    def udp_backlog(self):
+        # Batches of datagrams waiting for the decoder.
+        decoder = self.decoder
+        return decoder.queue.qsize() if decoder else 0
+
+    def stop(self):
+        """
+        Stops the engine. Safe to call from any thread, also before run(), which then returns at once.
+        """
+        with self.stop_lock:
+            if self.stopped is None:
+                self.stop_requested = True
+            else:
+                self.call(self.stopped.set)
@@ -0,0 +1,55 @@
+#!/usr/bin/python3
+
+import time
+import collections
+
+BUFFER_SIZE = 10000
+
+
+class EventBuffer:
+
+    def __init__(self, maxlen=BUFFER_SIZE):
+        """
+        Initializes EventBuffer object. A bounded ring buffer of (time, message) events which server
+        threads push to and the view drains at its own pace. When it is full, oldest events are dropped.
+        deque append and popleft are atomic, so no lock is taken on the server side.
+
+            Parameters:
+                maxlen (int): maximum number of events kept. Default BUFFER_SIZE.
+        """
+        self.maxlen = maxlen
+        self.events = collections.deque(maxlen=maxlen)
+        self.dropped = 0 # Approximate, it is not guarded by a lock.
+
+    def __len__(self):
+        return len(self.events)
+
+    def push(self, msg):
+        """
+        Adds event to the buffer. Safe to call from any thread.
+
+            Parameters:
+                msg (str): message of the event.
+        """
+        if len(self.events) == self.maxlen:
+            self.dropped += 1
+        self.events.append((time.time(), msg))
+
+    def drain(self, limit=None):
+        """
+        Removes every event from the buffer and returns the newest of them.
+
+            Parameters:
+                limit (int): maximum number of events returned. Older events are skipped. Default None.
+
+            Returns:
+                events (list of tuples): (time, message) tuples, oldest first.
+                dropped (int): number of events that were dropped or skipped since the last drain.
+        """
+        count = len(self.events)
+        skip = count - limit if limit is not None and count > limit else 0
+        for _ in range(skip):
+            self.events.popleft()
+        events = [self.events.popleft() for _ in range(count - skip)]
+        dropped, self.dropped = self.dropped + skip, 0
+        return events, dropped
@@ -0,0 +1,119 @@
+#!/usr/bin/python3
+
+MAX_FRAME_SIZE = 65536
+MIN_READ_SIZE = 4096
+
+
+class FrameError(ValueError):
+    pass
+
+
+class Framer:
+
+    IMEI_MSG_HEADER = 2
+    TCP_MSG_HEADER = 8
+    TCP_MSG_TRAILER = 4
+
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE, read_size=MIN_READ_SIZE):
+        """
+        Initializes Framer object which cuts a TCP byte stream into IMEI and AVL frames.
+        Data is received straight into a reusable bytearray (recv_into), so there is no per read
+        allocation. Bytes left after the last complete frame are kept for the next read.
+        Buffer is compacted when it runs out of space and grows only if a single frame does not fit.
+
+            Parameters:
+                max_frame_size (int): frames declaring bigger length raise FrameError.
+                read_size (int): minimum free space offered for a single read.
+        """
+        self.max_frame_size = max_frame_size
+        self.read_size = read_size
+        self.buffer = bytearray(read_size * 2)
+        self.view = None
+        self.start = 0
+        self.end = 0
+        self.handshake = True # IMEI frame is expected until handshake is done.
+
+    def __len__(self):
+        return self.end - self.start
+
+    def get_buffer(self, sizehint=-1):
+        """
+        Returns writable view of free space at the end of the buffer. Used by asyncio.BufferedProtocol.
+
+            Parameters:
+                sizehint (int): preferred size of the free space. Ignored if smaller than read_size.
+
+            Returns:
+                view (memoryview): free part of the buffer.
+        """
+        needed = max(sizehint, self.read_size)
+        if len(self.buffer) - self.end < needed:
+            if self.view is not None:
+                self.view.release()
+            pending = self.end - self.start
+            if self.start:
+                self.buffer[:pending] = self.buffer[self.start:self.end]
+                self.start, self.end = 0, pending
+            if len(self.buffer) - self.end < needed:
+                self.buffer.extend(bytes(max(needed, len(self.buffer))))
+        self.view = memoryview(self.buffer)
+        return self.view[self.end:]
+
+    def buffer_updated(self, nbytes):
+        """
+        Marks nbytes written into the view returned by get_buffer as received.
+        """
+        self.end += nbytes
+
+    def recv_into(self, sock):
+        """
+        Receives data from blocking socket into the buffer.
+
+            Parameters:
+                sock (socket): socket to read from.
+
+            Returns:
+                nbytes (int): number of bytes received. 0 means connection was closed.
+        """
+        nbytes = sock.recv_into(self.get_buffer())
+        self.buffer_updated(nbytes)
+        return nbytes
+
+    def frame_length(self):
+        """
+        Reads length of the next frame from its header.
+
+            Returns:
+                length (int): full length of the next frame, 0 if header is not received yet.
+        """
+        pending = self.end - self.start
+        if self.handshake:
+            if pending < self.IMEI_MSG_HEADER:
+                return 0
+            data_len = int.from_bytes(self.buffer[self.start:self.start + self.IMEI_MSG_HEADER], 'big')
+            length = data_len + self.IMEI_MSG_HEADER
+        else:
+            if pending < self.TCP_MSG_HEADER:
+                return 0
+            data_len = int.from_bytes(self.buffer[self.start + 4:self.start + self.TCP_MSG_HEADER], 'big')
+            length = data_len + self.TCP_MSG_HEADER + self.TCP_MSG_TRAILER
+        if length > self.max_frame_size:
+            raise FrameError(f'Frame length {length} exceeds the limit of {self.max_frame_size} bytes')
+        return length
+
+    def frames(self):
+        """
+        Yields every complete frame in the buffer. handshake may be changed between frames.
+
+            Returns:
+                frame (bytes): complete IMEI or AVL frame.
+        """
+        while True:
+            length = self.frame_length()
+            if not length or self.end - self.start < length:
+                break
+            frame = bytes(self.buffer[self.start:self.start + length])
+            self.start += length
+            if self.start == self.end:
+                self.start = self.end = 0
+            yield frame
@@ -0,0 +1,324 @@
+#!/usr/bin/python3
+
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import resource
+import parselib
+import tempfile
+import subprocess
+from datetime import datetime, timezone
+
+FIRST_IMEI = 350000000000000
+ACK_TIMEOUT = 5.0
+
+
+class Stats:
+
+    def __init__(self):
+        """
+        Initializes Stats object which collects results of all simulated devices.
+        """
+        self.connected = 0
+        self.connect_failed = 0
+        self.setup_times = []
+        self.first_connect = None
+        self.last_connect = None
+        self.sent = 0
+        self.records = 0
+        self.acked = 0
+        self.bad_acks = 0
+        self.timeouts = 0
+        self.latencies = []
+        self.bytes_sent = 0
+
+    def connect_started(self):
+        started = time.perf_counter()
+        if self.first_connect is None:
+            self.first_connect = started
+        return started
+
+    def connect_finished(self, started):
+        self.last_connect = time.perf_counter()
+        self.connected += 1
+        self.setup_times.append(self.last_connect - started)
+
+    def report(self, duration, server_usage=None):
+        """
+        Summarizes collected results.
+
+            Parameters:
+                duration (float): length of the measured period in seconds.
+                server_usage (dict): CPU and memory use of the server process. Default None.
+
+            Returns:
+                report (dict): summary of the run.
+        """
+        report = {'duration':round(duration, 3), 'connected':self.connected, 'connect_failed':self.connect_failed,
+            'connects_per_s':round(self.connected / max(self.last_connect - self.first_connect, 1e-9), 1)
+                if self.connected else 0,
+            'setup_p50_ms':percentile(self.setup_times, 50) * 1000,
+            'setup_p99_ms':percentile(self.setup_times, 99) * 1000,
+            'packets_sent':self.sent, 'packets_acked':self.acked, 'bad_acks':self.bad_acks,
+            'timeouts':self.timeouts, 'packets_per_s':round(self.acked / duration, 1),
+            'records_per_s':round(self.records / duration, 1), 'mbit_per_s':round(self.bytes_sent * 8 / duration / 1e6, 3),
+            'ack_p50_ms':percentile(self.latencies, 50) * 1000, 'ack_p99_ms':percentile(self.latencies, 99) * 1000}
+        if server_usage:
+            report.update(server_usage)
+        return report
+
+
+def percentile(values, p):
+    """
+    Returns p-th percentile (nearest rank) of values, 0 if there are none.
+    """
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, round(p / 100 * len(values) + 0.5) - 1))]
+
+
+class DeviceProfile:
+
+    def __init__(self, codec=parselib.CODEC_8, records=1, io_elements=5):
+        """
+        Initializes DeviceProfile object which describes packets a simulated device sends.
+
+            Parameters:
+                codec (int): CODEC_8 or CODEC_8E. Default CODEC_8.
+                records (int): records in every packet. Default 1.
+                io_elements (int): IO elements in every record. Default 5.
+        """
+        self.codec = codec
+        self.records = records
+        self.io = {avl_id: random.randrange(0, 2 ** (8 * random.choice((1, 2, 4, 8))))
+            for avl_id in range(1, io_elements + 1)}
+
+    def packet(self, protocol, imei, packet_id=0):
+        now = datetime.now(timezone.utc)
+        gps_data = {'longitude':25.28, 'latitude':54.68, 'altitude':112, 'angle':180, 'satellites':9, 'speed':42}
+        records = [parselib.build_record(now, gps_data, self.io, 0, 1, self.codec) for _ in range(self.records)]
+        return parselib.build_avl_packet(records, self.codec, protocol, imei, packet_id)
+
+
+async def tcp_device(imei, args, profile, stats, stop):
+    started = stats.connect_started()
+    try:
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(args.host, args.port), ACK_TIMEOUT)
+        writer.write(parselib.build_imei_packet(imei))
+        if await asyncio.wait_for(reader.readexactly(1), ACK_TIMEOUT) != b'\x01':
+            raise ConnectionError('IMEI was not accepted')
+    except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+        stats.connect_failed += 1
+        return
+    stats.connect_finished(started)
+    await asyncio.sleep(random.random() / args.rate)
+    try:
+        while not stop.is_set():
+            packet = profile.packet('TCP', imei)
+            expected = parselib.build_record_reply('TCP', profile.records)
+            sent = time.perf_counter()
+            writer.write(packet)
+            stats.sent += 1
+            stats.bytes_sent += len(packet)
+            try:
+                ack = await asyncio.wait_for(reader.readexactly(len(expected)), ACK_TIMEOUT)
+            except asyncio.TimeoutError:
+                stats.timeouts += 1
+                break
+            stats.latencies.append(time.perf_counter() - sent)
+            if ack == expected:
+                stats.acked += 1
+                stats.records += profile.records
+            else:
+                stats.bad_acks += 1
+            await asyncio.sleep(max(0, 1 / args.rate - (time.perf_counter() - sent)))
+    except (OSError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+
+class UdpDevice(asyncio.DatagramProtocol):
+
+    def __init__(self):
+        self.acks = asyncio.Queue()
+
+    def datagram_received(self, data, addr):
+        self.acks.put_nowait(data)
+
+
+async def udp_device(imei, args, profile, stats, stop):
+    loop = asyncio.get_running_loop()
+    started = stats.connect_started()
+    try:
+        transport, device = await loop.create_datagram_endpoint(UdpDevice, remote_addr=(args.host, args.port))
+    except OSError:
+        stats.connect_failed += 1
+        return
+    stats.connect_finished(started)
+    await asyncio.sleep(random.random() / args.rate)
+    packet_id = 0
+    try:
+        while not stop.is_set():
+            packet_id = (packet_id + 1) % 256
+            packet = profile.packet('UDP', imei, packet_id)
+            expected = parselib.build_record_reply('UDP', profile.records, packet_id)
+            sent = time.perf_counter()
+            transport.sendto(packet)
+            stats.sent += 1
+            stats.bytes_sent += len(packet)
+            try:
+                ack = await asyncio.wait_for(device.acks.get(), ACK_TIMEOUT)
+            except asyncio.TimeoutError:
+                stats.timeouts += 1
+                continue
+            stats.latencies.append(time.perf_counter() - sent)
+            if ack == expected:
+                stats.acked += 1
+                stats.records += profile.records
+            else:
+                stats.bad_acks += 1
+            await asyncio.sleep(max(0, 1 / args.rate - (time.perf_counter() - sent)))
+    finally:
+        transport.close()
+
+
+async def run_fleet(args, stats):
+    stop = asyncio.Event()
+    device = tcp_device if args.protocol == 'TCP' else udp_device
+    codec = parselib.CODEC_8E if args.codec == '8e' else parselib.CODEC_8
+    tasks = []
+    for i in range(args.devices):
+        profile = DeviceProfile(codec, args.records, args.io)
+        tasks.append(asyncio.create_task(device(str(FIRST_IMEI + i), args, profile, stats, stop)))
+        if args.connect_rate:
+            await asyncio.sleep(1 / args.connect_rate)
+    started = time.perf_counter()
+    await asyncio.sleep(args.duration)
+    stop.set()
+    await asyncio.gather(*tasks)
+    return time.perf_counter() - started
+
+
+class ProcessUsage:
+
+    def __init__(self, pid):
+        """
+        Initializes ProcessUsage object which measures CPU time and memory of a process through /proc (Linux only).
+        """
+        self.pid = pid
+        self.ticks = os.sysconf('SC_CLK_TCK')
+        self.start_cpu = self.cpu_time()
+        self.start_time = time.perf_counter()
+        self.peak_rss = self.rss()
+
+    def cpu_time(self):
+        with open(f'/proc/{self.pid}/stat', 'r') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / self.ticks
+
+    def rss(self):
+        with open(f'/proc/{self.pid}/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+        return 0.0
+
+    async def sample(self, interval=0.5):
+        while True:
+            self.peak_rss = max(self.peak_rss, self.rss())
+            await asyncio.sleep(interval)
+
+    def result(self):
+        elapsed = time.perf_counter() - self.start_time
+        cpu = self.cpu_time() - self.start_cpu
+        return {'server_cpu_s':round(cpu, 3), 'server_cpu_percent':round(cpu / elapsed * 100, 1),
+            'server_rss_mb':round(self.rss(), 1), 'server_peak_rss_mb':round(self.peak_rss, 1)}
+
+
+async def measure(args, stats, pid):
+    usage = ProcessUsage(pid) if pid else None
+    sampler = asyncio.create_task(usage.sample()) if usage else None
+    duration = await run_fleet(args, stats)
+    if sampler:
+        sampler.cancel()
+    return duration, usage.result() if usage else None
+
+def spawn_server(args):
+    """
+    Starts headless server (cli.py) to be tested in a subprocess.
+    """
+    cmd = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cli.py'),
+        '-p', str(args.port), '-t', args.protocol, '--log-file', args.server_log, '--raw-log-file', args.server_raw_log]
+    cmd.extend(args.server_args)
+    server = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    time.sleep(1.0)
+    if server.poll() is not None:
+        raise RuntimeError(f'Server exited with code {server.returncode}: {" ".join(cmd)}')
+    return server
+
+def raise_fd_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Simulates a fleet of Teltonika devices and measures server performance.')
+    parser.add_argument('-n', '--devices', type=int, default=100, help='number of simulated devices')
+    parser.add_argument('-t', '--protocol', choices=['TCP', 'UDP'], default='TCP', type=str.upper)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('-p', '--port', type=int, default=5027)
+    parser.add_argument('-r', '--rate', type=float, default=1.0, help='packets per second sent by every device')
+    parser.add_argument('--records', type=int, default=1, help='records in every packet')
+    parser.add_argument('--io', type=int, default=5, help='IO elements in every record')
+    parser.add_argument('--codec', choices=['8', '8e'], default='8', type=str.lower)
+    parser.add_argument('-d', '--duration', type=float, default=10.0, help='seconds to send packets for')
+    parser.add_argument('--connect-rate', type=float, default=0, help='new devices per second, unlimited by default')
+    parser.add_argument('--spawn', action='store_true', help='start headless server (cli.py) for the test')
+    parser.add_argument('--server-log', default=os.devnull, help='application log of spawned server')
+    parser.add_argument('--server-args', nargs=argparse.REMAINDER, default=[],
+        help='extra options passed to spawned server, must be last')
+    parser.add_argument('--server-raw-log', help='raw data log of spawned server, temporary file removed after the test by default')
+    parser.add_argument('--server-pid', type=int, help='pid of already running server to measure CPU and memory of')
+    parser.add_argument('--json', help='write report to this file as well')
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    raise_fd_limit()
+    raw_dir = None
+    if args.spawn and args.server_raw_log is None:
+        raw_dir = tempfile.TemporaryDirectory(prefix='loadtest-')
+        args.server_raw_log = os.path.join(raw_dir.name, 'raw.log')
+    try:
+        server = spawn_server(args) if args.spawn else None
+        pid = server.pid if server else args.server_pid
+        stats = Stats()
+        try:
+            duration, usage = asyncio.run(measure(args, stats, pid))
+        finally:
+            if server:
+                server.terminate()
+                server.wait()
+    finally:
+        if raw_dir:
+            raw_dir.cleanup()
+    report = stats.report(duration, usage)
+    report['config'] = {'devices':args.devices, 'protocol':args.protocol, 'rate':args.rate, 'records':args.records,
+        'io':args.io, 'codec':args.codec}
+    for key, value in report.items():
+        if key != 'config':
+            print(f'{key:>20}: {round(value, 3) if isinstance(value, float) else value}')
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+    return report
+
+
+if __name__ == '__main__':
+    main()
@@ -1,35 +1,459 @@
 #!usr/bin/python3
 
+import os
+import re
+import sys
+import gzip
+import json
+import time
+import queue
+import atexit
+import shutil
 import logging
+import threading
+
+FLUSH_INTERVAL = 0.5
+BUFFER_SIZE = 10000
+OVERFLOW_BLOCK = 'block'
+OVERFLOW_DROP_NEW = 'drop_new'
+OVERFLOW_DROP_OLDEST = 'drop_oldest'
+OVERFLOW_POLICIES = (OVERFLOW_BLOCK, OVERFLOW_DROP_NEW, OVERFLOW_DROP_OLDEST)
+MAX_BYTES = 0 # Size of log file segment in bytes, 0 disables rotation by size.
+INTERVAL = 0 # Seconds a log file segment covers, 0 disables rotation by time.
+BACKUP_COUNT = 0 # Rotated segments kept, 0 keeps all of them.
+MAX_AGE = 0 # Seconds rotated segments are kept for, 0 keeps them forever.
+SEGMENT_HEADER = '#segment ' # First line of a rotated segment, followed by JSON.
+SEGMENT_TIME_FORMAT = '%Y%m%d-%H%M%S' # UTC time of the first record in segment file names.
+
+
+class LogWriter(threading.Thread):
+
+    def __init__(self, flush_interval=FLUSH_INTERVAL, buffer_size=BUFFER_SIZE, overflow=OVERFLOW_DROP_OLDEST):
+        """
+        Initializes LogWriter object. A single background thread that formats and writes records
+        enqueued by queued Logger objects. Records are written in batches, each handler is flushed once per batch.
+
+            Parameters:
+                flush_interval (float): maximum time in seconds a record waits in the queue. Default FLUSH_INTERVAL.
+                buffer_size (int): maximum number of records waiting in the queue. Default BUFFER_SIZE.
+                overflow (str): what to do when the queue is full. 'block' waits for free space,
+                'drop_new' drops the new record, 'drop_oldest' drops the oldest queued record.
+                Default 'drop_oldest'.
+        """
+        super().__init__(name='LogWriter', daemon=True)
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f'Unknown overflow policy {overflow}')
+        self.flush_interval = flush_interval
+        self.buffer_size = buffer_size
+        self.overflow = overflow
+        self.queue = queue.Queue(buffer_size)
+        self.dropped = 0
+        self.stopping = False
+        self.exc_formatter = logging.Formatter()
+
+    def put(self, handlers, record):
+        """
+        Enqueues record to be written by handlers. Called from the thread that logs.
+        """
+        if record.exc_info:
+            # Traceback has to be formatted now, frames it refers to will be gone later.
+            record.exc_text = self.exc_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        item = (handlers, record)
+        if self.overflow == OVERFLOW_BLOCK:
+            self.queue.put(item)
+            return
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            self.dropped += 1
+            if self.overflow == OVERFLOW_DROP_OLDEST:
+                try:
+                    self.queue.get_nowait()
+                    self.queue.put_nowait(item)
+                except (queue.Empty, queue.Full):
+                    pass
+
+    def run(self):
+        while not (self.stopping and self.queue.empty()):
+            try:
+                batch = [self.queue.get(timeout=self.flush_interval)]
+            except queue.Empty:
+                continue
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.buffer_size:
+                timeout = deadline - time.monotonic()
+                try:
+                    if timeout <= 0 or self.stopping:
+                        batch.append(self.queue.get_nowait())
+                    else:
+                        batch.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            self.write(batch)
+
+    def write(self, batch):
+        chunks = {}
+        for handlers, record in batch:
+            for handler in handlers:
+                if record.levelno >= handler.level:
+                    lines, records = chunks.setdefault(handler, ([], []))
+                    lines.append(handler.format(record) + handler.terminator)
+                    records.append(record)
+        if self.dropped:
+            dropped, self.dropped = self.dropped, 0
+            msg = f'{dropped} log records were dropped, log queue is full.'
+            for handler in chunks:
+                chunks[handler][0].append(msg + handler.terminator)
+        for handler, (lines, records) in chunks.items():
+            with handler.lock:
+                try:
+                    if isinstance(handler, SegmentedFileHandler):
+                        handler.write_batch(lines, records)
+                    else:
+                        handler.stream.write(''.join(lines))
+                        handler.stream.flush()
+                except Exception:
+                    handler.handleError(batch[-1][1])
+
+    def stop(self):
+        """
+        Writes every queued record and stops the thread.
+        """
+        self.stopping = True
+        if self.is_alive():
+            self.join()
+
+
+def segment_pattern(path):
+    """
+    Returns regex matching file names of rotated segments of log file path (without directory).
+    """
+    stem, ext = os.path.splitext(os.path.basename(path))
+    return re.compile(rf'^{re.escape(stem)}\.(\d{{8}}-\d{{6}})(?:-(\d+))?{re.escape(ext)}(?:\.gz)?$')
+
+def list_segments(path):
+    """
+    Finds rotated segments of log file path.
+
+        Returns:
+            segments (list of str): paths of segments, oldest first.
+    """
+    directory = os.path.dirname(path) or '.'
+    pattern = segment_pattern(path)
+    segments = []
+    for name in os.listdir(directory):
+        m = pattern.match(name)
+        if m:
+            segments.append(((m.group(1), int(m.group(2) or 0)), os.path.join(os.path.dirname(path), name)))
+    return [segment for _, segment in sorted(segments)]
+
+def open_segment(path):
+    """
+    Opens log file or rotated segment, compressed (.gz) or not, for reading text.
+    """
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', encoding='utf-8', errors='replace')
+    return open(path, 'r', encoding='utf-8', errors='replace')
+
+def read_segment_header(path):
+    """
+    Reads header of a rotated segment.
+
+        Returns:
+            header (dict): 'first' and 'last' (time of the first and the last record, seconds since epoch),
+            'lines' and 'imeis' (sorted list of IMEIs seen). Values are None if they are not known,
+            header is None if the file has none (e.g. the log file currently written).
+    """
+    with open_segment(path) as f:
+        line = f.readline()
+    if not line.startswith(SEGMENT_HEADER):
+        return None
+    return json.loads(line[len(SEGMENT_HEADER):])
+
+def segment_matches(header, start=None, end=None, imei=None):
+    """
+    Checks if segment may hold records within time window and/or of a single device.
+
+        Parameters:
+            header (dict): result of read_segment_header().
+            start (float): seconds since epoch. Default None.
+            end (float): seconds since epoch. Default None.
+            imei (str): IMEI. Default None.
+
+        Returns:
+            matches (bool): False only if the header shows that the segment can be skipped.
+    """
+    if header is None:
+        return True
+    if start is not None and header.get('last') is not None and header['last'] < start:
+        return False
+    if end is not None and header.get('first') is not None and header['first'] > end:
+        return False
+    if imei is not None and header.get('imeis') is not None and imei not in header['imeis']:
+        return False
+    return True
+
+def archive_segment(path, header, compress=True):
+    """
+    Rewrites rotated segment with its header line first, gzip compressed if compress is True
+    (path + '.gz', path is removed).
+    """
+    target = path + '.gz' if compress else path
+    temp = target + '.tmp'
+    with open(path, 'rb') as src, (gzip.open(temp, 'wb') if compress else open(temp, 'wb')) as dst:
+        dst.write(f'{SEGMENT_HEADER}{json.dumps(header, separators=(",", ":"))}\n'.encode('utf-8'))
+        shutil.copyfileobj(src, dst, 1 << 20)
+    os.replace(temp, target)
+    if compress:
+        os.remove(path)
+    return target
+
+
+class SegmentArchiver(threading.Thread):
+
+    def __init__(self, path, backup_count=BACKUP_COUNT, max_age=MAX_AGE, compress=True):
+        """
+        Initializes SegmentArchiver object. A background thread that adds headers to rotated segments
+        of log file path, compresses them and removes segments that are past retention.
+        """
+        super().__init__(name='SegmentArchiver', daemon=True)
+        self.path = path
+        self.backup_count = backup_count
+        self.max_age = max_age
+        self.compress = compress
+        self.queue = queue.Queue()
+
+    def put(self, segment, header):
+        self.queue.put((segment, header))
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            try:
+                archive_segment(*item, self.compress)
+                self.expire()
+            except OSError as e:
+                print(f'Could not archive log segment {item[0]} - {e}', file=sys.stderr)
+
+    def recover(self):
+        # Queues segments that were rotated but not archived before the previous run ended,
+        # they get a header with unknown values.
+        for segment in list_segments(self.path):
+            if segment.endswith('.gz') or segment.endswith('.tmp'):
+                continue
+            try:
+                if read_segment_header(segment) is None:
+                    self.put(segment, {'first':None, 'last':None, 'lines':None, 'imeis':None})
+            except (OSError, ValueError):
+                continue
+
+    def expire(self):
+        segments = [s for s in list_segments(self.path) if self.compress == s.endswith('.gz')]
+        expired = set()
+        if self.backup_count and len(segments) > self.backup_count:
+            expired.update(segments[:len(segments) - self.backup_count])
+        if self.max_age:
+            deadline = time.time() - self.max_age
+            expired.update(s for s in segments if os.path.getmtime(s) < deadline)
+        for segment in expired:
+            os.remove(segment)
+
+    def stop(self):
+        """
+        Archives every rotated segment and stops the thread.
+        """
+        self.queue.put(None)
+        if self.is_alive():
+            self.join()
+
+
+class SegmentedFileHandler(logging.FileHandler):
+
+    def __init__(self, filename, max_bytes=MAX_BYTES, interval=INTERVAL, backup_count=BACKUP_COUNT, max_age=MAX_AGE,
+            compress=True, imeis=True):
+        """
+        Initializes SegmentedFileHandler object. It writes to filename until the segment is max_bytes
+        long or interval seconds have passed (aligned to multiples of interval since epoch, so a day is
+        midnight to midnight UTC). Log is written in UTF-8 and its size is counted in encoded bytes.
+        Filled segment is renamed to <stem>.<UTC time of first record><ext> and
+        a background thread (SegmentArchiver) prepends a header (see read_segment_header()), compresses it
+        and applies retention, so writing never waits for compression. Parsers can use the header to skip
+        segments outside the time window or IMEI they look for. IMEI of a record is taken from its imei
+        attribute, see Logger.info(). If records are not all tagged with IMEI (imeis is False), IMEIs
+        of the header are None, so no segment of the log is skipped by IMEI.
+
+            Parameters:
+                filename (str): log file.
+                max_bytes (int): size of a segment, 0 disables rotation by size. Default MAX_BYTES.
+                interval (float): seconds a segment covers, 0 disables rotation by time. Default INTERVAL.
+                backup_count (int): rotated segments kept, 0 keeps all. Default BACKUP_COUNT.
+                max_age (float): seconds rotated segments are kept for, 0 keeps them forever. Default MAX_AGE.
+                compress (bool): gzip rotated segments. Default True.
+                imeis (bool): every record about a device is tagged with its IMEI. Default True.
+        """
+        super().__init__(filename, encoding='utf-8')
+        self.max_bytes = max_bytes
+        self.interval = interval
+        self.track_imeis = imeis
+        self.archiver = SegmentArchiver(self.baseFilename, backup_count, max_age, compress)
+        self.size = self.stream.tell()
+        # Records written by a previous run are not known, header of this segment says so.
+        self.known = self.size == 0
+        self.first = self.last = None
+        self.lines = 0
+        self.imeis = set()
+        self.rotate_at = self.next_rotation(time.time())
+
+    def next_rotation(self, now):
+        if not self.interval:
+            return None
+        return (now // self.interval + 1) * self.interval
+
+    def emit(self, record):
+        try:
+            self.write_batch([self.format(record) + self.terminator], [record])
+        except Exception:
+            self.handleError(record)
+
+    def write_batch(self, lines, records):
+        """
+        Writes formatted records, rotating the segment before the record that would overfill it or
+        falls after its interval, so a batch can span segments. Called with the handler's lock held.
+
+            Parameters:
+                lines (list of str): formatted records, lines[i] is records[i]. Lines past the end of
+                    records (notices of the writer) have no record and use the current time.
+                records (list of logging.LogRecord): records of the lines.
+        """
+        pending = []
+        for i, line in enumerate(lines):
+            record = records[i] if i < len(records) else None
+            now = record.created if record else time.time()
+            size = len(line) if line.isascii() else len(line.encode(self.encoding, 'replace'))
+            if self.size and ((self.max_bytes and self.size + size > self.max_bytes)
+                    or (self.rotate_at and now >= self.rotate_at)):
+                # Lines of the full segment are written out before it is renamed.
+                self.stream.write(''.join(pending))
+                pending = []
+                self.rotate(now)
+            elif self.rotate_at and now >= self.rotate_at:
+                self.rotate_at = self.next_rotation(now)
+            pending.append(line)
+            self.size += size
+            if record is None:
+                continue
+            if self.first is None:
+                self.first = record.created
+            self.last = record.created
+            imei = getattr(record, 'imei', None)
+            if imei:
+                self.imeis.add(imei)
+            self.lines += 1
+        self.stream.write(''.join(pending))
+        self.stream.flush()
+
+    def rotate(self, now):
+        self.stream.close()
+        base, ext = os.path.splitext(self.baseFilename)
+        started = self.first if self.first is not None else os.path.getmtime(self.baseFilename)
+        segment = f'{base}.{time.strftime(SEGMENT_TIME_FORMAT, time.gmtime(started))}{ext}'
+        n = 1
+        while os.path.exists(segment) or os.path.exists(segment + '.gz'):
+            segment = f'{base}.{time.strftime(SEGMENT_TIME_FORMAT, time.gmtime(started))}-{n}{ext}'
+            n += 1
+        if not self.archiver.is_alive():
+            # Started on first rotation, so a process that forks after creating its logger has no extra thread.
+            self.archiver.recover()
+            self.archiver.start()
+        os.rename(self.baseFilename, segment)
+        if self.known:
+            header = {'first':self.first, 'last':self.last, 'lines':self.lines,
+                'imeis':sorted(self.imeis) if self.track_imeis else None}
+        else:
+            header = {'first':None, 'last':self.last, 'lines':None, 'imeis':None}
+        self.archiver.put(segment, header)
+        self.stream = self._open()
+        self.size = 0
+        self.known = True
+        self.first = self.last = None
+        self.lines = 0
+        self.imeis = set()
+        self.rotate_at = self.next_rotation(now)
+
+    def close(self):
+        super().close()
+        if self.archiver.is_alive():
+            self.archiver.stop()
+
+
+class RawFormatter(logging.Formatter):
+
+    def format(self, record):
+        # IMEI of the frame is appended when it is known, so frames of concurrent connections can be told apart.
+        line = super().format(record)
+        imei = getattr(record, 'imei', None)
+        return f'{line} IMEI: {imei}' if imei else line
+
+
+class QueuedHandler(logging.Handler):
+
+    def __init__(self, writer, handlers):
+        """
+        Initializes QueuedHandler object. It only passes records to LogWriter, handlers are used by the writer.
+        """
+        super().__init__()
+        self.writer = writer
+        self.handlers = handlers
+
+    def emit(self, record):
+        self.writer.put(self.handlers, record)
 
 
 class Logger:
-    def __init__(self, logger_name, log_file='application_events.log'):
+    def __init__(self, logger_name, log_file='application_events.log', writer=None, rotation=None):
         """
         Initializes Logger object used to log various events happening during the execution of the application.
+        If writer (LogWriter) is supplied, records are only enqueued by the calling thread and are
+        formatted and written by the writer thread. If rotation (dict of SegmentedFileHandler arguments
+        max_bytes, interval, backup_count, max_age and compress) is supplied, log file is rotated.
         """
         self.logger_name = logger_name
         self.log_file = log_file
-        self.file_handler = logging.FileHandler(self.log_file)
+        if rotation:
+            # Only the raw log tags every frame with IMEI, see ServerCore.log_raw().
+            self.file_handler = SegmentedFileHandler(self.log_file, imeis=self.logger_name == 'RAW', **rotation)
+        else:
+            self.file_handler = logging.FileHandler(self.log_file)
         self.logger = logging.getLogger(self.logger_name)
         if self.logger_name == 'RAW':
-            self.formatter = logging.Formatter('%(asctime)s - %(name)s: %(message)s')
+            self.formatter = RawFormatter('%(asctime)s - %(name)s: %(message)s')
             self.file_handler.setFormatter(self.formatter)
-            self.logger.addHandler(self.file_handler)
+            handlers = [self.file_handler]
         else:
             self.formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(name)s: %(message)s')
             self.stream_formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(name)s: %(message)s')
             self.stream_handler = logging.StreamHandler()
             self.file_handler.setFormatter(self.formatter)
             self.stream_handler.setFormatter(self.stream_formatter)
-            self.logger.addHandler(self.stream_handler)
-            self.logger.addHandler(self.file_handler)
+            handlers = [self.stream_handler, self.file_handler]
+        if writer:
+            if not writer.is_alive():
+                writer.start()
+                atexit.register(writer.stop)
+            self.logger.addHandler(QueuedHandler(writer, handlers))
+        else:
+            for handler in handlers:
+                self.logger.addHandler(handler)
         self.logger.setLevel(logging.INFO)
 
-    def info(self, msg):
+    def info(self, msg, imei=None):
         """
+        IMEI the message is about is noted in the header of the rotated segment of the raw log.
         """
-        self.logger.info(msg)
+        self.logger.info(msg, extra={'imei':imei})
 
     def warning(self, msg):
         """
@@ -44,4 +468,4 @@ class Logger:
     def exception(self, msg):
         """
         """
-        self.logger.exception(msg)
\ No newline at end of file
+        self.logger.exception(msg)
@@ -0,0 +1,241 @@
+#!/usr/bin/python3
+
+import time
+import bisect
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+NAMESPACE = 'teltonika'
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Counters are exposed as <NAMESPACE>_<name>_total. Rates are left to Prometheus (rate()).
+COUNTERS = {
+    'connections':'TCP connections accepted.',
+    'handshakes':'IMEI handshakes accepted.',
+    'handshake_failures':'IMEI handshakes rejected.',
+    'packets':'AVL data packets received.',
+    'records':'AVL records received.',
+    'duplicates':'AVL packets received again because their ack was lost, acked without being handled.',
+    'commands_sent':'GPRS commands sent.',
+    'command_responses':'GPRS command responses received.',
+    'decode_errors':'Frames or datagrams that could not be decoded.',
+    'handshake_timeouts':'TCP connections closed because IMEI was not received in time.',
+    'idle_timeouts':'Sessions closed because nothing was received from the device in time.',
+    'records_stored':'AVL records written by the record sink.',
+    'sink_errors':'Batches the record sink failed to write.',
+    'bytes_received':'Bytes received from devices.',
+    'bytes_sent':'Bytes sent to devices.',
+}
+DEVICE_COUNTERS = ('packets', 'records', 'bytes_received', 'bytes_sent') # Order of per device stats.
+DEVICE_HELP = {
+    'packets':'AVL data packets received per device.',
+    'records':'AVL records received per device.',
+    'bytes_received':'Bytes received per device.',
+    'bytes_sent':'Bytes sent per device.',
+}
+HISTOGRAMS = {
+    'decode_seconds':('Time spent decoding a packet.',
+        (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025)),
+    'ack_latency_seconds':('Time from receiving a packet to sending its ack.',
+        (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)),
+    'sink_commit_seconds':('Time spent writing and committing a batch of records.',
+        (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)),
+}
+
+
+class Shard:
+
+    def __init__(self):
+        """
+        Initializes Shard object which holds metrics updated by a single thread. Only the owning thread
+        writes to it, so updates take no lock.
+        """
+        self.counters = {} # counters[(name, protocol)] = value
+        self.devices = {} # devices[imei] = [packets, records, bytes_received, bytes_sent]
+        self.histograms = {name: [[0] * (len(buckets) + 1), 0.0] for name, (_, buckets) in HISTOGRAMS.items()}
+
+
+class Metrics:
+
+    def __init__(self, per_device=True):
+        """
+        Initializes Metrics object. Every thread updates its own shard, shards are merged only when
+        metrics are collected, so the cost of an update on the hot path is a couple of dict operations.
+
+            Parameters:
+                per_device (bool): keep counters of every IMEI. Default True.
+        """
+        self.per_device = per_device
+        self.local = threading.local()
+        self.shards = []
+        self.lock = threading.Lock()
+        self.gauges = {} # gauges[name] = (help, function returning current value)
+        self.start_time = time.time()
+
+    def shard(self):
+        try:
+            return self.local.shard
+        except AttributeError:
+            shard = self.local.shard = Shard()
+            with self.lock:
+                self.shards.append(shard)
+            return shard
+
+    def inc(self, name, value=1, protocol=None):
+        """
+        Increases counter by value.
+
+            Parameters:
+                name (str): name of the counter, one of COUNTERS.
+                value (int): increment. Default 1.
+                protocol (str): 'TCP' or 'UDP' label of the sample. Default None.
+        """
+        counters = self.shard().counters
+        key = (name, protocol)
+        counters[key] = counters.get(key, 0) + value
+
+    def device(self, imei, packets=0, records=0, bytes_received=0, bytes_sent=0):
+        """
+        Increases counters of a single device.
+        """
+        if not self.per_device or not imei:
+            return
+        devices = self.shard().devices
+        stats = devices.get(imei)
+        if stats is None:
+            stats = devices[imei] = [0, 0, 0, 0]
+        stats[0] += packets
+        stats[1] += records
+        stats[2] += bytes_received
+        stats[3] += bytes_sent
+
+    def observe(self, name, value):
+        """
+        Adds observation to histogram.
+
+            Parameters:
+                name (str): name of the histogram, one of HISTOGRAMS.
+                value (float): observed value in seconds.
+        """
+        histogram = self.shard().histograms[name]
+        histogram[0][bisect.bisect_left(HISTOGRAMS[name][1], value)] += 1
+        histogram[1] += value
+
+    def gauge(self, name, help, function):
+        """
+        Registers gauge which value is read by calling function when metrics are collected.
+        """
+        self.gauges[name] = (help, function)
+
+    def collect(self):
+        """
+        Merges shards of every thread.
+
+            Returns:
+                counters (dict): counters[(name, protocol)] = value.
+                devices (dict): devices[imei] = [packets, records, bytes_received, bytes_sent].
+                histograms (dict): histograms[name] = (bucket counts, sum).
+        """
+        with self.lock:
+            shards = list(self.shards)
+        counters = {}
+        devices = {}
+        histograms = {name: ([0] * (len(buckets) + 1), 0.0) for name, (_, buckets) in HISTOGRAMS.items()}
+        for shard in shards:
+            # dict.copy() is atomic, owning thread may keep updating the shard meanwhile.
+            for key, value in shard.counters.copy().items():
+                counters[key] = counters.get(key, 0) + value
+            for imei, stats in shard.devices.copy().items():
+                merged = devices.setdefault(imei, [0, 0, 0, 0])
+                for i, value in enumerate(list(stats)):
+                    merged[i] += value
+            for name, (counts, total) in shard.histograms.items():
+                merged_counts, merged_total = histograms[name]
+                for i, count in enumerate(list(counts)):
+                    merged_counts[i] += count
+                histograms[name] = (merged_counts, merged_total + total)
+        return counters, devices, histograms
+
+    def render(self):
+        """
+        Returns every metric in Prometheus text exposition format.
+        """
+        counters, devices, histograms = self.collect()
+        lines = []
+        for name, help in COUNTERS.items():
+            metric = f'{NAMESPACE}_{name}_total'
+            lines.append(f'# HELP {metric} {help}')
+            lines.append(f'# TYPE {metric} counter')
+            samples = sorted((protocol or '', value) for (n, protocol), value in counters.items() if n == name)
+            if not samples:
+                lines.append(f'{metric} 0')
+            for protocol, value in samples:
+                lines.append(f'{metric}{{protocol="{protocol}"}} {value}' if protocol else f'{metric} {value}')
+        for name, (help, buckets) in HISTOGRAMS.items():
+            metric = f'{NAMESPACE}_{name}'
+            counts, total = histograms[name]
+            lines.append(f'# HELP {metric} {help}')
+            lines.append(f'# TYPE {metric} histogram')
+            cumulative = 0
+            for bound, count in zip(buckets, counts):
+                cumulative += count
+                lines.append(f'{metric}_bucket{{le="{bound}"}} {cumulative}')
+            cumulative += counts[-1]
+            lines.append(f'{metric}_bucket{{le="+Inf"}} {cumulative}')
+            lines.append(f'{metric}_sum {total}')
+            lines.append(f'{metric}_count {cumulative}')
+        if self.per_device:
+            for i, name in enumerate(DEVICE_COUNTERS):
+                metric = f'{NAMESPACE}_device_{name}_total'
+                lines.append(f'# HELP {metric} {DEVICE_HELP[name]}')
+                lines.append(f'# TYPE {metric} counter')
+                for imei, stats in sorted(devices.items()):
+                    lines.append(f'{metric}{{imei="{imei}"}} {stats[i]}')
+        for name, (help, function) in self.gauges.items():
+            metric = f'{NAMESPACE}_{name}'
+            lines.append(f'# HELP {metric} {help}')
+            lines.append(f'# TYPE {metric} gauge')
+            lines.append(f'{metric} {function()}')
+        metric = f'{NAMESPACE}_start_time_seconds'
+        lines.append(f'# HELP {metric} Time the server was started at, in seconds since epoch.')
+        lines.append(f'# TYPE {metric} gauge')
+        lines.append(f'{metric} {self.start_time}')
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.metrics.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MetricsServer(ThreadingHTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, metrics, host='127.0.0.1', port=9150):
+        """
+        Initializes MetricsServer object which serves metrics on http://host:port/metrics.
+        """
+        super().__init__((host, port), MetricsHandler)
+        self.metrics = metrics
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, name='MetricsServer', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
@@ -1,54 +1,170 @@
 #!/usr/bin/python3
 
+import os
 import re
+import time
+import struct
 import binascii
 import libscrc
-from datetime import datetime
+import functools
+import collections.abc
+from datetime import datetime, timedelta, timezone
 
 TCP_PACKET_PATTERN = re.compile(r'Packet len: .*, data: .*\n.*(this is correct single packet|no 0x31 at the end)')
 UDP_PACKET_PATTERN = re.compile(r'Packet len: .*, data: .*\n.*received imei:.*\n.*sending udp')
 PACKET_PATTERN = re.compile(r'((Packet len: .*, data: .*\n.*(this is correct single packet|no 0x31 at the end))|(Packet len: .*, data: .*\n.*received imei:.*\n.*sending udp))')
 DATE_PATTERN = re.compile(r'\d{4}\.\d{2}\.\d{2}\s\d{2}:\d{2}:\d{2}')
 
+CODEC_8 = 0x08
+CODEC_8E = 0x8E
+CODEC_12 = 0x0C
+UDP_PACKET_ID = 0xCAFE
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+MAX_TIMESTAMP = (datetime.max.replace(tzinfo=timezone.utc) - EPOCH) // timedelta(milliseconds=1) # Latest datetime in ms.
+
+# Precompiled layouts used by the bytes decoder. All fields are big-endian.
+TCP_HEADER = struct.Struct('>II') # zeros, data length
+TCP_TRAILER = struct.Struct('>BI') # no of data 2, crc-16
+UDP_HEADER = struct.Struct('>HHBBH') # length, packet id, not used, avl packet id, imei length
+RECORD_HEADER = struct.Struct('>QBiihHBH') # timestamp, priority, lon, lat, alt, angle, satellites, speed
+TCP_REPLY = struct.Struct('>I')
+UDP_REPLY = struct.Struct('>5xBB')
+U8 = struct.Struct('>B')
+U16 = struct.Struct('>H')
+U64 = struct.Struct('>Q')
+# IO element layouts for 1, 2, 4 and 8 byte values. First field is AVL id, second is value.
+IO_ELEMENTS = {
+    CODEC_8: [struct.Struct(f'>B{f}') for f in 'BHIQ'],
+    CODEC_8E: [struct.Struct(f'>H{f}') for f in 'BHIQ'],
+}
+NX_ELEMENT = struct.Struct('>HH') # Codec 8E variable length element: avl id, value length
+GPRS_CMD_HEADER = struct.Struct('>BBBI') # codec, no of cmds, type, cmd length
+GPRS_CMD_CACHE_SIZE = 1024
+
+LOG_CHUNK_SIZE = 1 << 20
+MAX_RECORD_LINES = 3 # Longest PACKET_PATTERN match spans this many lines.
+
+@functools.lru_cache(maxsize=4096)
+def parse_log_time(time_str):
+    """
+    Converts date string found in the log to datetime. Results are cached, packets received
+    during the same second share the date string.
+
+        Parameters:
+            time_str (str): date in '%Y.%m.%d %H:%M:%S' format.
+
+        Returns:
+            time (datetime): parsed date.
+    """
+    return datetime(int(time_str[0:4]), int(time_str[5:7]), int(time_str[8:10]),
+        int(time_str[11:13]), int(time_str[14:16]), int(time_str[17:19]))
+
+def __parse_log_match(match):
+    match_string = match.group()
+    packet = match_string.split(':')[2].split('\n')[0].strip()
+    time_received = parse_log_time(DATE_PATTERN.search(match_string).group())
+    return time_received, packet
+
 def parse_log(log):
     """
     Parses supplied string object and finds packets containing record information.
-    Returns the list of said data packets.
+    Returns the list of said data packets. Use iter_log for big log files.
 
         Parameters:
             log (str): a string representing a log of server_main.
 
         Returns:
-            packets (list of tuples): returns a list with packets containing the string date of when packet
+            packets (list of tuples): returns a list with packets containing the date of when packet
             was received and packet data in string format.
     """
-    packet_matches = PACKET_PATTERN.finditer(log)
-    packets = []
-    for match in packet_matches:
-        match_string = match.group()
-        packet = match.group().split(':')[2].split('\n')[0].strip()
-        time_received = re.search(DATE_PATTERN, match_string).group()
-        time_received = datetime.strptime(time_received, '%Y.%m.%d %H:%M:%S')
-        packets.append((time_received, packet))
-    return packets
+    return [__parse_log_match(match) for match in PACKET_PATTERN.finditer(log)]
+
+def iter_log(log_file, chunk_size=LOG_CHUNK_SIZE, follow=False, poll_interval=1.0):
+    """
+    Reads log file in chunks and yields packets containing record information as they are found.
+    Memory use doesn't depend on size of the log. Records split between chunks are handled.
+
+        Parameters:
+            log_file (str or file object): path to a log of server_main or a log opened in text mode.
+            chunk_size (int): number of characters read at once. Default LOG_CHUNK_SIZE.
+            follow (bool): keep waiting for new lines at the end of the file, like tail -f. Default False.
+            poll_interval (float): seconds between checks for new data in follow mode. Default 1.0.
+
+        Returns:
+            packet (tuple): the date of when packet was received and packet data in string format.
+    """
+    if isinstance(log_file, str):
+        with open(log_file, 'r', errors='replace') as f:
+            yield from iter_log(f, chunk_size, follow, poll_interval)
+        return
+    pending = ''
+    while True:
+        chunk = log_file.read(chunk_size)
+        if not chunk:
+            if not follow:
+                break
+            # Nothing more to wait for right now, so records in the last lines are yielded as well.
+            lines_end = pending.rfind('\n') + 1
+            consumed = 0
+            for match in PACKET_PATTERN.finditer(pending, 0, lines_end):
+                consumed = match.end()
+                yield __parse_log_match(match)
+            pending = pending[consumed:]
+            if __log_truncated(log_file):
+                log_file.seek(0)
+                pending = ''
+            time.sleep(poll_interval)
+            continue
+        pending += chunk
+        # Only complete lines are searched. Matches starting in the last lines may still grow,
+        # so they are left for the next chunk together with an incomplete line.
+        lines_end = pending.rfind('\n') + 1
+        keep_from = lines_end
+        for _ in range(MAX_RECORD_LINES - 1):
+            keep_from = pending.rfind('\n', 0, max(keep_from - 1, 0)) + 1
+        consumed = keep_from
+        for match in PACKET_PATTERN.finditer(pending, 0, lines_end):
+            if match.start() >= keep_from:
+                break
+            consumed = max(consumed, match.end())
+            yield __parse_log_match(match)
+        pending = pending[consumed:]
+    for match in PACKET_PATTERN.finditer(pending):
+        yield __parse_log_match(match)
+
+def __log_truncated(log_file):
+    try:
+        return os.fstat(log_file.fileno()).st_size < log_file.tell()
+    except (AttributeError, OSError, ValueError):
+        return False
 
 def parse_packet(packet):
     """
-    Goes through supplied string representation of data packet and parses its parts.
+    Goes through supplied data packet and parses its parts.
     Considers record as a single part of a packet.
+    Packet data can be either a hex string (as found in logs) or a bytes-like object
+    (as received from a socket). Bytes are decoded in place, without hexlifying them.
 
         Parameters:
-            packet (tuple): tuple containing the string date of when packet
-            was received and packet data in string format.
+            packet (tuple): tuple containing the date of when packet
+            was received and packet data in string or bytes format.
 
         Returns:
             packet_info (dict): a dict with various parts of data packet.
+            reply (str or bytes): ack of received records. Same type as packet data.
     """
     time_received, packet = packet
-    if packet[4:8].upper() == 'CAFE':
-        packet_info, reply = __parse_udp_packet(packet)
+    if isinstance(packet, str):
+        if packet[4:8].upper() == 'CAFE':
+            packet_info, reply = __parse_udp_packet(packet)
+        else:
+            packet_info, reply = __parse_tcp_packet(packet)
     else:
-        packet_info, reply = __parse_tcp_packet(packet)
+        packet = memoryview(packet)
+        if len(packet) > 4 and U16.unpack_from(packet, 2)[0] == UDP_PACKET_ID:
+            packet_info, reply = __parse_udp_packet_bytes(packet)
+        else:
+            packet_info, reply = __parse_tcp_packet_bytes(packet)
     packet_info['time_received'] = time_received
     return packet_info, reply
 
@@ -64,7 +180,7 @@ def parse_date(log):
             was received and packet data in string format.
     """
     str_dates = DATE_PATTERN.findall(log)
-    dates = [datetime.strptime(d, '%Y.%m.%d %H:%M:%S') for d in str_dates]
+    dates = [parse_log_time(d) for d in str_dates]
     return dates
 
 def __parse_tcp_packet(packet):
@@ -117,68 +233,365 @@ def __parse_udp_packet(packet):
     reply = build_record_reply(packet_info['protocol'], no_of_data_1, packet_id)
     return packet_info, reply
 
+def __parse_tcp_packet_bytes(packet):
+    """
+    Function used in parse packets function. Specificaly parses TCP packets in bytes format.
+
+        Parameters:
+            packet (memoryview): a view of data packet bytes.
+
+        Returns:
+            packet_info (dict): a dict with various parts of data packet.
+    """
+    zeros, data_length = TCP_HEADER.unpack_from(packet, 0)
+    no_of_data_2, crc_16 = TCP_TRAILER.unpack_from(packet, len(packet) - TCP_TRAILER.size)
+    no_of_data_1 = packet[9]
+    packet_info = {'protocol':'TCP', 'zeros':zeros, 'data_length':data_length, 'codec':packet[8],
+        'no_of_data_1':no_of_data_1, 'records':packet[10:-TCP_TRAILER.size], 'no_of_data_2':no_of_data_2,
+            'crc_16':crc_16}
+    reply = build_record_reply(packet_info['protocol'], no_of_data_1)
+    return packet_info, reply
+
+def __parse_udp_packet_bytes(packet):
+    """
+    Function used in parse packets function. Specificaly parses UDP packets in bytes format.
+
+        Parameters:
+            packet (memoryview): a view of data packet bytes.
+
+        Returns:
+            packet_info (dict): a dict with various parts of data packet.
+    """
+    data_length, identification, not_used, packet_id, imei_len = UDP_HEADER.unpack_from(packet, 0)
+    offset = UDP_HEADER.size
+    imei = packet[offset:offset + imei_len]
+    offset += imei_len
+    no_of_data_1 = packet[offset + 1]
+    packet_info = {'protocol':'UDP', 'data_length':data_length, 'identification':identification,
+        'not_used':not_used, 'packet_id':packet_id, 'imei_len':imei_len, 'imei':imei, 'codec':packet[offset],
+            'no_of_data_1':no_of_data_1, 'records':packet[offset + 2:-1], 'no_of_data_2':packet[-1]}
+    reply = build_record_reply(packet_info['protocol'], no_of_data_1, packet_id)
+    return packet_info, reply
+
+class HexRecord(collections.abc.Mapping):
+
+    __slots__ = ('payload', 'offset', 'id_len', 'io_offset', 'codec', '_io')
+
+    # (start, end) of fields that precede IO elements relative to the start of the record, by length of AVL id.
+    FIELDS = {id_len: {'timestamp':(0, 16), 'priority':(16, 18), 'gps_data':(18, 48), 'event_id':(48, 48 + id_len),
+        'no_of_io':(48 + id_len, 48 + 2 * id_len)} for id_len in (2, 4)}
+
+    def __init__(self, payload, offset, id_len, io_offset, codec):
+        """
+        Initializes HexRecord object, a read-only dict-like view of a record in hex string payload.
+        Keys are 'timestamp', 'priority', 'gps_data', 'event_id', 'no_of_io' and hex AVL ids of IO elements,
+        values are hex strings. Values are sliced out of the payload only when they are read,
+        IO elements are located the first time one of them is read.
+        """
+        self.payload = payload
+        self.offset = offset
+        self.id_len = id_len
+        self.io_offset = io_offset
+        self.codec = codec
+        self._io = None
+
+    @property
+    def io(self):
+        # io[avl_id] = (start, end) of the value, in the order elements are in the payload.
+        if self._io is None:
+            payload = self.payload
+            id_len = self.id_len
+            io = {}
+            pos = self.io_offset
+            for i in range(4):
+                value_len = (2 ** i) * 2
+                no_of_elements_x_byte = int(payload[pos:pos + id_len], 16)
+                pos += id_len
+                for _ in range(no_of_elements_x_byte):
+                    io[payload[pos:pos + id_len]] = (pos + id_len, pos + id_len + value_len)
+                    pos += id_len + value_len
+            if self.codec == '8e':
+                no_of_elements_x_byte = int(payload[pos:pos + id_len], 16)
+                pos += id_len
+                for _ in range(no_of_elements_x_byte):
+                    value_len = int(payload[pos + id_len:pos + 2 * id_len], 16) * 2
+                    io[payload[pos:pos + id_len]] = (pos + 2 * id_len, pos + 2 * id_len + value_len)
+                    pos += 2 * id_len + value_len
+            self._io = io
+        return self._io
+
+    def __getitem__(self, key):
+        field = self.FIELDS[self.id_len].get(key)
+        if field is not None:
+            return self.payload[self.offset + field[0]:self.offset + field[1]]
+        field = self.io.get(key)
+        if field is None:
+            raise KeyError(key)
+        return self.payload[field[0]:field[1]]
+
+    def __iter__(self):
+        yield from self.FIELDS[self.id_len]
+        yield from self.io
+
+    def __len__(self):
+        return 5 + len(self.io)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+    def __reduce__(self):
+        return HexRecord, (self.payload, self.offset, self.id_len, self.io_offset, self.codec)
+
+
+class Record(collections.abc.Mapping):
+
+    __slots__ = ('payload', 'offset', 'io_offset', 'codec', '_io')
+
+    KEYS = ('timestamp', 'priority', 'gps_data', 'event_id', 'no_of_io', 'io')
+
+    def __init__(self, payload, offset, io_offset, codec):
+        """
+        Initializes Record object, a read-only dict-like view of a record in packet payload (bytes shared
+        by every record of the packet). Keys are the same as of dicts decode_record_payload() used to return:
+        'timestamp', 'priority', 'gps_data', 'event_id', 'no_of_io' and 'io'. Fields are unpacked only when
+        they are read, 'io' is decoded the first time it is read. Attributes like timestamp_ms, longitude
+        and latitude read a single field without building dicts or datetimes.
+        """
+        self.payload = payload
+        self.offset = offset
+        self.io_offset = io_offset
+        self.codec = codec
+        self._io = None
+
+    @property
+    def counter(self):
+        return U16 if self.codec == CODEC_8E else U8
+
+    @property
+    def timestamp_ms(self):
+        return U64.unpack_from(self.payload, self.offset)[0]
+
+    @property
+    def timestamp(self):
+        return EPOCH + timedelta(milliseconds=self.timestamp_ms)
+
+    @property
+    def priority(self):
+        return self.payload[self.offset + 8]
+
+    @property
+    def longitude(self):
+        return RECORD_HEADER.unpack_from(self.payload, self.offset)[2] / 10000000
+
+    @property
+    def latitude(self):
+        return RECORD_HEADER.unpack_from(self.payload, self.offset)[3] / 10000000
+
+    @property
+    def gps_data(self):
+        _, _, lon, lat, alt, angle, sats, speed = RECORD_HEADER.unpack_from(self.payload, self.offset)
+        return {'longitude':lon / 10000000, 'latitude':lat / 10000000, 'altitude':alt, 'angle':angle,
+            'satellites':sats, 'speed':speed}
+
+    @property
+    def event_id(self):
+        return self.counter.unpack_from(self.payload, self.offset + RECORD_HEADER.size)[0]
+
+    @property
+    def no_of_io(self):
+        counter = self.counter
+        return counter.unpack_from(self.payload, self.offset + RECORD_HEADER.size + counter.size)[0]
+
+    @property
+    def io(self):
+        # IO elements keyed by AVL id. Variable length (Codec 8E NX) values are bytes, others are ints.
+        if self._io is None:
+            payload = self.payload
+            counter = self.counter
+            c_size = counter.size
+            io = {}
+            pos = self.io_offset
+            for element in IO_ELEMENTS[CODEC_8E if self.codec == CODEC_8E else CODEC_8]:
+                no_of_elements_x_byte = counter.unpack_from(payload, pos)[0]
+                pos += c_size
+                for _ in range(no_of_elements_x_byte):
+                    avl_id, value = element.unpack_from(payload, pos)
+                    io[avl_id] = value
+                    pos += element.size
+            if self.codec == CODEC_8E:
+                no_of_elements_x_byte = counter.unpack_from(payload, pos)[0]
+                pos += c_size
+                for _ in range(no_of_elements_x_byte):
+                    avl_id, value_len = NX_ELEMENT.unpack_from(payload, pos)
+                    pos += NX_ELEMENT.size
+                    io[avl_id] = payload[pos:pos + value_len]
+                    pos += value_len
+            self._io = io
+        return self._io
+
+    def __getitem__(self, key):
+        if key not in self.KEYS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __iter__(self):
+        return iter(self.KEYS)
+
+    def __len__(self):
+        return len(self.KEYS)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+    def __reduce__(self):
+        # Records of a packet pickled together share a single copy of the payload.
+        return Record, (self.payload, self.offset, self.io_offset, self.codec)
+
+
 def parse_record_payload(record_payload, no_of_records, codec='08'):
     """
-    Parses packet payload containing records. Puts every parameter into a dict. Each dict represents a single record.
-    dicts are appended to the list which is than returned.
+    Parses packet payload containing records. Every record is represented by a HexRecord, a dict-like
+    view of the payload. Only counts of IO elements are read here, values are sliced out of the
+    payload when they are read.
 
         Parameters:
             record_payload (str): a string representation record data.
-            no_of_records (int): a number of records in record_payload.
+            no_of_records (str): a number of records in record_payload, hex.
             codec (str): type of codec used to encode records. Default '08'.
 
         Returns:
-            records (list of dicts): a list containing dicts representing records.
-            reply (str): str representation of bytes that are sent to device as an ack of received records.
+            records (list of HexRecords): records keyed by field names and hex AVL ids, with hex string values.
     """
     records = []
-    rest_of_payload = record_payload
+    payload = record_payload
     mx = 1 if codec == '08' else 2
-    no_of_records_hex = no_of_records
+    id_len = 2 * mx
+    pos = 0
     no_of_records = int(no_of_records, 16)
-    recs_parsed = 0
-    while recs_parsed < no_of_records:
-        timestamp, rest_of_payload = rest_of_payload[:16], rest_of_payload[16:]
-        priority, rest_of_payload = rest_of_payload[:2], rest_of_payload[2:]
-        gps_data, rest_of_payload = rest_of_payload[:30], rest_of_payload[30:]
-        event_id, rest_of_payload = rest_of_payload[:2*mx], rest_of_payload[2*mx:]
-        no_of_io, rest_of_payload = rest_of_payload[:2*mx], rest_of_payload[2*mx:]
-        record = {'timestamp':timestamp, 'priority':priority, 'gps_data':gps_data,
-            'event_id':event_id, 'no_of_io':no_of_io}
+    for _ in range(no_of_records):
+        start = pos
+        pos += 48 + 2 * id_len
+        io_offset = pos
         for i in range(4):
             value_len = (2 ** i) * 2
-            no_of_elements_x_byte, rest_of_payload = rest_of_payload[:2*mx], rest_of_payload[2*mx:]
-            no_of_elements_x_byte = int(no_of_elements_x_byte, 16)
-            for _ in range(no_of_elements_x_byte):
-                avl_id, rest_of_payload = rest_of_payload[:2*mx], rest_of_payload[2*mx:]
-                value, rest_of_payload = rest_of_payload[:value_len], rest_of_payload[value_len:]
-                record[avl_id] = value
+            no_of_elements_x_byte = int(payload[pos:pos + id_len], 16)
+            pos += id_len + no_of_elements_x_byte * (id_len + value_len)
         if codec == '8e':
-            no_of_elements_x_byte, rest_of_payload = rest_of_payload[:2*mx], rest_of_payload[2*mx:]
-            no_of_elements_x_byte = int(no_of_elements_x_byte, 16)
+            no_of_elements_x_byte = int(payload[pos:pos + id_len], 16)
+            pos += id_len
+            for _ in range(no_of_elements_x_byte):
+                pos += 2 * id_len + int(payload[pos + id_len:pos + 2 * id_len], 16) * 2
+        if pos > len(payload):
+            raise ValueError(f'Record payload is {len(payload)} characters long, record {len(records)} ends at {pos}')
+        records.append(HexRecord(payload, start, id_len, io_offset, codec))
+    return records
+
+def decode_record_payload(record_payload, no_of_records, codec=CODEC_8):
+    """
+    Decodes packet payload containing records directly from bytes. Payload is copied once (unless it
+    is bytes already) and shared by every record. Only timestamps and counts and lengths of IO elements
+    are read here, to find where every record starts and to check that the payload holds all of them and
+    that every timestamp can be converted to datetime. Fields are unpacked with precompiled struct layouts
+    when they are read, see Record.
+
+        Parameters:
+            record_payload (bytes-like): record data as bytes, bytearray or memoryview.
+            no_of_records (int): a number of records in record_payload.
+            codec (int): type of codec used to encode records. Default CODEC_8.
+
+        Returns:
+            records (list of Records): dict-like views of records. GPS data is put in 'gps_data' dict,
+            IO elements are put in 'io' dict keyed by AVL id. Variable length (Codec 8E NX) values are bytes,
+            others are ints.
+    """
+    payload = record_payload if isinstance(record_payload, bytes) else bytes(record_payload)
+    records = []
+    counter = U16 if codec == CODEC_8E else U8
+    c_size = counter.size
+    sizes = [element.size for element in IO_ELEMENTS[CODEC_8E if codec == CODEC_8E else CODEC_8]]
+    pos = 0
+    for _ in range(no_of_records):
+        start = pos
+        if U64.unpack_from(payload, pos)[0] > MAX_TIMESTAMP:
+            raise ValueError(f'Timestamp of record {len(records)} is out of range')
+        pos += RECORD_HEADER.size + 2 * c_size
+        io_offset = pos
+        for size in sizes:
+            pos += c_size + counter.unpack_from(payload, pos)[0] * size
+        if codec == CODEC_8E:
+            no_of_elements_x_byte = counter.unpack_from(payload, pos)[0]
+            pos += c_size
             for _ in range(no_of_elements_x_byte):
-                avl_id, rest_of_payload = rest_of_payload[:2*mx], rest_of_payload[2*mx:]
-                value_len, rest_of_payload = rest_of_payload[:2*mx], rest_of_payload[2*mx:]
-                value_len = int(value_len, 16) * 2
-                value, rest_of_payload = rest_of_payload[:value_len], rest_of_payload[value_len:]
-                record[avl_id] = value
-        recs_parsed += 1
-        records.append(record)
+                pos += NX_ELEMENT.size + NX_ELEMENT.unpack_from(payload, pos)[1]
+        if pos > len(payload):
+            raise ValueError(f'Record payload is {len(payload)} bytes long, record {len(records)} ends at {pos}')
+        records.append(Record(payload, start, io_offset, codec))
     return records
 
+def first_record_timestamp(record_payload):
+    """
+    Reads timestamp of the first record without decoding the payload.
+
+        Parameters:
+            record_payload (bytes-like): record data.
+
+        Returns:
+            timestamp (int): ms since epoch, None if payload is too short.
+    """
+    if len(record_payload) < U64.size:
+        return None
+    return U64.unpack_from(record_payload, 0)[0]
+
+def check_crc(packet_info, data):
+    """
+    Checks CRC-16 of a TCP packet, so a corrupted packet is never acked.
+
+        Parameters:
+            packet_info (dict): a dict returned by parse_packet().
+            data (bytes): the whole packet.
+
+        Raises:
+            ValueError: if CRC-16 of the packet doesn't match.
+    """
+    crc = libscrc.ibm(data[TCP_HEADER.size:-4]) # Codec ID to number of data 2.
+    if crc != packet_info['crc_16']:
+        raise ValueError(f"CRC-16 {packet_info['crc_16']:#06x} doesn't match {crc:#06x} of the packet")
+
+def check_packet(packet_info):
+    """
+    Checks the parts of a parsed packet that can be checked without decoding its records.
+    Used when records are decoded after the packet has been acked, CRC-16 of TCP packets is checked
+    by check_crc() before.
+
+        Parameters:
+            packet_info (dict): a dict returned by parse_packet().
+
+        Raises:
+            ValueError: if codec is unknown or record counts don't match.
+    """
+    codec = packet_info['codec']
+    if codec not in (CODEC_8, CODEC_8E, CODEC_12):
+        raise ValueError(f'Unknown codec {codec:#04x}')
+    if packet_info['no_of_data_1'] != packet_info['no_of_data_2']:
+        raise ValueError(f"Number of data {packet_info['no_of_data_1']} and {packet_info['no_of_data_2']} don't match")
+    if codec != CODEC_12 and len(packet_info['records']) < packet_info['no_of_data_1'] * RECORD_HEADER.size:
+        raise ValueError(f"{len(packet_info['records'])} bytes are too few for {packet_info['no_of_data_1']} records")
+
 def parse_imei(data, wlen=True):
     """
     Parses IMEI from data received while establishing connection.
 
         Parameters:
-            data (str): received data from device as a str object.
+            data (str or bytes): received data from device as a str or bytes object.
 
         Returns:
             imei (str): parsed IMEI in decimal format.
     """
-    imei_hex = data[4:] if wlen else data
-    imei = binascii.unhexlify(imei_hex).decode('utf-8')
-    return imei
+    if isinstance(data, str):
+        imei_hex = data[4:] if wlen else data
+        return binascii.unhexlify(imei_hex).decode('utf-8')
+    data = data[2:] if wlen else data
+    return bytes(data).decode('utf-8')
 
 def build_gprs_cmd(cmd):
     """
@@ -191,33 +604,38 @@ def build_gprs_cmd(cmd):
             packet (str): str representation of bytes of GPRS command and other fields
             requirerd to send a command.
     """
-    cmd = binascii.hexlify(cmd.encode('utf-8')).decode('utf-8')
-    four_zeros = '00000000'
-    codec = '0C'
-    no_of_cmds = '01'
-    type_byte = '05' # GPRS cmd to send. 06 would be cmd response received from device.
-    cmd_len = hex(int(len(cmd)/2))[2:].zfill(8)
-    packet = codec + no_of_cmds + type_byte + cmd_len + cmd + no_of_cmds
-    packet_len = hex(int(len(packet) / 2))[2:]
-    packet_len = packet_len.zfill(8)
-    full_packet = four_zeros + packet_len + packet
-    packet_bytes = binascii.unhexlify(packet)
-    crc16 = hex(libscrc.ibm(packet_bytes))[2:].zfill(8)
-    full_packet += crc16
-    return full_packet
+    return encode_gprs_cmd(cmd).hex()
+
+@functools.lru_cache(maxsize=GPRS_CMD_CACHE_SIZE)
+def encode_gprs_cmd(cmd):
+    """
+    Builds Codec 12 packet of GPRS command as bytes. Packets are cached by command text,
+    the same command sent again (or to many devices) is encoded once.
+
+        Parameters:
+            cmd (str): GPRS command to send to the device.
+
+        Returns:
+            packet (bytes): complete packet with header and CRC-16.
+    """
+    cmd = cmd.encode('utf-8')
+    # Type 0x05 is GPRS cmd to send. 0x06 would be cmd response received from device.
+    data = GPRS_CMD_HEADER.pack(CODEC_12, 1, 0x05, len(cmd)) + cmd + b'\x01'
+    return TCP_HEADER.pack(0, len(data)) + data + TCP_REPLY.pack(libscrc.ibm(data))
 
 def parse_gprs_cmd_response(data):
     """
     Parses GPRS CMD response from data received.
 
         Parameters:
-            data (str): received data from device as a str object.
+            data (str or bytes): received data from device as a str or bytes object.
 
         Returns:
             response (str): human readable response to GPRS command.
     """
-    response = binascii.unhexlify(data[10:]).decode('utf-8')
-    return response
+    if isinstance(data, str):
+        return binascii.unhexlify(data[10:]).decode('utf-8')
+    return bytes(data[5:]).decode('utf-8')
 
 def build_record_reply(protocol, no_of_recs, packet_id=None):
     """
@@ -225,10 +643,92 @@ def build_record_reply(protocol, no_of_recs, packet_id=None):
 
         Parameters:
             protocol (str): transport protocol of received packet.
-            no_of_recs (int): number of records in data packet.
-            packet_id (str): UDP packet id.
+            no_of_recs (str or int): number of records in data packet. If it is a hex str,
+            reply is a hex str. If it is an int, reply is bytes.
+            packet_id (str or int): UDP packet id.
     """
-    if protocol == 'TCP':
+    if isinstance(no_of_recs, int):
+        if protocol == 'TCP':
+            return TCP_REPLY.pack(no_of_recs)
+        elif protocol == 'UDP':
+            return UDP_REPLY.pack(packet_id, no_of_recs)
+    elif protocol == 'TCP':
         return '0' * (8 - len(no_of_recs)) + no_of_recs
     elif protocol == 'UDP':
-        return '0' * (14 - len(no_of_recs + packet_id)) + packet_id + no_of_recs
\ No newline at end of file
+        return '0' * (14 - len(no_of_recs + packet_id)) + packet_id + no_of_recs
+
+def build_imei_packet(imei):
+    """
+    Builds a packet device sends to the TCP server when it connects.
+
+        Parameters:
+            imei (str): IMEI of the device.
+
+        Returns:
+            packet (bytes): IMEI length and IMEI.
+    """
+    imei = imei.encode('utf-8')
+    return U16.pack(len(imei)) + imei
+
+def build_record(timestamp, gps_data=None, io=None, event_id=0, priority=0, codec=CODEC_8):
+    """
+    Encodes a single AVL record. Reverse of decode_record_payload, used to generate test data.
+
+        Parameters:
+            timestamp (datetime or int): time of the record, int is ms since epoch.
+            gps_data (dict): 'longitude', 'latitude', 'altitude', 'angle', 'satellites' and 'speed'. Default zeros.
+            io (dict): IO elements keyed by AVL id. Int values are stored in the smallest of 1, 2, 4 or 8 bytes,
+            bytes values are stored as variable length (Codec 8E NX) elements. Default None.
+            event_id (int): AVL id of the IO element that triggered the record. Default 0.
+            priority (int): record priority. Default 0.
+            codec (int): CODEC_8 or CODEC_8E. Default CODEC_8.
+
+        Returns:
+            record (bytes): encoded record.
+    """
+    if isinstance(timestamp, datetime):
+        timestamp = (timestamp - EPOCH) // timedelta(milliseconds=1)
+    gps = gps_data or {}
+    io = io or {}
+    counter = U16 if codec == CODEC_8E else U8
+    elements = [[], [], [], []]
+    nx_elements = []
+    for avl_id, value in io.items():
+        if isinstance(value, (bytes, bytearray)):
+            nx_elements.append(NX_ELEMENT.pack(avl_id, len(value)) + value)
+            continue
+        width = 0 if value < 0x100 else 1 if value < 0x10000 else 2 if value < 0x100000000 else 3
+        elements[width].append(IO_ELEMENTS[codec if codec == CODEC_8E else CODEC_8][width].pack(avl_id, value))
+    if nx_elements and codec != CODEC_8E:
+        raise ValueError('Variable length IO elements are only supported by Codec 8E')
+    parts = [RECORD_HEADER.pack(timestamp, priority, round(gps.get('longitude', 0) * 10000000),
+        round(gps.get('latitude', 0) * 10000000), gps.get('altitude', 0), gps.get('angle', 0),
+            gps.get('satellites', 0), gps.get('speed', 0)), counter.pack(event_id), counter.pack(len(io))]
+    for group in elements:
+        parts.append(counter.pack(len(group)))
+        parts.extend(group)
+    if codec == CODEC_8E:
+        parts.append(counter.pack(len(nx_elements)))
+        parts.extend(nx_elements)
+    return b''.join(parts)
+
+def build_avl_packet(records, codec=CODEC_8, protocol='TCP', imei=None, packet_id=0):
+    """
+    Builds AVL data packet out of encoded records, as device would send it.
+
+        Parameters:
+            records (list of bytes): records encoded with build_record.
+            codec (int): codec the records are encoded with. Default CODEC_8.
+            protocol (str): 'TCP' or 'UDP'. Default 'TCP'.
+            imei (str): IMEI of the device, required for UDP. Default None.
+            packet_id (int): AVL packet id of UDP packet. Default 0.
+
+        Returns:
+            packet (bytes): complete packet.
+    """
+    data = bytes([codec, len(records)]) + b''.join(records) + bytes([len(records)])
+    if protocol == 'TCP':
+        return TCP_HEADER.pack(0, len(data)) + data + TCP_REPLY.pack(libscrc.ibm(data))
+    imei = imei.encode('utf-8')
+    header = UDP_HEADER.pack(UDP_HEADER.size - 2 + len(imei) + len(data), UDP_PACKET_ID, 0x01, packet_id, len(imei))
+    return header + imei + data
@@ -1,48 +1,490 @@
 #!/usr/bin/python3
 
-import sys
+import os
 import re
+import sys
+import csv
+import gzip
+import struct
+import argparse
+import concurrent.futures
+import numpy as np
 from datetime import datetime
+import logger
+import capture
+import columnar
+
+PATTERN = 'Periodic low priority record' # Device log lines analyzed by default.
+CHUNK_SIZE = 64 << 20 # Bytes of a text file scanned by a single task.
+CAPTURE_CHUNK = 200000 # Indexed frames of a capture scanned by a single task.
+DECODE_BATCH = 4096 # Packets decoded by columnar.decode_batch() at once.
+PERCENTILES = (25, 50, 75, 95, 99)
+NO_EVENT = -1 # Event id of device log records, they have none.
+UNKNOWN = -1 # IMEI code of TCP records sent before the chunk's first IMEI frame.
+
+# Frames received from devices in raw text log (raw.log) and in server_main log, with IMEI the raw log
+# tags frames with (see logger.RawFormatter).
+FRAME_PATTERN = re.compile(rb"(?: - RAW: << |Packet len: \d+, data: )(?:b')?([0-9a-fA-F]+)'?(?: IMEI: (\w+))?")
+# Same with time the line was logged, slower, only used with a time window.
+TIMED_FRAME_PATTERN = re.compile(rb"^(?:\[?(\d{4}[-.]\d{2}[-.]\d{2} \d{2}:\d{2}:\d{2}))?[^\n]*?"
+    rb"(?: - RAW: << |Packet len: \d+, data: )(?:b')?([0-9a-fA-F]+)'?(?: IMEI: (\w+))?", re.M)
+LINE_TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+DEVICE_LOG_LINE = rb'^\[(\d{4})\.(\d{2})\.(\d{2}) (\d{2}:\d{2}:\d{2})\][^\n]*?'
+COLUMNS = ['imei', 'event_id', 'records', 'intervals', 'mean', 'variance', 'std', 'min',
+    *(f'p{p}' for p in PERCENTILES), 'max', 'gaps']
+
+
+def device_log_pattern(pattern):
+    return re.compile(DEVICE_LOG_LINE + pattern.encode('utf-8'), re.M)
+
+def device_log_times(matches):
+    """
+    Converts device log time stamps ('[YYYY.MM.DD HH:MM:SS]' groups of DEVICE_LOG_LINE) to ms since epoch.
+    """
+    times = [f'{year}-{month}-{day}T{time}' for year, month, day, time in
+        (tuple(g.decode('ascii') for g in m.groups()[:4]) for m in matches)]
+    return np.array(times, 'datetime64[s]').astype(np.int64) * 1000
 
-log_file = sys.argv[1]
-try:
-    min_period = sys.argv[2]
-except IndexError:
-    pass
-
-pattern = re.compile(r'.*Periodic low priority record')
-date_pattern = re.compile(r'\d{4}\.\d{2}\.\d{2}\s\d{2}:\d{2}:\d{2}')
-time_format = '[%Y.%m.%d %H:%M:%S]'
-
-with open(log_file, 'r') as f:
-    log = f.read()
-
-matches = pattern.finditer(log)
-
-minuend = None
-subtrahend = None
-diffs = []
-for m in matches:
-    time_str = m.group().split('-')[0]
-    time = datetime.strptime(time_str, time_format)
-    if not subtrahend:
-        subtrahend = time
+def find_intervals(log, pattern=PATTERN):
+    """
+    Finds matching records in device log and returns seconds between consecutive records.
+
+        Parameters:
+            log (str): device log.
+            pattern (str): regex matched against log lines. Default PATTERN.
+
+        Returns:
+            diffs (np.ndarray): float64 seconds between consecutive records.
+    """
+    times = device_log_times(device_log_pattern(pattern).finditer(log.encode('utf-8')))
+    return np.diff(times) / 1000
+
+def group_stats(groups, intervals, no_of_groups, gap=None):
+    """
+    Calculates statistics of intervals of every group at once.
+
+        Parameters:
+            groups (np.ndarray): group of every interval, 0 to no_of_groups - 1.
+            intervals (np.ndarray): intervals in seconds.
+            no_of_groups (int): number of groups.
+            gap (float): intervals longer than gap are counted as gaps. Default None.
+
+        Returns:
+            stats (dict of np.ndarray): 'intervals', 'mean', 'variance' (sample), 'std', 'min', 'max',
+            exact percentiles 'p<N>' (linear interpolation, as np.percentile) and 'gaps', a value per group.
+            Statistics of groups without intervals are nan.
+    """
+    intervals = np.asarray(intervals, np.float64)
+    order = np.lexsort((intervals, groups))
+    groups, values = groups[order], intervals[order]
+    counts = np.bincount(groups, minlength=no_of_groups)
+    starts = np.cumsum(counts) - counts
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.bincount(groups, values, no_of_groups) / counts
+        deviations = np.bincount(groups, (values - mean[groups]) ** 2, no_of_groups)
+        variance = np.where(counts > 1, deviations / (counts - 1), np.nan)
+    present = counts > 0
+    last = np.maximum(counts - 1, 0)
+    stats = {'intervals':counts, 'mean':mean, 'variance':variance, 'std':np.sqrt(variance)}
+    if len(values):
+        stats['min'] = np.where(present, values[np.minimum(starts, len(values) - 1)], np.nan)
+    else:
+        stats['min'] = mean
+    for p in PERCENTILES:
+        position = last * (p / 100)
+        low = np.floor(position).astype(np.int64)
+        high = np.ceil(position).astype(np.int64)
+        if len(values):
+            low_values = values[np.minimum(starts + low, len(values) - 1)]
+            high_values = values[np.minimum(starts + high, len(values) - 1)]
+            stats[f'p{p}'] = np.where(present, low_values + (high_values - low_values) * (position - low), np.nan)
+        else:
+            stats[f'p{p}'] = mean
+    if len(values):
+        stats['max'] = np.where(present, values[np.minimum(starts + last, len(values) - 1)], np.nan)
     else:
-        minuend = time
-        diff = (minuend - subtrahend).total_seconds()
-        subtrahend = minuend
-        diffs.append(diff)
-
-s_sq = (sum([i**2 for i in diffs]) - ((sum(diffs)**2)/len(diffs)))/(len(diffs)-1)
-s = s_sq**0.5
-diffs.sort()
-diffs_len = len(diffs)
-R = diffs[-1] - diffs[0]
-x_ = sum(diffs)/diffs_len
-Q1 = 0.25*(diffs_len+1)
-Q3 = 0.75*(diffs_len+1)
-
-print(f"MEAN: {x_:.2f}")
-print(f"S^2: {s_sq:.2f}\nS: {s:.2f}")
-print(f"R: {R}")
-print(f"Q1: {diffs[int(Q1)]}; Q3: {diffs[int(Q3)]}")
+        stats['max'] = mean
+    if gap is None:
+        stats['gaps'] = np.zeros(no_of_groups, np.int64)
+    else:
+        stats['gaps'] = np.bincount(groups, values > gap, no_of_groups).astype(np.int64)
+    return stats
+
+def interval_stats(diffs, gap=None):
+    """
+    Calculates mean, variance, standard deviation, range, exact quartiles and gaps of intervals.
+
+        Parameters:
+            diffs (sequence of float): intervals in seconds.
+            gap (float): intervals longer than gap are counted as gaps. Default None.
+
+        Returns:
+            stats (dict): 'mean', 's_sq', 's', 'R', 'Q1', 'median', 'Q3', 'min', 'max', 'gaps'.
+    """
+    diffs = np.asarray(diffs, np.float64)
+    stats = {name: float(value[0]) for name, value in
+        group_stats(np.zeros(len(diffs), np.int64), diffs, 1, gap).items()}
+    return {'mean':stats['mean'], 's_sq':stats['variance'], 's':stats['std'], 'R':stats['max'] - stats['min'],
+        'Q1':stats['p25'], 'median':stats['p50'], 'Q3':stats['p75'], 'min':stats['min'], 'max':stats['max'],
+            'gaps':int(stats['gaps'])}
+
+def decode_packets(packets, first=0):
+    """
+    Decodes packets with columnar.decode_batch(). A batch that fails is split in halves,
+    so only packets that are broken are skipped.
+
+        Parameters:
+            packets (list of bytes): AVL packets.
+            first (int): index of the first packet, added to packet indexes of records. Default 0.
+
+        Returns:
+            columns (list of tuples): (packet index, event id, timestamp in ms) arrays.
+            errors (int): number of packets that could not be decoded.
+    """
+    if not packets:
+        return [], 0
+    try:
+        batch = columnar.decode_batch(packets)
+    except (struct.error, ValueError, IndexError):
+        if len(packets) == 1:
+            return [], 1
+        middle = len(packets) // 2
+        left, left_errors = decode_packets(packets[:middle], first)
+        right, right_errors = decode_packets(packets[middle:], first + middle)
+        return left + right, left_errors + right_errors
+    return [(batch['packet'] + first, batch['event_id'].astype(np.int32), batch['timestamp'].astype(np.int64))], 0
+
+
+class Scan:
+
+    def __init__(self):
+        """
+        Initializes Scan object which collects records found by a single task. IMEIs are coded by
+        their position in imeis, records of TCP packets whose IMEI is not known yet get UNKNOWN.
+        """
+        self.imeis = []
+        self.codes = {}
+        self.current = None # Code of the IMEI of the last TCP connection.
+        self.packets = []
+        self.packet_imeis = []
+        self.columns = [] # (imei codes, event ids, timestamps) arrays.
+        self.errors = 0
+
+    def code(self, imei):
+        code = self.codes.get(imei)
+        if code is None:
+            code = self.codes[imei] = len(self.imeis)
+            self.imeis.append(imei)
+        return code
+
+    def add_frame(self, data, imei=None, within=True):
+        # Frame received from a device: AVL packet, or IMEI sent when TCP connection is established.
+        # AVL packets logged outside of the time window (within is False) are skipped.
+        # TCP packets without IMEI (logs written before frames were tagged) belong to the last IMEI frame.
+        if len(data) > 8 and data[2:4] == b'\xca\xfe':
+            imei_len = int.from_bytes(data[6:8], 'big')
+            if within:
+                self.add_packet(data, self.code(imei or data[8:8 + imei_len].decode('ascii', 'replace')))
+        elif data[:4] == b'\x00\x00\x00\x00':
+            if within:
+                self.add_packet(data, self.code(imei) if imei else self.current)
+        elif len(data) > 2 and int.from_bytes(data[:2], 'big') == len(data) - 2:
+            self.current = self.code(data[2:].decode('ascii', 'replace'))
+
+    def add_packet(self, data, code):
+        self.packets.append(data)
+        self.packet_imeis.append(UNKNOWN if code is None else code)
+        if len(self.packets) >= DECODE_BATCH:
+            self.decode()
+
+    def add_records(self, imei, event_id, timestamps):
+        self.columns.append((np.full(len(timestamps), self.code(imei), np.int32),
+            np.full(len(timestamps), event_id, np.int32), timestamps))
+
+    def decode(self):
+        columns, errors = decode_packets(self.packets)
+        packet_imeis = np.asarray(self.packet_imeis, np.int32)
+        for packet, event_id, timestamp in columns:
+            self.columns.append((packet_imeis[packet], event_id, timestamp))
+        self.errors += errors
+        self.packets = []
+        self.packet_imeis = []
+
+    def result(self):
+        self.decode()
+        if self.columns:
+            imei, event_id, timestamp = (np.concatenate(column) for column in zip(*self.columns))
+        else:
+            imei, event_id, timestamp = np.zeros(0, np.int32), np.zeros(0, np.int32), np.zeros(0, np.int64)
+        last = self.imeis[self.current] if self.current is not None else None
+        return {'imeis':self.imeis, 'imei':imei, 'event_id':event_id, 'timestamp':timestamp, 'last_imei':last,
+            'errors':self.errors}
+
+
+def read_chunk(path, start, end):
+    """
+    Reads lines of a text file that start within [start, end). Compressed log segment (.gz) is read whole.
+    """
+    if path.endswith('.gz'):
+        with gzip.open(path, 'rb') as f:
+            return f.read()
+    with open(path, 'rb') as f:
+        if start:
+            f.seek(start - 1)
+            if f.read(1) != b'\n':
+                f.readline()
+        if f.tell() >= end and start:
+            return b''
+        data = f.read(max(end - f.tell(), 0))
+        if data and not data.endswith(b'\n'):
+            data += f.readline()
+    return data
+
+def line_bounds(start, end):
+    # Time window as times of log lines (local time, LINE_TIME_FORMAT), None if not limited.
+    return tuple(None if t is None else t.astimezone().strftime(LINE_TIME_FORMAT).encode('ascii') if t.tzinfo
+        else t.strftime(LINE_TIME_FORMAT).encode('ascii') for t in (start, end))
+
+def scan_text(path, start, end, pattern, window=(None, None)):
+    """
+    Scans a chunk of text file. Runs in a worker process. Device log records matching pattern are
+    attributed to the file (device logs have no IMEI), AVL packets of raw text and server_main logs to
+    the IMEI in the UDP packet or to the IMEI sent when the TCP connection was established.
+    Only lines logged within window (datetimes, None if not limited) are analyzed.
+
+        Returns:
+            result (dict): see Scan.result().
+    """
+    data = read_chunk(path, start, end)
+    scan = Scan()
+    first, last = line_bounds(*window)
+    times = device_log_times(device_log_pattern(pattern).finditer(data))
+    if first is not None:
+        times = times[times >= np.datetime64(first.decode('ascii').replace(' ', 'T'), 'ms').astype(np.int64)]
+    if last is not None:
+        times = times[times <= np.datetime64(last.decode('ascii').replace(' ', 'T'), 'ms').astype(np.int64)]
+    if len(times):
+        scan.add_records(os.path.basename(path), NO_EVENT, times)
+    timed = first is not None or last is not None
+    for m in (TIMED_FRAME_PATTERN if timed else FRAME_PATTERN).finditer(data):
+        logged, frame, imei = m.groups() if timed else (None, *m.groups())
+        within = True
+        if logged is not None:
+            logged = logged.replace(b'.', b'-')
+            within = (first is None or logged >= first) and (last is None or logged <= last)
+        try:
+            frame = bytes.fromhex(frame.decode('ascii'))
+        except ValueError:
+            scan.errors += 1
+            continue
+        scan.add_frame(frame, imei and imei.decode('ascii'), within)
+    return scan.result()
+
+def scan_capture(path, first, last, window=(None, None)):
+    """
+    Scans index entries first to last of a binary capture, or the whole capture if it has no index
+    (last is None). Runs in a worker process. Only frames received within window are analyzed.
+
+        Returns:
+            result (dict): see Scan.result().
+    """
+    scan = Scan()
+    start, end = (None if t is None else t.astimezone() for t in window)
+    with capture.CaptureReader(path) as reader:
+        if last is None:
+            frames = iter(reader)
+        else:
+            frames = (reader.read_at(reader.entry(i)[2])[0] for i in range(first, last))
+        for frame in frames:
+            if frame is not None and frame.direction == capture.IN:
+                within = (start is None or frame.time >= start) and (end is None or frame.time <= end)
+                scan.add_frame(bytes(frame.data), frame.imei, within)
+    return scan.result()
+
+def make_tasks(paths, pattern, window=(None, None), chunk_size=CHUNK_SIZE, capture_chunk=CAPTURE_CHUNK):
+    """
+    Splits files into tasks that are scanned in parallel. Rotated log segments whose header
+    (see logger.read_segment_header()) shows they were written outside window are skipped.
+
+        Returns:
+            tasks (list of tuples): (function, path, arguments...) in file order.
+            skipped (int): number of skipped segments.
+    """
+    tasks = []
+    skipped = 0
+    bounds = tuple(None if t is None else t.timestamp() for t in window)
+    for path in paths:
+        with open(path, 'rb') as f:
+            is_capture = f.read(len(capture.MAGIC)) == capture.MAGIC
+        if is_capture:
+            with capture.CaptureReader(path) as reader:
+                entries = len(reader)
+            if not entries:
+                tasks.append((scan_capture, path, 0, None, window))
+            for first in range(0, entries, capture_chunk):
+                tasks.append((scan_capture, path, first, min(first + capture_chunk, entries), window))
+            continue
+        if window != (None, None) and not logger.segment_matches(logger.read_segment_header(path), *bounds):
+            skipped += 1
+            continue
+        if path.endswith('.gz'):
+            tasks.append((scan_text, path, 0, None, pattern, window))
+            continue
+        size = os.path.getsize(path)
+        for start in range(0, max(size, 1), chunk_size):
+            tasks.append((scan_text, path, start, min(start + chunk_size, size), pattern, window))
+    return tasks, skipped
+
+def run_task(task):
+    function, *args = task
+    return function(*args)
+
+def analyze(paths, pattern=PATTERN, by_event=True, gap=None, jobs=None, chunk_size=CHUNK_SIZE, start=None,
+        end=None):
+    """
+    Scans log and capture files with a pool of processes and calculates statistics of intervals between
+    consecutive records of every IMEI (and event id). Records are ordered by their timestamp, records
+    with the same timestamp (sent again) are counted once.
+
+        Parameters:
+            paths (list of str): device logs, raw text logs, server_main logs or binary captures.
+            pattern (str): regex matched against device log lines. Default PATTERN.
+            by_event (bool): separate statistics for every event id of a device. Default True.
+            gap (float): intervals longer than gap seconds are counted as gaps. Default None.
+            jobs (int): number of processes. Default None (number of CPUs).
+            chunk_size (int): bytes of a text file scanned by a single task. Default CHUNK_SIZE.
+            start (datetime): data logged before start is skipped, local time if naive. Default None.
+            end (datetime): data logged after end is skipped, local time if naive. Default None.
+
+        Returns:
+            rows (list of dicts): statistics of every group, keys are COLUMNS.
+            errors (int): number of frames that could not be decoded.
+            unattributed (int): records of TCP packets whose IMEI was not found.
+            skipped (int): rotated log segments skipped because of their header.
+    """
+    imeis = {}
+    columns = []
+    errors = unattributed = 0
+    tasks, skipped = make_tasks(paths, pattern, (start, end), chunk_size)
+    with concurrent.futures.ProcessPoolExecutor(jobs) as executor:
+        current = None
+        previous_path = None
+        for task, result in zip(tasks, executor.map(run_task, tasks)):
+            if task[1] != previous_path:
+                current = None # TCP connections don't continue in the next file.
+                previous_path = task[1]
+            codes = np.array([imeis.setdefault(imei, len(imeis)) for imei in result['imeis']] + [UNKNOWN], np.int32)
+            imei = codes[result['imei']] # UNKNOWN (-1) picks the last entry, which stays UNKNOWN.
+            unknown = imei == UNKNOWN
+            if unknown.any():
+                if current is None:
+                    unattributed += int(unknown.sum())
+                else:
+                    imei[unknown] = current
+            if result['last_imei'] is not None:
+                current = imeis[result['last_imei']]
+            keep = imei != UNKNOWN
+            columns.append((imei[keep], result['event_id'][keep], result['timestamp'][keep]))
+            errors += result['errors']
+    names = list(imeis)
+    if not columns:
+        return [], errors, unattributed, skipped
+    imei, event_id, timestamp = (np.concatenate(column) for column in zip(*columns))
+    if not by_event:
+        event_id = np.full(len(imei), NO_EVENT, np.int32)
+    order = np.lexsort((timestamp, event_id, imei))
+    imei, event_id, timestamp = imei[order], event_id[order], timestamp[order]
+    new_group = np.ones(len(imei), bool)
+    new_group[1:] = (imei[1:] != imei[:-1]) | (event_id[1:] != event_id[:-1])
+    unique = new_group.copy()
+    unique[1:] |= timestamp[1:] != timestamp[:-1]
+    imei, event_id, timestamp, new_group = imei[unique], event_id[unique], timestamp[unique], new_group[unique]
+    group = np.cumsum(new_group) - 1
+    no_of_groups = int(group[-1]) + 1 if len(group) else 0
+    follows = ~new_group[1:]
+    intervals = (timestamp[1:] - timestamp[:-1])[follows] / 1000
+    stats = group_stats(group[1:][follows], intervals, no_of_groups, gap)
+    records = np.bincount(group, minlength=no_of_groups)
+    firsts = np.flatnonzero(new_group)
+    rows = []
+    for g, first in enumerate(firsts):
+        row = {'imei':names[imei[first]], 'event_id':int(event_id[first]) if by_event else None,
+            'records':int(records[g])}
+        for name in COLUMNS[3:]:
+            value = stats[name][g]
+            row[name] = int(value) if name in ('intervals', 'gaps') else float(value)
+        if row['event_id'] == NO_EVENT:
+            row['event_id'] = None
+        rows.append(row)
+    return rows, errors, unattributed, skipped
+
+def format_value(value):
+    if value is None:
+        return '-'
+    if isinstance(value, float):
+        return 'nan' if value != value else f'{value:.3f}'
+    return str(value)
+
+def is_number(value):
+    try:
+        float(value)
+    except ValueError:
+        return False
+    return True
+
+def print_table(rows, columns, out=sys.stdout):
+    cells = [columns] + [[format_value(row[c]) for c in columns] for row in rows]
+    widths = [max(len(line[i]) for line in cells) for i in range(len(columns))]
+    for line in cells:
+        print('  '.join(cell.rjust(width) if i else cell.ljust(width)
+            for i, (cell, width) in enumerate(zip(line, widths))), file=out)
+
+def main(argv=None):
+    arg_parser = argparse.ArgumentParser(description='Statistics of intervals between records of every device '
+        'and event id, from device logs, raw text logs, server_main logs and binary captures.')
+    arg_parser.add_argument('files', nargs='+', help='files to analyze. A number after a single file is taken as '
+        'min_period of the old command line (parser.py <log> <min_period>), which was never used and is ignored')
+    arg_parser.add_argument('-p', '--pattern', default=PATTERN,
+        help=f'regex matched against device log lines. Default "{PATTERN}"')
+    arg_parser.add_argument('--by', choices=['event', 'imei'], default='event',
+        help='statistics for every IMEI and event id, or for every IMEI. Default event')
+    arg_parser.add_argument('-g', '--gap', type=float, help='count intervals longer than this many seconds')
+    arg_parser.add_argument('-j', '--jobs', type=int, help='number of processes. Default number of CPUs')
+    arg_parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE,
+        help=f'bytes of text file scanned by a single process. Default {CHUNK_SIZE}')
+    arg_parser.add_argument('--start', type=datetime.fromisoformat,
+        help='skip data logged before this time, ISO format, local time if no offset')
+    arg_parser.add_argument('--end', type=datetime.fromisoformat,
+        help='skip data logged after this time, ISO format, local time if no offset')
+    arg_parser.add_argument('--csv', action='store_true', help='print CSV instead of a table')
+    arg_parser.add_argument('-o', '--output', help='write results to this file instead of stdout')
+    args = arg_parser.parse_args(argv)
+    if len(args.files) == 2 and not os.path.exists(args.files[1]) and is_number(args.files[1]):
+        print('min_period argument is deprecated and ignored', file=sys.stderr)
+        args.files.pop()
+
+    rows, errors, unattributed, skipped = analyze(args.files, args.pattern, args.by == 'event', args.gap, args.jobs,
+        args.chunk_size, args.start, args.end)
+    columns = COLUMNS if args.by == 'event' else [c for c in COLUMNS if c != 'event_id']
+    out = open(args.output, 'w', newline='') if args.output else sys.stdout
+    try:
+        if args.csv:
+            writer = csv.writer(out)
+            writer.writerow(columns)
+            writer.writerows([['' if row[c] is None else row[c] for c in columns] for row in rows])
+        else:
+            print_table(rows, columns, out)
+    finally:
+        if args.output:
+            out.close()
+    if errors:
+        print(f'{errors} frames could not be decoded', file=sys.stderr)
+    if skipped:
+        print(f'{skipped} log segments outside of the time window are skipped', file=sys.stderr)
+    if unattributed:
+        print(f'{unattributed} records of TCP packets sent before IMEI was logged are skipped', file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,133 @@
+#!/usr/bin/python3
+
+import time
+import threading
+import collections
+
+
+class Session:
+
+    __slots__ = ('imei', 'listener', 'conn', 'addr', 'connected_at', 'last_seen', 'packets', 'records',
+        'bytes_received', 'bytes_sent', 'commands', 'announced')
+
+    def __init__(self, imei, listener, conn, addr):
+        """
+        Initializes Session object which holds state of a single device known to the server.
+
+            Parameters:
+                imei (str): IMEI of the device.
+                listener (engine.Listener): listener the device is connected to.
+                conn (asyncio.Transport or tuple): transport of TCP connection or address and port of UDP device.
+                addr (tuple): address and port of the device.
+        """
+        self.imei = imei
+        self.listener = listener
+        self.conn = conn
+        self.addr = addr
+        self.connected_at = time.time()
+        self.last_seen = self.connected_at
+        self.packets = 0
+        self.records = 0
+        self.bytes_received = 0
+        self.bytes_sent = 0
+        self.commands = collections.deque() # Encoded GPRS commands waiting to be sent.
+        self.announced = True # False until server's new_conn is emitted for the device.
+
+    def __repr__(self):
+        return f'Session({self.imei}, {self.listener}, {self.addr})'
+
+    @property
+    def protocol(self):
+        return self.listener.trans_prot
+
+
+class SessionRegistry:
+
+    def __init__(self):
+        """
+        Initializes SessionRegistry object which indexes sessions by IMEI and by (address, port).
+        Lookups take no lock, a single dict lookup is atomic. Changes are made under a lock, so both
+        indexes and the count stay consistent when sessions are added or removed from different threads.
+        """
+        self.lock = threading.Lock()
+        self.by_imei = {}
+        self.by_address = {}
+
+    def __len__(self):
+        return len(self.by_imei)
+
+    def __contains__(self, imei):
+        return imei in self.by_imei
+
+    def __iter__(self):
+        return iter(list(self.by_imei.values()))
+
+    def get(self, imei):
+        return self.by_imei.get(imei)
+
+    def get_by_address(self, addr):
+        return self.by_address.get(addr)
+
+    def add(self, imei, listener, conn, addr):
+        """
+        Adds session of a device unless the device already has one.
+
+            Returns:
+                session (Session): new or existing session of the device.
+                created (bool): True if session was created.
+        """
+        with self.lock:
+            session = self.by_imei.get(imei)
+            if session:
+                return session, False
+            session = Session(imei, listener, conn, addr)
+            self.by_imei[imei] = session
+            if addr:
+                self.by_address[addr] = session
+            return session, True
+
+    def move(self, session, listener, conn, addr):
+        """
+        Updates connection of a session, e.g. when UDP device starts sending from a different port.
+        """
+        with self.lock:
+            if self.by_address.get(session.addr) is session:
+                del self.by_address[session.addr]
+            session.listener = listener
+            session.conn = conn
+            session.addr = addr
+            if addr:
+                self.by_address[addr] = session
+
+    def remove(self, imei, conn=None):
+        """
+        Removes session of a device.
+
+            Parameters:
+                imei (str): IMEI of the device.
+                conn: if supplied, session is only removed if it still belongs to this connection. Default None.
+
+            Returns:
+                session (Session): removed session, None if there was nothing to remove.
+        """
+        with self.lock:
+            session = self.by_imei.get(imei)
+            if session is None or (conn is not None and session.conn is not conn):
+                return None
+            del self.by_imei[imei]
+            if self.by_address.get(session.addr) is session:
+                del self.by_address[session.addr]
+            return session
+
+    def clear(self):
+        """
+        Removes every session.
+
+            Returns:
+                sessions (list of Session): removed sessions.
+        """
+        with self.lock:
+            sessions = list(self.by_imei.values())
+            self.by_imei = {}
+            self.by_address = {}
+            return sessions
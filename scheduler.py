@@ -0,0 +1,170 @@
+#!/usr/bin/python3
+
+import time
+import heapq
+import random
+import itertools
+import threading
+import collections
+
+MAX_PENDING = 100 # Commands kept for a single offline device, oldest are dropped.
+
+
+class Job:
+
+    __slots__ = ('id', 'imei', 'cmd', 'period', 'jitter', 'planned', 'next_run', 'runs', 'cancelled')
+
+    def __init__(self, id, imei, cmd, period=None, jitter=0.0):
+        """
+        Initializes Job object which describes a GPRS command sent to a device once or periodically.
+
+            Parameters:
+                id (int): unique id of the job.
+                imei (str): IMEI of the device.
+                cmd (str): GPRS command.
+                period (float): seconds between sends, None sends the command once. Default None.
+                jitter (float): every send is delayed by random time up to this many seconds. Default 0.
+        """
+        self.id = id
+        self.imei = imei
+        self.cmd = cmd
+        self.period = period
+        self.jitter = jitter
+        self.planned = None # Time of the next run without jitter, periods are counted from it.
+        self.next_run = None
+        self.runs = 0
+        self.cancelled = False
+
+    def __repr__(self):
+        return f'Job({self.id}, {self.imei}, {self.cmd!r}, period={self.period})'
+
+
+class CommandScheduler(threading.Thread):
+
+    def __init__(self, server, max_pending=MAX_PENDING):
+        """
+        Initializes CommandScheduler object. A single thread that sends scheduled GPRS commands.
+        Jobs are kept in a min-heap ordered by time of their next run, so the thread only wakes up
+        when the earliest job is due. Cancelled jobs are dropped from the heap when they come up.
+        Commands of devices that are offline when their job runs are queued for the device and sent
+        when it connects again (see device_online). A periodic job is queued at most once.
+
+            Parameters:
+                server (core.ServerCore): server the commands are sent through.
+                max_pending (int): maximum number of commands queued for a single device. Default MAX_PENDING.
+        """
+        super().__init__(name='CommandScheduler', daemon=True)
+        self.server = server
+        self.max_pending = max_pending
+        self.heap = []
+        self.jobs = {} # jobs[id] = job
+        self.pending = {} # pending[imei] = OrderedDict of job id: job waiting for the device to connect
+        self.ids = itertools.count(1)
+        self.condition = threading.Condition()
+        self.stopping = False
+
+    def schedule(self, imei, cmd, delay=0.0, period=None, jitter=0.0):
+        """
+        Schedules GPRS command. Starts the scheduler thread if it isn't running yet.
+
+            Parameters:
+                imei (str): IMEI of the device.
+                cmd (str): GPRS command.
+                delay (float): seconds until the first send. Default 0.
+                period (float): seconds between sends, None sends the command once. Default None.
+                jitter (float): every send is delayed by random time up to this many seconds. Default 0.
+
+            Returns:
+                job (Job): scheduled job, can be passed to cancel().
+        """
+        job = Job(next(self.ids), imei, cmd, period, jitter)
+        with self.condition:
+            self.jobs[job.id] = job
+            self.push(job, time.monotonic() + delay)
+            if not self.is_alive() and not self.stopping:
+                self.start()
+        return job
+
+    def push(self, job, planned):
+        # Must be called with the condition held.
+        job.planned = planned
+        job.next_run = planned + random.uniform(0, job.jitter)
+        heapq.heappush(self.heap, (job.next_run, job.id, job))
+        if self.heap[0][2] is job:
+            self.condition.notify()
+
+    def cancel(self, job):
+        with self.condition:
+            job.cancelled = True
+            self.jobs.pop(job.id, None)
+            pending = self.pending.get(job.imei)
+            if pending:
+                pending.pop(job.id, None)
+
+    def cancel_device(self, imei):
+        """
+        Cancels every job of a device and forgets its queued commands.
+        """
+        with self.condition:
+            for job in [job for job in self.jobs.values() if job.imei == imei]:
+                job.cancelled = True
+                del self.jobs[job.id]
+            self.pending.pop(imei, None)
+
+    def device_online(self, imei):
+        """
+        Sends commands queued while the device was offline. Connect it to server's new_conn signal.
+        """
+        with self.condition:
+            pending = self.pending.pop(imei, None)
+        for job in (pending or {}).values():
+            self.server.send_cmd(job.cmd, imei)
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.stopping:
+                    if self.heap and self.heap[0][2].cancelled:
+                        heapq.heappop(self.heap)
+                        continue
+                    timeout = self.heap[0][0] - time.monotonic() if self.heap else None
+                    if timeout is not None and timeout <= 0:
+                        break
+                    self.condition.wait(timeout)
+                if self.stopping:
+                    return
+                now = time.monotonic()
+                due = []
+                while self.heap and self.heap[0][0] <= now:
+                    _, _, job = heapq.heappop(self.heap)
+                    if job.cancelled:
+                        continue
+                    due.append(job)
+                    job.runs += 1
+                    if job.period:
+                        # Counted from the planned time, so jitter doesn't accumulate.
+                        self.push(job, max(now, job.planned + job.period))
+                    else:
+                        self.jobs.pop(job.id, None)
+            for job in due:
+                self.run_job(job)
+
+    def run_job(self, job):
+        if job.imei in self.server.sessions:
+            self.server.send_cmd(job.cmd, job.imei)
+            return
+        with self.condition:
+            if job.cancelled:
+                return
+            pending = self.pending.setdefault(job.imei, collections.OrderedDict())
+            pending.pop(job.id, None)
+            pending[job.id] = job
+            while len(pending) > self.max_pending:
+                pending.popitem(last=False)
+
+    def stop(self):
+        with self.condition:
+            self.stopping = True
+            self.condition.notify()
+        if self.is_alive():
+            self.join()
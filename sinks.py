@@ -0,0 +1,347 @@
+#!/usr/bin/python3
+
+import os
+import abc
+import json
+import time
+import struct
+import sqlite3
+import threading
+import collections
+from datetime import timedelta
+import parselib
+
+BATCH_SIZE = 50000 # Records written in a single commit at most.
+COMMIT_DELAY = 0.0 # Seconds to wait for more records before committing. Batches also form while committing.
+MAX_OPEN_FILES = 256 # Partitions of ColumnarSink kept open.
+
+# Columns of ColumnarSink blocks: name and struct format of a single value. Coordinates are kept
+# as sent by the device, in 1e-7 degrees.
+COLUMNS = (('timestamp', 'Q'), ('priority', 'B'), ('longitude', 'i'), ('latitude', 'i'), ('altitude', 'h'),
+    ('angle', 'H'), ('satellites', 'B'), ('speed', 'H'), ('event_id', 'H'))
+BLOCK_MAGIC = b'TRB1'
+BLOCK_HEADER = struct.Struct('>4sII') # magic, number of records, length of IO elements
+
+
+def timestamp_ms(record):
+    return (record['timestamp'] - parselib.EPOCH) // timedelta(milliseconds=1)
+
+def io_json(io):
+    # IO elements as JSON object, variable length (Codec 8E NX) values are hex strings.
+    return json.dumps({str(avl_id): value.hex() if isinstance(value, bytes) else value
+        for avl_id, value in io.items()}, separators=(',', ':'))
+
+
+class RecordSink(abc.ABC):
+
+    def __init__(self, batch_size=BATCH_SIZE, commit_delay=COMMIT_DELAY):
+        """
+        Initializes RecordSink object, base of storage backends for decoded records. Records are queued
+        by put() and written by the sink's thread. Everything queued while the previous commit was
+        running is written and made durable by a single commit (group commit), so the cost of
+        a commit is shared by every packet in it. Callbacks passed to put() are called once the
+        records are durable. Subclasses implement open(), write(), commit() and close_storage().
+
+            Parameters:
+                batch_size (int): records written in a single commit at most. Default BATCH_SIZE.
+                commit_delay (float): seconds to wait for more records before committing. Default COMMIT_DELAY.
+        """
+        self.batch_size = batch_size
+        self.commit_delay = commit_delay
+        self.condition = threading.Condition()
+        self.pending = collections.deque() # (imei, records, callback) waiting to be written.
+        self.backlog = 0 # Records waiting to be written.
+        self.thread = None
+        self.stopping = False
+        self.server = None
+
+    def start(self, server):
+        """
+        Starts the sink's thread. Errors are logged and counted through server (core.ServerCore).
+        """
+        self.server = server
+        self.stopping = False
+        self.thread = threading.Thread(target=self.run, name=type(self).__name__, daemon=True)
+        self.thread.start()
+
+    def put(self, imei, records, callback=None):
+        """
+        Queues records of a single packet. Safe to call from any thread.
+
+            Parameters:
+                imei (str): IMEI of the device.
+                records (list of Records): records decoded by parselib.decode_record_payload().
+                callback (function): called without arguments from the sink's thread once records are durable.
+                Default None.
+        """
+        with self.condition:
+            self.pending.append((imei, records, callback))
+            self.backlog += len(records)
+            if len(self.pending) == 1:
+                self.condition.notify()
+
+    def run(self):
+        self.open()
+        try:
+            while True:
+                with self.condition:
+                    while not self.pending and not self.stopping:
+                        self.condition.wait()
+                    if not self.pending:
+                        return
+                    if self.commit_delay and self.backlog < self.batch_size and not self.stopping:
+                        self.condition.wait(self.commit_delay)
+                    batch = []
+                    count = 0
+                    while self.pending and count < self.batch_size:
+                        batch.append(self.pending.popleft())
+                        count += len(batch[-1][1])
+                    self.backlog -= count
+                self.store(batch, count)
+        finally:
+            self.close_storage()
+
+    def store(self, batch, count):
+        start = time.perf_counter()
+        try:
+            self.write(batch)
+            self.commit()
+        except Exception as e:
+            # Packets of the batch stay unacked (if acks wait for the sink), devices will send them again.
+            # The sink's thread keeps running, later batches are still stored.
+            self.server.metrics.inc('sink_errors')
+            self.server.logger.error(f"{type(self).__name__} could not store {count} records - {e}")
+            return
+        self.server.metrics.observe('sink_commit_seconds', time.perf_counter() - start)
+        self.server.metrics.inc('records_stored', count)
+        for _, _, callback in batch:
+            if callback:
+                callback()
+
+    def open(self):
+        pass
+
+    @abc.abstractmethod
+    def write(self, batch):
+        pass
+
+    def commit(self):
+        pass
+
+    def close_storage(self):
+        pass
+
+    def close(self):
+        """
+        Writes every queued record and stops the sink's thread.
+        """
+        with self.condition:
+            self.stopping = True
+            self.condition.notify()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+
+
+class SqliteSink(RecordSink):
+
+    def __init__(self, path, **kwargs):
+        """
+        Initializes SqliteSink object which stores records in records table of SQLite database.
+        The database is in WAL mode and every batch is a single transaction, synchronous=FULL makes
+        every commit durable.
+
+            Parameters:
+                path (str): database file.
+        """
+        super().__init__(**kwargs)
+        self.path = path
+        self.db = None
+
+    def open(self):
+        # Connection belongs to the sink's thread.
+        self.db = sqlite3.connect(self.path, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=FULL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS records (imei TEXT NOT NULL, timestamp INTEGER NOT NULL, '
+            'priority INTEGER, longitude REAL, latitude REAL, altitude INTEGER, angle INTEGER, satellites INTEGER, '
+            'speed INTEGER, event_id INTEGER, io TEXT)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS records_imei_timestamp ON records (imei, timestamp)')
+
+    def write(self, batch):
+        rows = []
+        for imei, records, _ in batch:
+            for record in records:
+                gps = record['gps_data']
+                rows.append((imei, timestamp_ms(record), record['priority'], gps['longitude'], gps['latitude'],
+                    gps['altitude'], gps['angle'], gps['satellites'], gps['speed'], record['event_id'],
+                        io_json(record['io'])))
+        self.db.execute('BEGIN')
+        try:
+            self.db.executemany('INSERT INTO records VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+        except Exception:
+            self.db.execute('ROLLBACK')
+            raise
+
+    def commit(self):
+        try:
+            self.db.execute('COMMIT')
+        except sqlite3.Error:
+            if self.db.in_transaction:
+                self.db.execute('ROLLBACK')
+            raise
+
+    def close_storage(self):
+        if self.db:
+            self.db.close()
+            self.db = None
+
+
+class ColumnarSink(RecordSink):
+
+    def __init__(self, directory, max_open_files=MAX_OPEN_FILES, **kwargs):
+        """
+        Initializes ColumnarSink object which appends records to columnar files partitioned by day
+        (of the record's timestamp, UTC) and IMEI: <directory>/<YYYY-MM-DD>/<imei>.col.
+        Records of a device written in one batch make a block: BLOCK_HEADER followed by every column
+        of COLUMNS (big-endian) and IO elements as JSON lines. Files are only appended to,
+        every file written in a batch is fsynced once when the batch is committed. If a batch fails,
+        files are truncated to their size before the batch, so its records are not stored twice when
+        devices send them again. See read_blocks().
+
+            Parameters:
+                directory (str): root directory of the partitions.
+                max_open_files (int): partitions kept open. Default MAX_OPEN_FILES.
+        """
+        super().__init__(**kwargs)
+        self.directory = directory
+        self.max_open_files = max_open_files
+        self.files = collections.OrderedDict() # files[(day, imei)] = file object, least recently used first
+        self.dirty = set()
+        self.offsets = {} # offsets[(day, imei)] = size of the file before the current batch
+
+    def partition_path(self, day, imei):
+        return os.path.join(self.directory, day, f'{imei}.col')
+
+    def partition(self, day, imei):
+        key = (day, imei)
+        f = self.files.get(key)
+        if f:
+            self.files.move_to_end(key)
+            return f
+        while len(self.files) >= self.max_open_files:
+            old_key, old = self.files.popitem(last=False)
+            if old_key in self.dirty:
+                old.flush()
+                os.fsync(old.fileno())
+                self.dirty.discard(old_key)
+            old.close()
+        os.makedirs(os.path.join(self.directory, day), exist_ok=True)
+        f = self.files[key] = open(self.partition_path(day, imei), 'ab')
+        return f
+
+    def write(self, batch):
+        partitions = {}
+        for imei, records, _ in batch:
+            for record in records:
+                partitions.setdefault((record['timestamp'].strftime('%Y-%m-%d'), imei), []).append(record)
+        blocks = {}
+        for key, records in partitions.items():
+            columns = {name: [] for name, _ in COLUMNS}
+            for record in records:
+                gps = record['gps_data']
+                columns['timestamp'].append(timestamp_ms(record))
+                columns['priority'].append(record['priority'])
+                columns['longitude'].append(round(gps['longitude'] * 10000000))
+                columns['latitude'].append(round(gps['latitude'] * 10000000))
+                columns['altitude'].append(gps['altitude'])
+                columns['angle'].append(gps['angle'])
+                columns['satellites'].append(gps['satellites'])
+                columns['speed'].append(gps['speed'])
+                columns['event_id'].append(record['event_id'])
+            io = ''.join(io_json(record['io']) + '\n' for record in records).encode('utf-8')
+            parts = [BLOCK_HEADER.pack(BLOCK_MAGIC, len(records), len(io))]
+            for name, fmt in COLUMNS:
+                parts.append(struct.pack(f'>{len(records)}{fmt}', *columns[name]))
+            parts.append(io)
+            blocks[key] = b''.join(parts)
+        try:
+            for key, block in blocks.items():
+                f = self.partition(*key)
+                self.offsets.setdefault(key, f.tell())
+                f.write(block)
+                self.dirty.add(key)
+        except Exception:
+            self.rollback()
+            raise
+
+    def commit(self):
+        try:
+            for key in self.dirty:
+                f = self.files[key]
+                f.flush()
+                os.fsync(f.fileno())
+        except Exception:
+            self.rollback()
+            raise
+        self.dirty.clear()
+        self.offsets.clear()
+
+    def rollback(self):
+        # Blocks of the failed batch are cut off, files are reopened by the next batch.
+        for key, offset in self.offsets.items():
+            f = self.files.pop(key, None)
+            if f:
+                try:
+                    f.close()
+                except OSError:
+                    pass
+            os.truncate(self.partition_path(*key), offset)
+        self.dirty.clear()
+        self.offsets.clear()
+
+    def close_storage(self):
+        for f in self.files.values():
+            f.close()
+        self.files.clear()
+
+
+def read_blocks(path):
+    """
+    Reads columnar file written by ColumnarSink. A block cut short by a crash ends the file.
+
+        Parameters:
+            path (str): path to <imei>.col file.
+
+        Returns:
+            blocks (generator of dicts): every block as dict of column name: tuple of values,
+            'io' is a list of dicts keyed by AVL id (str).
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    pos = 0
+    while pos + BLOCK_HEADER.size <= len(data):
+        magic, count, io_length = BLOCK_HEADER.unpack_from(data, pos)
+        if magic != BLOCK_MAGIC:
+            raise ValueError(f'{path} is corrupted at offset {pos}')
+        pos += BLOCK_HEADER.size
+        size = sum(struct.calcsize(f'>{fmt}') for _, fmt in COLUMNS) * count + io_length
+        if pos + size > len(data):
+            return
+        block = {}
+        for name, fmt in COLUMNS:
+            block[name] = struct.unpack_from(f'>{count}{fmt}', data, pos)
+            pos += struct.calcsize(f'>{count}{fmt}')
+        block['io'] = [json.loads(line) for line in data[pos:pos + io_length].decode('utf-8').splitlines()]
+        pos += io_length
+        yield block
+
+def create_sink(kind, path, **kwargs):
+    """
+    Creates sink of the kind, 'sqlite' or 'columnar'.
+    """
+    if kind == 'sqlite':
+        return SqliteSink(path, **kwargs)
+    if kind == 'columnar':
+        return ColumnarSink(path, **kwargs)
+    raise ValueError(f'Unknown record sink {kind}')
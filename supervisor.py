@@ -0,0 +1,428 @@
+#!/usr/bin/python3
+
+import os
+import json
+import socket
+import threading
+import socketserver
+import multiprocessing
+import multiprocessing.connection
+from core import Signal
+from logger import Logger
+from scheduler import CommandScheduler
+
+CONTROL_SOCKET = 'control.sock' # Unix socket workers and control clients connect to.
+
+
+def worker_file(path, worker):
+    # Every worker writes its own logs, e.g. raw.log of worker 1 is raw.1.log.
+    root, ext = os.path.splitext(path)
+    return f'{root}.{worker}{ext}'
+
+
+class Device:
+
+    __slots__ = ('imei', 'worker', 'addr', 'protocol')
+
+    def __init__(self, imei, worker, addr, protocol):
+        """
+        Initializes Device object, an entry of the supervisor's directory of devices connected to workers.
+        """
+        self.imei = imei
+        self.worker = worker
+        self.addr = addr
+        self.protocol = protocol
+
+    def __repr__(self):
+        return f'Device({self.imei}, worker {self.worker}, {self.addr})'
+
+
+class Directory:
+
+    def __init__(self):
+        """
+        Initializes Directory object which maps IMEI of every device to the worker holding its connection.
+        Lookups take no lock, changes are made under a lock.
+        """
+        self.lock = threading.Lock()
+        self.devices = {}
+
+    def __len__(self):
+        return len(self.devices)
+
+    def __contains__(self, imei):
+        return imei in self.devices
+
+    def __iter__(self):
+        return iter(list(self.devices.values()))
+
+    def get(self, imei):
+        return self.devices.get(imei)
+
+    def add(self, imei, worker, addr, protocol):
+        """
+        Records that device is connected to worker. A device that reconnects through another worker
+        moves to it.
+
+            Returns:
+                created (bool): True if the device wasn't connected to any worker.
+        """
+        with self.lock:
+            created = imei not in self.devices
+            self.devices[imei] = Device(imei, worker, addr, protocol)
+            return created
+
+    def remove(self, imei, worker=None):
+        """
+        Removes device. If worker is supplied, device is only removed if it is still connected to it.
+
+            Returns:
+                removed (bool): True if device was removed.
+        """
+        with self.lock:
+            device = self.devices.get(imei)
+            if device is None or (worker is not None and device.worker != worker):
+                return False
+            del self.devices[imei]
+            return True
+
+    def remove_worker(self, worker):
+        """
+        Removes every device of the worker.
+
+            Returns:
+                imeis (list of str): IMEIs of removed devices.
+        """
+        with self.lock:
+            imeis = [imei for imei, device in self.devices.items() if device.worker == worker]
+            for imei in imeis:
+                del self.devices[imei]
+            return imeis
+
+
+class ControlHandler(socketserver.StreamRequestHandler):
+
+    # Every connection is either a worker, it introduces itself with 'hello', or a control client
+    # (ControlClient) that sends requests and reads replies. Messages are JSON objects, one per line.
+
+    def setup(self):
+        super().setup()
+        self.lock = threading.Lock()
+        self.worker = None
+
+    def handle(self):
+        supervisor = self.server.supervisor
+        for line in self.rfile:
+            try:
+                msg = json.loads(line)
+                op = msg['op']
+            except (ValueError, KeyError, TypeError):
+                self.send({'ok':False, 'error':'malformed message'})
+                continue
+            if op == 'hello':
+                self.worker = msg['worker']
+                supervisor.worker_connected(self.worker, self)
+            elif self.worker is not None:
+                supervisor.worker_message(self.worker, msg)
+            else:
+                self.send(supervisor.request(msg))
+        if self.worker is not None:
+            supervisor.worker_disconnected(self.worker, self)
+
+    def send(self, msg):
+        with self.lock:
+            try:
+                self.wfile.write(json.dumps(msg).encode('utf-8') + b'\n')
+            except OSError:
+                pass
+
+
+class ControlServer(socketserver.ThreadingUnixStreamServer):
+
+    daemon_threads = True
+
+    def __init__(self, path, supervisor):
+        """
+        Initializes ControlServer object. Socket is bound and listening, connections are accepted once
+        start() is called.
+        """
+        if os.path.exists(path):
+            os.unlink(path) # Left behind by a supervisor that didn't stop cleanly.
+        super().__init__(path, ControlHandler)
+        self.path = path
+        self.supervisor = supervisor
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, name='ControlServer', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.thread:
+            self.shutdown()
+        self.server_close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+class Supervisor:
+
+    def __init__(self, workers, target, control_path=CONTROL_SOCKET, log_file='application_events.log',
+            log_rotation=None):
+        """
+        Initializes Supervisor object. It forks workers, each of them runs its own server (core.ServerCore)
+        on listeners opened with SO_REUSEPORT, so the kernel spreads connections and datagrams over them.
+        Workers report devices that connect and disconnect over the control socket, the supervisor keeps
+        a directory of them and routes GPRS commands and disconnect requests to the worker that holds
+        the device. It offers the part of ServerCore's interface used by the scheduler and the CLI:
+        sessions, clients, send_cmd(), disconnect_client(), display_info, new_conn and closed_conn.
+
+            Parameters:
+                workers (int): number of worker processes.
+                target (function): runs a worker until it is closed, called with worker index and
+                control socket path in the forked process.
+                control_path (str): path of the control socket. Default CONTROL_SOCKET.
+                log_file (str): application events log file of the supervisor. Default 'application_events.log'.
+                log_rotation (dict): rotation of log_file, see logger.Logger. Default None.
+        """
+        self.display_info = Signal()
+        self.new_conn = Signal()
+        self.closed_conn = Signal()
+        self.workers = workers
+        self.target = target
+        self.control_path = control_path
+        self.sessions = Directory()
+        self.links = {} # links[worker] = ControlHandler of worker's connection
+        self.processes = {} # processes[worker] = multiprocessing.Process
+        self.control = None
+        self.thread = None
+        self.stopping = False
+        self.logger = Logger('Supervisor', log_file, rotation=log_rotation)
+        self.scheduler = CommandScheduler(self)
+        self.new_conn.connect(self.scheduler.device_online)
+
+    @property
+    def clients(self):
+        return len(self.sessions)
+
+    def start(self):
+        # Workers are forked before any thread of the supervisor is started.
+        self.control = ControlServer(self.control_path, self)
+        context = multiprocessing.get_context('fork')
+        for worker in range(self.workers):
+            process = context.Process(target=self.run_worker, args=(worker,), name=f'Worker-{worker}')
+            process.start()
+            self.processes[worker] = process
+            self.logger.info(f'Worker {worker} started, pid {process.pid}.')
+        self.control.start()
+        self.thread = threading.Thread(target=self.watch, name='Supervisor', daemon=True)
+        self.thread.start()
+
+    def run_worker(self, worker):
+        # Runs in the forked worker process.
+        self.control.socket.close()
+        self.target(worker, self.control_path)
+
+    def watch(self):
+        # Waits for workers to exit. Devices of a worker that exits are removed from the directory.
+        while self.processes:
+            sentinels = {process.sentinel: worker for worker, process in self.processes.items()}
+            for sentinel in multiprocessing.connection.wait(list(sentinels)):
+                worker = sentinels[sentinel]
+                process = self.processes.pop(worker)
+                process.join()
+                if not self.stopping:
+                    self.logger.error(f'Worker {worker} exited with code {process.exitcode}.')
+                self.worker_disconnected(worker, self.links.get(worker))
+        self.logger.info(f'Every worker has exited.')
+
+    def worker_connected(self, worker, link):
+        self.links[worker] = link
+        self.logger.info(f'Worker {worker} connected to the supervisor.')
+
+    def worker_disconnected(self, worker, link):
+        if link is None or self.links.get(worker) is not link:
+            return
+        del self.links[worker]
+        for imei in self.sessions.remove_worker(worker):
+            self.closed_conn.emit(imei)
+
+    def worker_message(self, worker, msg):
+        op = msg.get('op')
+        if op == 'online':
+            addr = tuple(msg['addr']) if msg.get('addr') else None
+            if self.sessions.add(msg['imei'], worker, addr, msg.get('protocol')):
+                self.display_info.emit(f"Connected from: {addr}. IMEI: {msg['imei']} (worker {worker})")
+                self.new_conn.emit(msg['imei'])
+        elif op == 'offline':
+            if self.sessions.remove(msg['imei'], worker):
+                self.display_info.emit(f"Connection with {msg['imei']} closed (worker {worker}).")
+                self.closed_conn.emit(msg['imei'])
+        else:
+            self.logger.warning(f'Unknown message from worker {worker} - {msg}')
+
+    def route(self, imei, msg):
+        # Sends message to the worker holding the device. Returns worker index, None if device is offline.
+        device = self.sessions.get(imei)
+        link = self.links.get(device.worker) if device else None
+        if not link:
+            return None
+        link.send(msg)
+        return device.worker
+
+    def send_cmd(self, cmd, imei):
+        worker = self.route(imei, {'op':'send_cmd', 'imei':imei, 'cmd':cmd})
+        if worker is None:
+            self.display_info.emit(f"Could not send GPRS CMD - {imei} is not connected.")
+            self.logger.error(f"Could not send GPRS CMD - {imei} is not connected.")
+        else:
+            self.display_info.emit(f"Sending GPRS CMD to {imei} (worker {worker}) - {cmd}")
+            self.logger.info(f"Sending GPRS CMD to {imei} (worker {worker}) - {cmd}")
+        return worker
+
+    def disconnect_client(self, imei):
+        worker = self.route(imei, {'op':'disconnect', 'imei':imei})
+        if worker is not None:
+            self.display_info.emit(f"Connection with {imei} closed by user input.")
+        return worker
+
+    def request(self, msg):
+        # Handles request of a control client and returns the reply.
+        op = msg.get('op')
+        if op == 'clients':
+            return {'ok':True, 'clients':[{'imei':device.imei, 'worker':device.worker,
+                'addr':device.addr, 'protocol':device.protocol} for device in self.sessions]}
+        if op == 'send_cmd' and msg.get('imei') and msg.get('cmd'):
+            worker = self.send_cmd(msg['cmd'], msg['imei'])
+        elif op == 'disconnect' and msg.get('imei'):
+            worker = self.disconnect_client(msg['imei'])
+        else:
+            return {'ok':False, 'error':f'unknown request {op}'}
+        if worker is None:
+            return {'ok':False, 'error':f"{msg['imei']} is not connected"}
+        return {'ok':True, 'worker':worker}
+
+    def close(self):
+        # Workers close their servers on SIGTERM, self.thread exits once all of them have.
+        self.stopping = True
+        for process in list(self.processes.values()):
+            process.terminate()
+
+    def stop(self):
+        # Called once every worker has exited.
+        self.scheduler.stop()
+        if self.control:
+            self.control.stop()
+
+
+class SupervisorLink(threading.Thread):
+
+    def __init__(self, server, worker, path=CONTROL_SOCKET):
+        """
+        Initializes SupervisorLink object which connects worker's server to the supervisor. Devices
+        that connect to or disconnect from the server are reported to the supervisor, GPRS commands
+        and disconnect requests routed by the supervisor are passed to the server. When the supervisor
+        goes away, the server is closed.
+
+            Parameters:
+                server (core.ServerCore): server of the worker.
+                worker (int): index of the worker.
+                path (str): path of the supervisor's control socket. Default CONTROL_SOCKET.
+        """
+        super().__init__(name='SupervisorLink', daemon=True)
+        self.server = server
+        self.worker = worker
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+        self.lock = threading.Lock()
+        self.send({'op':'hello', 'worker':worker, 'pid':os.getpid()})
+        server.new_conn.connect(self.device_online)
+        server.closed_conn.connect(self.device_offline)
+
+    def send(self, msg):
+        with self.lock:
+            try:
+                self.sock.sendall(json.dumps(msg).encode('utf-8') + b'\n')
+            except OSError:
+                pass
+
+    def device_online(self, imei):
+        session = self.server.sessions.get(imei)
+        self.send({'op':'online', 'imei':imei, 'addr':session.addr if session else None,
+            'protocol':session.protocol if session else None})
+
+    def device_offline(self, imei):
+        self.send({'op':'offline', 'imei':imei})
+
+    def run(self):
+        try:
+            with self.sock.makefile('rb') as f:
+                for line in f:
+                    try:
+                        msg = json.loads(line)
+                        if msg['op'] == 'send_cmd':
+                            self.server.send_cmd(msg['cmd'], msg['imei'])
+                        elif msg['op'] == 'disconnect':
+                            self.server.disconnect_client(msg['imei'])
+                    except (ValueError, KeyError, TypeError) as e:
+                        self.server.logger.error(f'Malformed message from the supervisor is skipped - {e!r}')
+        finally:
+            # Without the link the worker has no routing, so it is closed however the link ends.
+            self.sock.close()
+            if self.server.running:
+                self.server.logger.error(f'Connection with the supervisor is lost, closing the server.')
+                self.server.close()
+
+
+class ControlClient:
+
+    def __init__(self, path=CONTROL_SOCKET, timeout=5.0):
+        """
+        Initializes ControlClient object which sends requests to a running supervisor.
+
+            Parameters:
+                path (str): path of the supervisor's control socket. Default CONTROL_SOCKET.
+                timeout (float): seconds to wait for a reply. Default 5.
+        """
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        self.sock.connect(path)
+        self.file = self.sock.makefile('rb')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def request(self, op, **kwargs):
+        """
+        Sends request and waits for its reply.
+
+            Returns:
+                reply (dict): reply of the supervisor.
+
+            Raises:
+                RuntimeError: if the supervisor couldn't handle the request.
+        """
+        self.sock.sendall(json.dumps({'op':op, **kwargs}).encode('utf-8') + b'\n')
+        line = self.file.readline()
+        if not line:
+            raise RuntimeError('Supervisor closed the connection')
+        reply = json.loads(line)
+        if not reply.get('ok'):
+            raise RuntimeError(reply.get('error'))
+        return reply
+
+    def clients(self):
+        return self.request('clients')['clients']
+
+    def send_cmd(self, cmd, imei):
+        return self.request('send_cmd', imei=imei, cmd=cmd)['worker']
+
+    def disconnect_client(self, imei):
+        return self.request('disconnect', imei=imei)['worker']
+
+    def close(self):
+        self.file.close()
+        self.sock.close()
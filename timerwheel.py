@@ -0,0 +1,125 @@
+#!/usr/bin/python3
+
+import math
+import time
+
+TICK = 1.0 # Resolution of the wheel in seconds.
+SLOTS = 64
+LEVELS = 4 # With 1 s tick, timers up to 64 ** 4 s (~194 days) are kept on the wheel.
+
+
+class Timer:
+
+    __slots__ = ('expires', 'callback', 'args', 'bucket')
+
+    def __init__(self, expires, callback, args):
+        self.expires = expires # Tick the timer expires at.
+        self.callback = callback
+        self.args = args
+        self.bucket = None # Set the timer is stored in, None once it has fired or was cancelled.
+
+
+class TimerWheel:
+
+    def __init__(self, tick=TICK, slots=SLOTS, levels=LEVELS, start=None):
+        """
+        Initializes TimerWheel object. A hierarchical timer wheel: level 0 has a slot for every tick,
+        every slot of level n spans all slots of level n - 1. Timers are moved one level down when the
+        slot they are in comes up. Scheduling, cancelling and advancing by a tick are O(1) no matter
+        how many timers there are. Not thread-safe, use it from a single thread (the engine's event loop).
+
+            Parameters:
+                tick (float): resolution in seconds. Default TICK.
+                slots (int): slots on every level. Default SLOTS.
+                levels (int): number of levels. Default LEVELS.
+                start (float): time.monotonic() of tick 0. Default now.
+        """
+        self.tick = tick
+        self.slots = slots
+        self.levels = levels
+        self.start = time.monotonic() if start is None else start
+        self.current = 0
+        self.wheels = [[set() for _ in range(slots)] for _ in range(levels)]
+        self.overflow = set() # Timers too far in the future for the wheel.
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def schedule(self, delay, callback, *args):
+        """
+        Schedules callback(*args) to be called after delay seconds, rounded up to the next tick.
+
+            Returns:
+                timer (Timer): handle that can be cancelled.
+        """
+        timer = Timer(self.current + max(1, math.ceil(delay / self.tick)), callback, args)
+        self.insert(timer)
+        self.count += 1
+        return timer
+
+    def cancel(self, timer):
+        if timer is not None and timer.bucket is not None:
+            timer.bucket.discard(timer)
+            timer.bucket = None
+            self.count -= 1
+
+    def insert(self, timer):
+        ticks = timer.expires - self.current
+        span = self.slots
+        for level in range(self.levels):
+            if ticks < span:
+                bucket = self.wheels[level][(timer.expires * self.slots // span) % self.slots]
+                break
+            span *= self.slots
+        else:
+            bucket = self.overflow
+        bucket.add(timer)
+        timer.bucket = bucket
+
+    def cascade(self):
+        # Moves timers of the slots that came up on higher levels one or more levels down.
+        span = self.slots
+        cascaded = []
+        for level in range(1, self.levels):
+            if self.current % span:
+                break
+            index = (self.current // span) % self.slots
+            cascaded.append(self.wheels[level][index])
+            self.wheels[level][index] = set()
+            span *= self.slots
+        else:
+            if self.current % span == 0:
+                cascaded.append(self.overflow)
+                self.overflow = set()
+        for bucket in reversed(cascaded):
+            for timer in bucket:
+                self.insert(timer)
+
+    def advance(self, now=None):
+        """
+        Advances the wheel to now and calls callbacks of expired timers.
+
+            Parameters:
+                now (float): time.monotonic() time. Default now.
+
+            Returns:
+                fired (int): number of callbacks called.
+        """
+        now = time.monotonic() if now is None else now
+        target = int((now - self.start) / self.tick)
+        fired = 0
+        while self.current < target:
+            self.current += 1
+            self.cascade()
+            index = self.current % self.slots
+            bucket = self.wheels[0][index]
+            if not bucket:
+                continue
+            self.wheels[0][index] = set()
+            for timer in bucket:
+                timer.bucket = None
+                self.count -= 1
+                timer.callback(*timer.args)
+                fired += 1
+        return fired
@@ -114,6 +114,10 @@ class Ui_MainWindow(object):
         self.lineEdit = QtWidgets.QLineEdit(self.centralwidget)
         self.lineEdit.setObjectName("lineEdit")
         self.horizontalLayout_2.addWidget(self.lineEdit)
+        self.checkBoxAll = QtWidgets.QCheckBox(self.centralwidget)
+        self.checkBoxAll.setChecked(False)
+        self.checkBoxAll.setObjectName("checkBoxAll")
+        self.horizontalLayout_2.addWidget(self.checkBoxAll)
         self.checkBox = QtWidgets.QCheckBox(self.centralwidget)
         self.checkBox.setChecked(False)
         self.checkBox.setObjectName("checkBox")
@@ -151,6 +155,7 @@ class Ui_MainWindow(object):
         self.radioButtonTCP.setText(_translate("MainWindow", "TCP"))
         self.radioButtonUDP.setText(_translate("MainWindow", "UDP"))
         self.pushButtonStart.setText(_translate("MainWindow", "Start"))
+        self.checkBoxAll.setText(_translate("MainWindow", "All clients"))
         self.checkBox.setText(_translate("MainWindow", "Automatic"))
         self.pushButtonSend.setText(_translate("MainWindow", "Send"))
 